@@ -0,0 +1,87 @@
+#! /usr/bin/env python
+
+import random
+import sys
+import time
+from typing import List, Tuple
+
+import click
+from fn import F
+
+from pipeline.pampi import trim
+from pipeline.util import chunked
+
+
+def simulate(nreads: int, length: int, phred: int, seed: int,
+             pool: int=1000) -> List[Tuple[str, str, str]]:
+    """
+    Generate reads with qualities slowly degrading towards the 3' end. To keep
+    simulation time negligible, sequences and quality strings are drawn from a
+    pool of `pool` precomputed variants.
+    :param nreads:
+    :param length:
+    :param phred:
+    :param seed:
+    :param pool:
+    :return:
+    """
+    rng = random.Random(seed)
+    seqs = [''.join(rng.choices('ACGT', k=length)) for _ in range(pool)]
+    quals = [
+        ''.join(
+            chr(phred + max(2, min(41, int(40 - 30 * pos / length +
+                                           rng.gauss(0, 5)))))
+            for pos in range(length)
+        )
+        for _ in range(pool)
+    ]
+    return [(f'read{i}', rng.choice(seqs), rng.choice(quals))
+            for i in range(nreads)]
+
+
+def timeit(f, reads) -> Tuple[float, list]:
+    start = time.perf_counter()
+    result = f(reads)
+    return time.perf_counter() - start, result
+
+
+@click.command('bench_trim')
+@click.option('-n', '--nreads', type=int, default=2000000,
+              help='The number of reads to trim')
+@click.option('-l', '--length', type=int, default=250,
+              help='Read length')
+@click.option('-q', '--minqual', type=int, default=20)
+@click.option('-w', '--window', type=int, default=10)
+@click.option('-c', '--chunksize', type=int, default=trim.CHUNKSIZE,
+              help='Batch size for the batch engine')
+@click.option('-s', '--seed', type=int, default=42)
+def bench_trim(nreads, length, minqual, window, chunksize, seed):
+    """
+    Compare the per-read trimming path (trim.trim) with the batch engine
+    (trim.trim_batch) on simulated reads.
+    """
+    phred = 33
+    print(f'simulating {nreads} reads of length {length}', file=sys.stderr)
+    reads = simulate(nreads, length, phred, seed)
+    # warm up the jit compiler outside the timed region
+    list(trim.trim(phred, minqual, window, 0, 0, reads[:10]))
+    trim.trim_batch(phred, minqual, window, 0, 0, reads[:10])
+
+    per_read = F(trim.trim, phred, minqual, window, 0, 0) >> list
+    batch = (
+        F(chunked, chunksize) >>
+        (map, F(trim.trim_batch, phred, minqual, window, 0, 0)) >>
+        (lambda chunks: [read for chunk in chunks for read in chunk])
+    )
+    per_read_time, per_read_result = timeit(per_read, reads)
+    batch_time, batch_result = timeit(batch, reads)
+    if per_read_result != batch_result:
+        raise RuntimeError('per-read and batch outputs differ')
+    print('engine\tseconds\treads/s')
+    print(f'per-read\t{per_read_time:.3f}\t{nreads/per_read_time:.0f}')
+    print(f'batch\t{batch_time:.3f}\t{nreads/batch_time:.0f}')
+    print(f'speedup\t{per_read_time/batch_time:.2f}x', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    bench_trim()
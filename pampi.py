@@ -8,13 +8,17 @@ from fn import F, _ as X
 from fn.func import identity
 
 from pipeline import core, util
-from pipeline.pampi import data, pick, join, trim
+from pipeline.pampi import data, pick, join, trim, profiling, refpick, \
+    convert, otu
 
 CLUSTERS = 'clusters'
+CLUSTER_TABLE = 'cluster_table'
 TMPDIR = 'tmpdir'
 FASTQ = 'fastq'
 FASTA = 'fasta'
 PAIRED_FASTQ = 'paired_fastq'
+CDHIT = 'cd-hit'
+KMER = 'kmer'
 
 A = TypeVar('A')
 B = TypeVar('B')
@@ -22,6 +26,7 @@ B = TypeVar('B')
 
 _INPUT_DTYPE_DISPATCH = {
     CLUSTERS: (data.SampleClusters, data.MultipleClusters),
+    CLUSTER_TABLE: (data.SampleClusterTable, data.MultipleClusterTables),
     FASTA: (data.SampleFasta, data.MultipleFasta),
     FASTQ: (data.SampleFastq, data.MultipleFastq),
     PAIRED_FASTQ: (data.SamplePairedFastq, data.MultiplePairedFastq)
@@ -65,21 +70,38 @@ _input_paths_exist: Callable[[pd.DataFrame], bool] = (
                          'not all paths specified in the input mapping exist '
                          'or the mapping is empty'))
 @click.option('-d', '--dtype', required=True,
-              type=click.Choice([CLUSTERS, FASTA, FASTQ, PAIRED_FASTQ]),
+              type=click.Choice([CLUSTERS, CLUSTER_TABLE, FASTA, FASTQ,
+                                 PAIRED_FASTQ]),
               help='Initial data type')
 @click.option('-t', '--tempdir', default=tempfile.gettempdir(),
               type=click.Path(exists=False, dir_okay=True, resolve_path=True),
               callback=F(validate, os.path.isdir, identity,
                          'tempdir is not a directory or does not exist'),
               help='Temporary directory location')
+@click.option('--profile', default=None,
+              type=click.Path(exists=False, dir_okay=False, resolve_path=True),
+              callback=F(validate,
+                         lambda x: not x or util.root_exists(x),
+                         identity,
+                         'destination root does not exist'),
+              help='Profile each pipeline stage (wall and CPU time, peak RSS, '
+                   'records and bytes in/out) and write a report to this '
+                   'path: JSON if the path ends with .json, TSV otherwise. '
+                   'Records are counted by re-reading stage inputs and '
+                   'outputs, which is excluded from stage timings.')
+@click.option('--explain', is_flag=True, default=False,
+              help='Print the selected route and its relative cost estimate '
+                   'to stderr before running the pipeline.')
 @click.pass_context
-def pampi(ctx, input: pd.DataFrame, dtype: str, tempdir: str):
+def pampi(ctx, input: pd.DataFrame, dtype: str, tempdir: str,
+          profile: Optional[str], explain: bool):
     ctx.obj[TMPDIR] = tempdir
 
 
 @pampi.resultcallback()
 @click.pass_context
-def pipeline(ctx, routers: List[core.Router], input: pd.DataFrame, dtype, *_, **__):
+def pipeline(ctx, routers: List[core.Router], input: pd.DataFrame, dtype,
+             *_, profile: Optional[str]=None, explain: bool=False, **__):
     if not routers:
         exit()
     # TODO streamline input conversion
@@ -92,7 +114,22 @@ def pipeline(ctx, routers: List[core.Router], input: pd.DataFrame, dtype, *_, **
         ])
     except (TypeError, IndexError):
         raise ValueError(f'input data are not compatible with data type {dtype}')
-    output = core.pcompile(routers, multiple_t, None)(samples)
+    if explain:
+        stages = core.route(routers, multiple_t, None)
+        for router, stage in zip(routers, stages):
+            click.echo(f'{router.name}: {stage!r} ~ {stage.estimate:.2f}',
+                       err=True)
+        click.echo(f'estimate: {sum(stage.estimate for stage in stages):.2f}',
+                   err=True)
+    profiler = profiling.Profiler() if profile else None
+    if profiler:
+        routers = list(map(profiler.instrument, routers))
+    try:
+        output = core.pcompile(routers, multiple_t, None)(samples)
+    finally:
+        # report the stages that have finished even if the pipeline fails
+        if profiler:
+            profiler.report(profile)
 
 
 # TODO add validators
@@ -110,6 +147,10 @@ def pipeline(ctx, routers: List[core.Router], input: pd.DataFrame, dtype, *_, **
 @click.option('-c', '--crop', type=int, default=0)
 @click.option('--compress', is_flag=True, default=False,
               help='Compress the output')
+@click.option('-j', '--jobs', type=int, default=1,
+              callback=F(validate, X > 0, identity, 'must be positive'),
+              help='The number of worker processes; samples and chunks of '
+                   'large samples are trimmed in parallel.')
 @click.option('-o', '--outdir',
               type=click.Path(exists=False, resolve_path=True),
               callback=F(validate,
@@ -120,14 +161,15 @@ def pipeline(ctx, routers: List[core.Router], input: pd.DataFrame, dtype, *_, **
 # @click.option('-f', '--force', is_flag=True, default=True,
 #               help='Proceed even if outdir exists')
 def trimmer(ctx, phred: int, minqual: int, window: int, minlen: int, crop: int,
-            compress: bool, outdir: Optional[str]):
+            compress: bool, jobs: int, outdir: Optional[str]):
     if outdir is not None:
         os.makedirs(outdir)
 
     options = (ctx.obj[TMPDIR], phred, minqual, window, minlen, crop, compress, outdir)
     return core.Router('trimmer', [
         core.Map(data.MultiplePairedFastq, data.MultiplePairedFastq,
-                 lambda samples: trim.trimmer(*options, samples=samples))
+                 lambda samples: trim.trimmer(*options, samples=samples,
+                                              jobs=jobs))
     ])
 
 
@@ -138,16 +180,20 @@ def sample_filter(nseq: int):
 
     # TODO this might not be safe with inherently single-use resources
     def size_filt(samples):
-        # any parsable data type will do
+        # any countable data type will do
         for sample in samples:
-            if sum(map(bool, sample.parse())) >= nseq:
+            if sample.count() >= nseq:
                 yield sample
             else:
                 sample.release()
 
     return core.Router('filter', [
         core.Map(data.MultiplePairedFastq, data.MultiplePairedFastq,
-                 lambda x: data.MultiplePairedFastq(list(size_filt(x.samples))))
+                 lambda x: data.MultiplePairedFastq(list(size_filt(x.samples)))),
+        core.Map(data.MultipleFastq, data.MultipleFastq,
+                 lambda x: data.MultipleFastq(list(size_filt(x.samples)))),
+        core.Map(data.MultipleFasta, data.MultipleFasta,
+                 lambda x: data.MultipleFasta(list(size_filt(x.samples))))
     ])
 
 
@@ -172,28 +218,95 @@ def sample_filter(nseq: int):
                    'fastq output. Pattern example: /path/to/output-%.fastq - '
                    'here % will be replaced by R1 and R2 for forward and '
                    'reverse reads respectively')
-def joiner(ctx, pattern, group, compress, output):
+@click.option('-j', '--jobs', type=int, default=1,
+              callback=F(validate, X > 0, identity, 'must be positive'),
+              help='The number of worker processes. With several jobs samples '
+                   '(or groups of clusters) are renamed and compressed into '
+                   'separate shards in parallel and then concatenated.')
+def joiner(ctx, pattern, group, compress, output, jobs):
     rename = join.make_extractor(pattern, group) if pattern else identity
     output = output.replace('%', '{}') if output else None
     options = (ctx.obj[TMPDIR], rename, compress, output)
+    join_ = lambda samples: join.join(*options, samples, jobs=jobs)
+    # parallel joins write temporary shards
+    cost = core.Cost(1.0, False, jobs > 1)
     # chose maps based on `output` type (if output is provided)
     # TODO document this behaviour
     maps = [
-        core.Map(data.MultipleFasta, data.SampleFasta,
-                 lambda samples: join.join(*options, samples)),
-        core.Map(data.MultipleFastq, data.SampleFastq,
-                 lambda samples: join.join(*options, samples)),
-        core.Map(data.MultipleClusters, data.SampleClusters,
-                 lambda samples: join.join(*options, samples))
+        core.Map(data.MultipleFasta, data.SampleFasta, join_, cost),
+        core.Map(data.MultipleFastq, data.SampleFastq, join_, cost),
+        core.Map(data.MultipleClusters, data.SampleClusters, join_, cost),
+        core.Map(data.MultipleClusterTables, data.SampleClusters, join_, cost)
     ]
     if output is None or '{}' in output:
         return core.Router('joiner', maps+[
-            core.Map(data.MultiplePairedFastq, data.SamplePairedFastq,
-                     lambda samples: join.join(*options, samples)),
+            core.Map(data.MultiplePairedFastq, data.SamplePairedFastq, join_,
+                     cost),
         ])
     return core.Router('joiner', maps)
 
 
+@pampi.command('CONVERT')
+@click.pass_context
+@click.option('-f', '--format', 'format_', required=True,
+              type=click.Choice([CLUSTERS, CLUSTER_TABLE]),
+              help='Target cluster format: tab-separated clusters or a '
+                   'columnar cluster table (NumPy .npz), that lets JOIN and '
+                   'reports read cluster sizes without member names.')
+@click.option('-o', '--outdir',
+              type=click.Path(exists=False, resolve_path=True),
+              callback=F(validate,
+                         lambda x: not (x and os.path.exists(x)),
+                         identity,
+                         'output destination exists'),
+              help='Output destination.')
+def converter(ctx, format_: str, outdir: Optional[str]):
+    if outdir is not None:
+        os.makedirs(outdir)
+
+    options = (ctx.obj[TMPDIR], outdir)
+    if format_ == CLUSTER_TABLE:
+        # cluster tables are built in memory
+        cost = core.Cost(1.0, True, False)
+        return core.Router('converter', [
+            core.Map(data.SampleClusters, data.SampleClusterTable,
+                     lambda x: convert.to_table(*options, x), cost),
+            core.Map(data.MultipleClusters, data.MultipleClusterTables,
+                     lambda x: convert.to_tables(*options, x), cost)
+        ])
+    return core.Router('converter', [
+        core.Map(data.SampleClusterTable, data.SampleClusters,
+                 lambda x: convert.to_tsv(*options, x)),
+        core.Map(data.MultipleClusterTables, data.MultipleClusters,
+                 lambda x: convert.to_tsvs(*options, x))
+    ])
+
+
+@pampi.command('TABLE')
+@click.option('-f', '--format', 'format_', type=click.Choice([otu.TSV, otu.BIOM]),
+              default=otu.TSV,
+              help='Output format: a dense tab-separated table or a sparse '
+                   'BIOM 2.1 (HDF5) table; the latter requires h5py.')
+@click.option('-o', '--output', required=True,
+              type=click.Path(exists=False, dir_okay=False, resolve_path=True),
+              callback=F(validate,
+                         lambda x: util.root_exists(x) and not os.path.exists(x),
+                         identity,
+                         'destination root does not exist or output exists'),
+              help='Output destination.')
+def tabulator(format_: str, output: str):
+    """
+    Build a cluster (OTU) by sample abundance table from cluster sizes
+    """
+    tabulate = F(otu.abundance) >> F(otu.write, format_, output)
+    # the abundance table is built in memory
+    cost = core.Cost(1.0, True, False)
+    return core.Router('tabulator', [
+        core.Map(data.MultipleClusters, None, tabulate, cost),
+        core.Map(data.MultipleClusterTables, None, tabulate, cost)
+    ])
+
+
 @pampi.command('PICK')
 @click.option('-r', '--reference', required=True,
               type=click.Path(exists=True, dir_okay=False, resolve_path=True),
@@ -211,14 +324,51 @@ def joiner(ctx, pattern, group, compress, output):
                    'within [0.5, 1].')
 @click.option('-t', '--threads', type=int, default=1,
               callback=F(validate, X > 0, identity, 'must be positive'),
-              help='The number of CPU threads to use.')
+              help='The number of CPU threads to use. With several jobs '
+                   'the threads are split among them.')
 @click.option('-m', '--memory', type=int, default=1000,
-              callback=F(validate, X >= 100, identity,
-                         'should be at least 100MB'),
+              callback=F(validate, X >= pick.MINMEMORY, identity,
+                         f'should be at least {pick.MINMEMORY}MB'),
               help='Maximum amount of RAM available to CD-HIT (must be at '
-                   'least 100MB).')
+                   f'least {pick.MINMEMORY}MB). With several jobs the limit '
+                   'is split among them.')
+@click.option('-j', '--jobs', type=int, default=1,
+              callback=F(validate, X > 0, identity, 'must be positive'),
+              help='The maximum number of samples picked concurrently. The '
+                   'number is reduced to give each job at least one thread '
+                   f'and {pick.MINMEMORY}MB of RAM.')
 @click.option('-e', '--drop_empty', is_flag=True, default=False,
               help='delete empty output')
+@click.option('-E', '--engine', type=click.Choice([CDHIT, KMER]),
+              default=CDHIT,
+              help='Picking engine: an external CD-HIT (cd-hit-est-2d) or a '
+                   'built-in k-mer index with banded alignments, that runs '
+                   'in-process and shares a single reference index between '
+                   'samples. The built-in engine writes the same output; it '
+                   'ignores --memory, --jobs and --pooled.')
+@click.option('--cache', default=None,
+              type=click.Path(file_okay=False, resolve_path=True),
+              help='A directory caching reference indices of the built-in '
+                   'engine: an index is built once per reference content and '
+                   'word size and memory-mapped by later runs.')
+@click.option('--cache-size', type=float, default=10,
+              callback=F(validate, X > 0, identity, 'must be positive'),
+              help='The maximum total size of the index cache (GB); least '
+                   'recently used indices are evicted first.')
+@click.option('--cache-age', type=float, default=30,
+              callback=F(validate, X > 0, identity, 'must be positive'),
+              help='Evict cached indices unused for this many days.')
+@click.option('-p', '--pooled', is_flag=True, default=False,
+              help='Pick multiple samples in a single CD-HIT run: reads are '
+                   'tagged with their sample and pooled, hence the reference '
+                   'is indexed only once. The run gets all threads and '
+                   'memory, --jobs is ignored.')
+@click.option('-f', '--format', 'format_',
+              type=click.Choice([CLUSTERS, CLUSTER_TABLE]), default=CLUSTERS,
+              help='Output format: tab-separated clusters or a columnar '
+                   'cluster table (see CONVERT) written straight from CD-HIT '
+                   'output. Cluster tables require the CD-HIT engine without '
+                   '--pooled.')
 @click.option('-o', '--outdir',
               type=click.Path(exists=False, resolve_path=True),
               callback=F(validate,
@@ -228,28 +378,52 @@ def joiner(ctx, pattern, group, compress, output):
               help='Output destination.')
 @click.pass_context
 def picker(ctx, reference: str, accurate: bool, similarity: float, threads: int,
-           memory: int, drop_empty: bool, outdir: str):
+           memory: int, jobs: int, drop_empty: bool, engine: str,
+           cache: Optional[str], cache_size: float, cache_age: float,
+           pooled: bool, format_: str, outdir: str):
+    table = format_ == CLUSTER_TABLE
+    if table and (engine == KMER or pooled):
+        raise click.UsageError(
+            'cluster tables require the CD-HIT engine without --pooled'
+        )
     if outdir is not None:
         os.makedirs(outdir)
 
     options = dict(tmpdir=ctx.obj[TMPDIR], outdir=outdir, drop_empty=drop_empty,
                    reference=reference, accurate=accurate,
                    similarity=similarity, threads=threads, memory=memory)
+    if engine == KMER:
+        index_cache = cache and refpick.IndexCache(
+            cache, int(cache_size * 2**30), int(cache_age * 24 * 3600)
+        )
+        pick_single = F(refpick.refpick, cache=index_cache, **options)
+        pick_multiple = F(refpick.refpick_multiple, cache=index_cache,
+                          **options)
+    else:
+        pick_single = F(pick.cdpick, table=table, **options)
+        pick_multiple = (
+            F(pick.cdpick_pooled, **options) if pooled else
+            F(pick.cdpick_multiple, jobs=jobs, table=table, **options)
+        )
+    # cd-hit reads decompressed copies of the input and writes its output
+    # into temporary files; cluster tables are built in memory
+    cost = None if engine == KMER else core.Cost(1.0, table, True)
+    single, multiple = _INPUT_DTYPE_DISPATCH[format_]
     # TODO we might want to specify a pattern output or several possible types
     # of output and decide which Maps to return (similarly to JOIN).
     return core.Router('picker', [
-        core.Map(data.SampleFasta, data.SampleClusters,
-                 lambda x: pick.cdpick(sample=x, **options)),
-        core.Map(data.MultipleFasta, data.MultipleClusters,
-                 lambda x: pick.cdpick_multiple(samples=x, **options)),
-        core.Map(data.SampleFastq, data.SampleClusters,
-                 lambda x: pick.cdpick(sample=x, **options)),
-        core.Map(data.MultipleFastq, data.MultipleClusters,
-                 lambda x: pick.cdpick_multiple(samples=x, **options)),
-        core.Map(data.SamplePairedFastq, data.SampleClusters,
-                 lambda x: pick.cdpick(sample=x, **options)),
-        core.Map(data.MultiplePairedFastq, data.MultipleClusters,
-                 lambda x: pick.cdpick_multiple(samples=x, **options))
+        core.Map(data.SampleFasta, single,
+                 lambda x: pick_single(sample=x), cost),
+        core.Map(data.MultipleFasta, multiple,
+                 lambda x: pick_multiple(samples=x), cost),
+        core.Map(data.SampleFastq, single,
+                 lambda x: pick_single(sample=x), cost),
+        core.Map(data.MultipleFastq, multiple,
+                 lambda x: pick_multiple(samples=x), cost),
+        core.Map(data.SamplePairedFastq, single,
+                 lambda x: pick_single(sample=x), cost),
+        core.Map(data.MultiplePairedFastq, multiple,
+                 lambda x: pick_multiple(samples=x), cost)
 
     ])
 
@@ -0,0 +1,295 @@
+import io
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Tuple, Optional, Iterator, Deque
+
+MAGIC = b'\x1f\x8b\x08\x04'
+# the largest uncompressed block guaranteeing that even incompressible data
+# fit into a block of at most 64KB
+BLOCKSIZE = 65280
+# the number of blocks in a unit of parallel work
+GROUPSIZE = 64
+LEVEL = 6
+THREADS = min(4, os.cpu_count() or 1)
+EOF = bytes.fromhex(
+    '1f8b08040000000000ff0600424302001b0003000000000000000000'
+)
+_HEADER = struct.Struct('<4BI2BH')
+_SUBFIELD = struct.Struct('<2BH')
+_FOOTER = struct.Struct('<2I')
+
+
+def isbgzf(path: str) -> bool:
+    with open(path, 'rb') as buffer:
+        header = buffer.read(_HEADER.size)
+        if len(header) < _HEADER.size or not header.startswith(MAGIC):
+            return False
+        return _bsize(buffer.read(_HEADER.unpack(header)[-1])) is not None
+
+
+def _bsize(extra: bytes) -> Optional[int]:
+    """
+    Find the total block size in the extra field of a gzip member
+    :param extra: gzip member extra field
+    :return: None if there is no BGZF subfield
+    """
+    offset = 0
+    while offset + _SUBFIELD.size <= len(extra):
+        si1, si2, length = _SUBFIELD.unpack_from(extra, offset)
+        offset += _SUBFIELD.size
+        if (si1, si2, length) == (66, 67, 2):
+            return struct.unpack_from('<H', extra, offset)[0] + 1
+        offset += length
+    return None
+
+
+def compress_block(data: bytes, level: int=LEVEL) -> bytes:
+    """
+    Compress data (at most BLOCKSIZE bytes) into a single BGZF block
+    :param data:
+    :param level: compression level
+    :return:
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    bsize = _HEADER.size + _SUBFIELD.size + 2 + len(deflated) + _FOOTER.size
+    return b''.join([
+        _HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6),
+        _SUBFIELD.pack(66, 67, 2), struct.pack('<H', bsize - 1),
+        deflated,
+        _FOOTER.pack(zlib.crc32(data), len(data))
+    ])
+
+
+def compress_blocks(data: bytes, level: int=LEVEL) -> bytes:
+    return b''.join(
+        compress_block(data[start:start+BLOCKSIZE], level)
+        for start in range(0, len(data), BLOCKSIZE)
+    )
+
+
+def decompress_blocks(data: bytes) -> bytes:
+    """
+    Decompress a series of complete BGZF blocks
+    :param data:
+    :return:
+    """
+    chunks = []
+    offset = 0
+    while offset < len(data):
+        header = data[offset:offset+_HEADER.size]
+        xlen = _HEADER.unpack(header)[-1]
+        start = offset + _HEADER.size + xlen
+        bsize = _bsize(data[offset+_HEADER.size:start])
+        if bsize is None:
+            raise ValueError(f'not a BGZF block at offset {offset}')
+        end = offset + bsize - _FOOTER.size
+        crc, size = _FOOTER.unpack_from(data, end)
+        inflated = zlib.decompress(data[start:end], -zlib.MAX_WBITS)
+        if len(inflated) != size or zlib.crc32(inflated) != crc:
+            raise ValueError(f'corrupted BGZF block at offset {offset}')
+        chunks.append(inflated)
+        offset += bsize
+    return b''.join(chunks)
+
+
+def blocks(path: str, start: int=0, end: Optional[int]=None) \
+        -> Iterator[Tuple[int, int]]:
+    """
+    Iterate over (offset, size) of BGZF blocks starting within [start, end)
+    :param path:
+    :param start: must be a block boundary
+    :param end:
+    :return:
+    """
+    with open(path, 'rb') as buffer:
+        offset = buffer.seek(start)
+        while end is None or offset < end:
+            header = buffer.read(_HEADER.size)
+            if not header:
+                break
+            if len(header) < _HEADER.size or not header.startswith(MAGIC):
+                raise ValueError(f'not a BGZF block at offset {offset}')
+            bsize = _bsize(buffer.read(_HEADER.unpack(header)[-1]))
+            if bsize is None:
+                raise ValueError(f'not a BGZF block at offset {offset}')
+            yield offset, bsize
+            offset = buffer.seek(offset + bsize)
+
+
+def ranges(path: str, n: int) -> List[Tuple[int, int]]:
+    """
+    Split a BGZF file into at most n contiguous [start, end) byte ranges of
+    roughly equal compressed size aligned with block boundaries. Each range
+    can be read independently via BgzfReader.
+    :param path:
+    :param n:
+    :return:
+    """
+    if n < 1:
+        raise ValueError('the number of ranges must be positive')
+    total = os.path.getsize(path)
+    boundaries = [0]
+    for offset, _ in blocks(path):
+        if offset >= total * len(boundaries) / n:
+            boundaries.append(offset)
+    boundaries.append(total)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:])
+            if start < end]
+
+
+class BgzfWriter(io.BufferedIOBase):
+    """
+    A binary BGZF writer compressing groups of blocks on a thread pool
+    """
+
+    def __init__(self, path: str, threads: int=THREADS, level: int=LEVEL):
+        super().__init__()
+        if threads < 1:
+            raise ValueError('the number of threads must be positive')
+        self._handle = open(path, 'wb')
+        self._pool = ThreadPoolExecutor(threads)
+        self._pending: Deque[Future] = deque()
+        self._prefetch = 2 * threads
+        self._level = level
+        self._buffer = bytearray()
+        self._groupsize = BLOCKSIZE * GROUPSIZE
+
+    def writable(self) -> bool:
+        return True
+
+    def _submit(self, data: bytes):
+        self._pending.append(
+            self._pool.submit(compress_blocks, data, self._level)
+        )
+        while len(self._pending) > self._prefetch:
+            self._handle.write(self._pending.popleft().result())
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError('write to closed file')
+        self._buffer += data
+        while len(self._buffer) >= self._groupsize:
+            self._submit(bytes(self._buffer[:self._groupsize]))
+            del self._buffer[:self._groupsize]
+        return len(data)
+
+    def flush(self):
+        if self.closed or self._handle.closed:
+            return
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        while self._pending:
+            self._handle.write(self._pending.popleft().result())
+        self._handle.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+            self._handle.write(EOF)
+        finally:
+            self._pool.shutdown()
+            self._handle.close()
+            super().close()
+
+
+class BgzfReader(io.RawIOBase):
+    """
+    A binary BGZF reader decompressing groups of blocks ahead of time on a
+    thread pool. It can be restricted to a block-aligned range of the
+    compressed file.
+    """
+
+    def __init__(self, path: str, start: int=0, end: Optional[int]=None,
+                 threads: int=THREADS):
+        super().__init__()
+        if threads < 1:
+            raise ValueError('the number of threads must be positive')
+        self._handle = open(path, 'rb')
+        self._groups = self._read_groups(path, start, end)
+        self._pool = ThreadPoolExecutor(threads)
+        self._pending: Deque[Future] = deque()
+        self._prefetch = 2 * threads
+        self._chunk = memoryview(b'')
+
+    def _read_groups(self, path: str, start: int, end: Optional[int]) \
+            -> Iterator[bytes]:
+        group = []
+        for offset, size in blocks(path, start, end):
+            group.append((offset, size))
+            if len(group) == GROUPSIZE:
+                yield self._read(group)
+                group = []
+        if group:
+            yield self._read(group)
+
+    def _read(self, group: List[Tuple[int, int]]) -> bytes:
+        offset, _ = group[0]
+        self._handle.seek(offset)
+        return self._handle.read(sum(size for _, size in group))
+
+    def readable(self) -> bool:
+        return True
+
+    def _next_chunk(self) -> bool:
+        for group in self._groups:
+            self._pending.append(self._pool.submit(decompress_blocks, group))
+            if len(self._pending) >= self._prefetch:
+                break
+        if not self._pending:
+            return False
+        self._chunk = memoryview(self._pending.popleft().result())
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._chunk:
+            if not self._next_chunk():
+                return 0
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+    def close(self):
+        if self.closed:
+            return
+        for future in self._pending:
+            future.cancel()
+        self._pool.shutdown()
+        self._handle.close()
+        super().close()
+
+
+def bgzfopen(path: str, mode: str='rt', threads: int=THREADS,
+             start: int=0, end: Optional[int]=None) -> io.IOBase:
+    """
+    Open a BGZF file in binary ('rb', 'wb') or text ('r', 'rt', 'w', 'wt')
+    mode. BGZF is a series of independent gzip members holding at most 64KB of
+    uncompressed data each, with the compressed size of every member stored in
+    a 'BC' extra subfield. BGZF files are valid gzip files, but unlike regular
+    gzip streams they can be (de)compressed in parallel and read from any
+    block boundary.
+    :param path:
+    :param mode:
+    :param threads: the number of compression/decompression threads
+    :param start: reading only: a block-aligned offset to start at
+    :param end: reading only: an offset to stop at
+    :return:
+    """
+    if mode in ('r', 'rb', 'rt'):
+        handle = io.BufferedReader(BgzfReader(path, start, end, threads))
+    elif mode in ('w', 'wb', 'wt'):
+        handle = BgzfWriter(path, threads)
+    else:
+        raise ValueError(f'unsupported mode: {mode}')
+    return handle if 'b' in mode else io.TextIOWrapper(handle)
+
+
+if __name__ == '__main__':
+    raise RuntimeError
@@ -1,9 +1,11 @@
 import inspect
+import math
 import operator as op
-from functools import reduce
-from itertools import combinations, starmap, product, chain
+from collections import defaultdict
+from functools import reduce, lru_cache
+from itertools import chain
 from typing import Callable, TypeVar, Generic, Type, List, Tuple, Optional, \
-    Iterable, Sequence, Union
+    Iterable, Sequence, Union, NamedTuple
 
 from fn import F
 
@@ -13,6 +15,9 @@ A = TypeVar('A')
 B = TypeVar('B')
 C = TypeVar('C')
 
+# the number of compiled routes memoised by pcompile
+CACHESIZE = 256
+
 POS_ARGS = frozenset(
     [inspect.Parameter.POSITIONAL_ONLY,
      inspect.Parameter.POSITIONAL_OR_KEYWORD,
@@ -21,24 +26,64 @@ POS_ARGS = frozenset(
 
 _starapply: Callable[[Callable[..., A], Iterable], A] = lambda f, x: f(*x)
 
+# optional cost metadata of maps used to choose between valid routes
+Cost = NamedTuple('Cost', [
+    # relative throughput (e.g. records per second); maps without metadata
+    # have a unit throughput
+    ('throughput', float),
+    # the map holds its entire input in memory
+    ('materialises', bool),
+    # the map needs temporary disk space besides its output
+    ('tempdisk', bool)
+])
+# relative slowdowns accounted for materialisation and temporary disk usage
+MATERIALISE_PENALTY = 1.0
+TEMPDISK_PENALTY = 0.5
+
+
+def estimate(cost: Optional[Cost]) -> float:
+    """
+    Reduce cost metadata to a single relative estimate: time per unit of work
+    (an inverse throughput) scaled up by resource penalties
+    :param cost: None is regarded as a unit cost
+    :return:
+    >>> estimate(None)
+    1.0
+    >>> estimate(Cost(throughput=2.0, materialises=True, tempdisk=True))
+    1.25
+    """
+    if cost is None:
+        return 1.0
+    penalty = (1 + MATERIALISE_PENALTY * cost.materialises +
+               TEMPDISK_PENALTY * cost.tempdisk)
+    return penalty / cost.throughput
+
+
 # TODO research a way to relax the algebraic type system within Python
 # TODO https://github.com/HypothesisWorks/hypothesis/pull/643 (as an example)
 # abstract away type compatibility check to not depend on its implementation
 _typematch: Union[Callable[[Type, Type], bool]] = op.is_
 
-# signature matches
-_signmatch: Callable[[Tuple[Type, Tuple], Tuple[Type, Tuple]], bool] = (
-    F(_starapply, zip) >> (starmap, _typematch) >> all
-)
 # left-side codomain matches right-side domain
 _composable: Callable[['Map', 'Map'], bool] = (
     lambda l, r: _typematch(l.codomain, r.domain)
 )
-# are there any maps with identical domain-codomain pairs?
-_redundant: Callable[[Iterable['Map']], bool] = (
-        F(map, lambda m: m.signature) >> F(combinations, r=2) >>
-        (map, _signmatch) >> any
-)
+
+
+def _redundant(maps: Iterable['Map']) -> bool:
+    """
+    Are there any maps with identical domain-codomain pairs? Signatures are
+    hashed instead of being compared pairwise, which relies on `_typematch`
+    being an identity check (types hash by identity).
+    :param maps:
+    :return:
+    """
+    signatures = set()
+    for m in maps:
+        if m.signature in signatures:
+            return True
+        signatures.add(m.signature)
+    return False
 
 
 class RedundancyError(ValueError):
@@ -48,7 +93,7 @@ class RedundancyError(ValueError):
 class AmbiguousError(ValueError):
     def __init__(self, input: str, output: str) -> None:
         super().__init__(f'there are several valid routes '
-                         'from {input} to {output}')
+                         f'from {input} to {output}')
 
 
 class NoRouteError(ValueError):
@@ -58,12 +103,20 @@ class NoRouteError(ValueError):
 
 class Map(Generic[A, B]):
 
-    def __init__(self, domain: Type[A], codomain: Type[B], f: Callable[[A], B]):
+    def __init__(self, domain: Type[A], codomain: Type[B], f: Callable[[A], B],
+                 cost: Optional[Cost]=None):
         """
         :param domain: `None` is treated as NoneType
         :param codomain: `None` is treated as NoneType
         :param f:
+        :param cost: optional cost metadata used to choose between routes
         """
+        if not (cost is None or isinstance(cost, Cost)):
+            raise ValueError(f'cost is not a {Cost.__name__} instance')
+        if cost is not None and not cost.throughput > 0:
+            raise ValueError('throughput must be positive')
+        # costs of composed maps are kept separately
+        self._costs: Tuple[Optional[Cost], ...] = (cost,)
         # validate domain and codomain
         self._domain = type(None) if domain is None else domain
         self._codomain = type(None) if codomain is None else codomain
@@ -102,6 +155,22 @@ class Map(Generic[A, B]):
     def signature(self) -> Tuple[Type[A], Type[B]]:
         return self.domain, self.codomain
 
+    @property
+    def cost(self) -> Optional[Cost]:
+        """
+        Cost metadata; compositions have none, because their parts' penalties
+        do not reduce to a single Cost (use `estimate` instead)
+        """
+        return self._costs[0] if len(self._costs) == 1 else None
+
+    @property
+    def estimate(self) -> float:
+        """
+        A relative cost estimate (see `estimate`); estimates of composed maps
+        add up
+        """
+        return sum(map(estimate, self._costs))
+
     def __repr__(self):
         # TODO maybe we should show show type reprs instead of their names?
         try:
@@ -124,7 +193,9 @@ class Map(Generic[A, B]):
                 f'domain of right-hand operand {other} does not match codomain '
                 f'of {self}'
             )
-        return type(self)(self.domain, other.codomain, self._f >> other._f)
+        composed = type(self)(self.domain, other.codomain, self._f >> other._f)
+        composed._costs = self._costs + other._costs
+        return composed
 
 
 class Router:
@@ -183,10 +254,14 @@ class Router:
             return Router(name, [])
         left = self.constrain(None, other.domains)
         right = other.constrain(left.codomains, None)
-        compositions = (
-            F(product) >> (filter, F(_starapply, _composable)) >>
-            (starmap, op.rshift) >> list
-        )(left.maps, right.maps)
+        # index right-hand maps by domain to avoid matching all pairs
+        # (see the note on hashing in `_redundant`)
+        by_domain = defaultdict(list)
+        for m in right.maps:
+            by_domain[m.domain].append(m)
+        compositions = [
+            l >> r for l in left.maps for r in by_domain.get(l.codomain, [])
+        ]
         return type(self)(name, compositions)
 
     def constrain(self,
@@ -216,7 +291,11 @@ class Router:
 def pcompile(routers: List[Router], input: Optional[Type[A]], output: Optional[Type[B]]) \
         -> Callable[[A], B]:
     """
-    Compile a path from input node to the output node
+    Compile a path from input node to the output node. Routes are memoised
+    (see CACHESIZE) by the shape of routers, i.e. their maps' signatures and
+    cost estimates, and the input/output types: routers rebuilt with the same
+    shape (e.g. wrapped by a profiler) skip planning and the cache holds no
+    references to maps or routers.
     :param routers:
     :param input:
     :param output:
@@ -225,27 +304,122 @@ def pcompile(routers: List[Router], input: Optional[Type[A]], output: Optional[T
     # TODO maybe we should create and use something like CompileTimeError?
     if not all(isinstance(router, Router) for router in routers):
         raise ValueError(f'not all routers are instances of {Router.__name__}')
-    input_constraints = None if input is None else [input]
-    output_constraints = None if output is None else [output]
-    if len(routers) == 1:
-        constrained = routers[0].constrain(input_constraints, output_constraints)
-    else:
-        head, *tail = routers
-        try:
-            composed: Router = reduce(op.rshift, tail, head.constrain(input_constraints, None))
-        except RedundancyError:
-            raise ValueError(
-                f'there are several valid routes from {input} to {output}'
-            )
-        constrained = composed.constrain(None, output_constraints)
-    if not constrained:
-        raise ValueError(
-            f'there is no route' +
-            ('' if input is None else f' from {input}') +
-            ('' if output is None else f' to {output}')
-        )
-        
-    return constrained.maps[0]
+    shape = tuple(
+        _Layer(tuple(_Edge(m.domain, m.codomain, m.estimate)
+                     for m in router.maps))
+        for router in routers
+    )
+    order = _pcompile(shape, input, output)
+    return reduce(op.rshift, map(op.getitem, (r.maps for r in routers), order))
+
+
+# planning stand-ins for routers and maps holding just what `route` needs
+_Edge = NamedTuple('_Edge', [
+    ('domain', Type),
+    ('codomain', Type),
+    ('estimate', float)
+])
+_Layer = NamedTuple('_Layer', [
+    ('maps', Tuple[_Edge, ...])
+])
+
+
+@lru_cache(maxsize=CACHESIZE)
+def _pcompile(shape: Tuple[_Layer, ...], input: Optional[Type[A]],
+              output: Optional[Type[B]]) -> Tuple[int, ...]:
+    """
+    :return: indices of the cheapest route's maps within their routers
+    """
+    return _cheapest(shape, input, output, op.attrgetter('estimate')).order
+
+
+# a (partial) route in the planner's graph
+_Route = NamedTuple('_Route', [
+    ('cost', float),
+    # indices of maps within their routers: ties are broken by map order
+    ('order', Tuple[int, ...]),
+    ('maps', Tuple[Map, ...])
+])
+
+
+def plan(routers: Sequence[Router], input: Optional[Type[A]],
+         output: Optional[Type[B]],
+         cost: Callable[[Map], float]=op.attrgetter('estimate')) -> Map:
+    """
+    Compose maps along the cheapest route through routers (see `route`)
+    :param routers:
+    :param input:
+    :param output:
+    :param cost:
+    :return:
+    """
+    return reduce(op.rshift, route(routers, input, output, cost))
+
+
+def route(routers: Sequence[Router], input: Optional[Type[A]],
+          output: Optional[Type[B]],
+          cost: Callable[[Map], float]=op.attrgetter('estimate')) -> List[Map]:
+    """
+    Find the cheapest route through routers. Types are nodes of a layered
+    graph, a layer per router boundary, and maps are weighted edges between
+    consecutive layers. Routes are found by dynamic programming over the
+    layers, hence planning is linear in the number of edges (times the
+    number of input types, if the input is not constrained).
+    :param routers:
+    :param input: None is regarded as no constraint
+    :param output: None is regarded as no constraint
+    :param cost: edge cost; map estimates are used by default, hence all
+    routes through routers without cost metadata are equally expensive
+    :return: a map per router
+    :raises AmbiguousError: if any type reachable from the input is reached
+    by several cheapest routes
+    :raises NoRouteError: if the output is not reachable from the input
+    """
+    return list(_cheapest(routers, input, output, cost).maps)
+
+
+def _cheapest(routers: Sequence[Router], input: Optional[Type[A]],
+              output: Optional[Type[B]],
+              cost: Callable[[Map], float]) -> _Route:
+    if not routers:
+        raise ValueError('no routers to compile')
+    # nodes are (input type, current type) pairs mapped to the cheapest path
+    routes = {
+        (m.domain, m.domain): _Route(0, (), ())
+        for m in routers[0].maps
+        if input is None or _typematch(m.domain, input)
+    }
+    for router in routers:
+        edges = defaultdict(list)
+        for index, m in enumerate(router.maps):
+            edges[m.domain].append((index, m))
+        extended = {}
+        # nodes whose cheapest cost is (so far) shared by several paths
+        tied = set()
+        for (start, node), path in routes.items():
+            for index, m in edges.get(node, []):
+                key = (start, m.codomain)
+                candidate = _Route(path.cost + cost(m), path.order + (index,),
+                                   path.maps + (m,))
+                best = extended.setdefault(key, candidate)
+                if best is candidate:
+                    continue
+                if math.isclose(candidate.cost, best.cost):
+                    tied.add(key)
+                elif candidate.cost < best.cost:
+                    extended[key] = candidate
+                    tied.discard(key)
+        # only ties at the final cheapest cost are ambiguous
+        if tied:
+            raise AmbiguousError(*min(tied, key=str))
+        routes = extended
+    candidates = [
+        path for (_, node), path in routes.items()
+        if output is None or _typematch(node, output)
+    ]
+    if not candidates:
+        raise NoRouteError(input, output)
+    return min(candidates, key=lambda path: (path.cost, path.order))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,239 @@
+import io
+import mmap
+from contextlib import AbstractContextManager
+from typing import Iterator, Tuple, List
+
+import numba as nb
+import numpy as np
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
+
+from pipeline import util
+
+# the number of bytes indexed at once
+CHUNKSIZE = 2**23
+# offsets columns: [start, end) of names, sequences and quality strings
+NAME_START, NAME_END, SEQ_START, SEQ_END, QUAL_START, QUAL_END = range(6)
+
+_AT = ord('@')
+_PLUS = ord('+')
+_NEWLINE = ord('\n')
+# bytes that are either not ASCII or a carriage return, which universal
+# newlines treat as a line break
+_NONASCII = 128
+_CR = ord('\r')
+
+
+@nb.jit(nopython=True)
+def _rstrip(buffer: np.ndarray, start: int, end: int) -> int:
+    # ASCII characters stripped by str.rstrip
+    while end > start and (buffer[end-1] == 32 or 9 <= buffer[end-1] <= 13 or
+                           28 <= buffer[end-1] <= 31):
+        end -= 1
+    return end
+
+
+@nb.jit(nopython=True)
+def index(buffer: np.ndarray, newlines: np.ndarray, start: int, eof: bool) \
+        -> Tuple[np.ndarray, int]:
+    """
+    Index strictly formatted 4-line FASTQ records starting at `start`.
+    Indexing stops at the first record that does not comply (e.g. a
+    multi-line record); such records must be handled by a general parser.
+    Bytes within lines are not validated.
+    :param buffer: raw file contents
+    :param newlines: sorted positions of all newline characters in a window
+    of the buffer starting at `start`
+    :param start: a record boundary to start indexing at
+    :param eof: the window spans to the end of the buffer
+    :return: an (nrecords, 6) array of absolute offsets (see the column
+    constants) and the position of the first record that hasn't been indexed
+    """
+    size = len(buffer)
+    offsets = np.empty((len(newlines) // 4 + 1, 6), dtype=np.int64)
+    nrecords = 0
+    line = 0
+    position = start
+    while position < size and buffer[position] == _AT:
+        if line + 3 > len(newlines):
+            break
+        name_line_end = newlines[line]
+        seq_line_end = newlines[line+1]
+        plus_line_end = newlines[line+2]
+        # the last quality line might lack a trailing newline
+        if line + 3 < len(newlines):
+            qual_line_end = newlines[line+3]
+        elif eof and plus_line_end + 1 < size:
+            qual_line_end = size
+        else:
+            break
+        plus_start = seq_line_end + 1
+        qual_start = plus_line_end + 1
+        cursor = qual_line_end + 1
+        if buffer[plus_start] != _PLUS:
+            break
+        # the record must be followed by another record or EOF
+        if cursor < size and buffer[cursor] != _AT:
+            break
+        name_start = position + 1
+        name_end = _rstrip(buffer, name_start, name_line_end)
+        seq_start = name_line_end + 1
+        seq_end = _rstrip(buffer, seq_start, seq_line_end)
+        qual_end = _rstrip(buffer, qual_start, qual_line_end)
+        plus_end = _rstrip(buffer, plus_start + 1, plus_line_end)
+        if seq_end - seq_start != qual_end - qual_start:
+            break
+        # an empty sequence followed by a line starting with '@' is ambiguous
+        if seq_start == seq_end and qual_start < size and buffer[qual_start] == _AT:
+            break
+        valid = True
+        # whitespace is not allowed in sequences
+        for i in range(seq_start, seq_end):
+            if buffer[i] == 32 or buffer[i] == 9:
+                valid = False
+                break
+        # the optional second title must match the first one
+        if plus_end > plus_start + 1:
+            if plus_end - plus_start - 1 != name_end - name_start:
+                valid = False
+            else:
+                for i in range(name_end - name_start):
+                    if buffer[plus_start+1+i] != buffer[name_start+i]:
+                        valid = False
+                        break
+        if not valid:
+            break
+        offsets[nrecords, 0] = name_start
+        offsets[nrecords, 1] = name_end
+        offsets[nrecords, 2] = seq_start
+        offsets[nrecords, 3] = seq_end
+        offsets[nrecords, 4] = qual_start
+        offsets[nrecords, 5] = qual_end
+        nrecords += 1
+        line += 4
+        position = cursor
+    return offsets[:nrecords], position
+
+
+class MappedFastq(AbstractContextManager):
+    """
+    A zero-copy view of an uncompressed FASTQ file: the file is memory-mapped
+    and records are represented by offsets into the mapping, that can be
+    sliced lazily or handed over to numba kernels as whole columns.
+    """
+
+    def __init__(self, path: str):
+        if util.isgzipped(path):
+            raise ValueError(f'{path} is compressed')
+        self._path = path
+        with open(path, 'rb') as handle:
+            # empty files can't be mapped
+            self._mmap = (
+                mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+                if handle.seek(0, io.SEEK_END) else None
+            )
+        self._buffer = (
+            np.frombuffer(self._mmap, dtype=np.uint8) if self._mmap else
+            np.empty(0, dtype=np.uint8)
+        )
+
+    @property
+    def buffer(self) -> np.ndarray:
+        """
+        Raw file contents
+        """
+        return self._buffer
+
+    def offsets(self, chunksize: int=CHUNKSIZE) -> Iterator[np.ndarray]:
+        """
+        Iterate over record offset arrays (see `index`) covering chunks of
+        about `chunksize` bytes
+        :param chunksize:
+        :return:
+        :raise ValueError: the file is not a strict 4-line FASTQ
+        """
+        position = 0
+        for offsets, position in self._chunks(chunksize):
+            yield offsets
+        if position < len(self._buffer):
+            raise ValueError(
+                f'{self._path} is not a strict 4-line FASTQ file: failed to '
+                f'index a record at byte {position}'
+            )
+
+    def strict(self, chunksize: int=CHUNKSIZE) -> bool:
+        """
+        Is the file a strict 4-line ASCII FASTQ without carriage returns? If
+        so, `offsets` cover the entire file and `decode` yields exactly the
+        records FastqGeneralIterator would. This takes an extra indexing pass.
+        :param chunksize:
+        :return:
+        """
+        for start in range(0, len(self._buffer), chunksize):
+            chunk = self._buffer[start:start+chunksize]
+            if chunk.max() >= _NONASCII or (chunk == _CR).any():
+                return False
+        position = 0
+        for _, position in self._chunks(chunksize):
+            pass
+        return position == len(self._buffer)
+
+    def decode(self, offsets: np.ndarray) -> List[Tuple[str, str, str]]:
+        """
+        Slice (name, seq, qual) records out of the file
+        :param offsets: consecutive rows of an `offsets` array of an ASCII file
+        :return:
+        """
+        if not len(offsets):
+            return []
+        start = offsets[0, NAME_START]
+        text = self._buffer[start:offsets[-1, QUAL_END]].tobytes().decode('ascii')
+        # byte offsets are character offsets in ASCII text
+        columns = (offsets - start).T.tolist()
+        return list(zip(*(
+            map(text.__getitem__, map(slice, starts, ends))
+            for starts, ends in zip(columns[0::2], columns[1::2])
+        )))
+
+    def _chunks(self, chunksize: int) -> Iterator[Tuple[np.ndarray, int]]:
+        size = len(self._buffer)
+        position = 0
+        window = chunksize
+        while position < size:
+            end = min(position + window, size)
+            newlines = np.flatnonzero(self._buffer[position:end] == _NEWLINE)
+            offsets, stop = index(self._buffer, newlines + position,
+                                  position, end == size)
+            if not len(offsets):
+                # a record might be longer than the window
+                if end == size:
+                    break
+                window *= 2
+                continue
+            position = stop
+            window = chunksize
+            yield offsets, position
+
+    def close(self):
+        # numpy views must be released before the mapping
+        self._buffer = np.empty(0, dtype=np.uint8)
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def parse(path: str) -> Iterator[Tuple[str, str, str]]:
+    """
+    Parse a plain or compressed FASTQ file with Biopython. Memory-mapping
+    (see MappedFastq) only pays off for consumers of raw offsets, e.g. TRIM.
+    :param path:
+    :return:
+    """
+    with util.gzread(path) as handle:
+        yield from FastqGeneralIterator(handle)
+
+
+if __name__ == '__main__':
+    raise RuntimeError
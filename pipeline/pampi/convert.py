@@ -0,0 +1,73 @@
+import os
+from typing import Optional
+
+from pipeline import util
+from pipeline.pampi import data
+
+
+def _destination(tmpdir: str, outdir: Optional[str], name: str, extension: str) \
+        -> str:
+    return (util.randname(tmpdir, f'.{extension}') if outdir is None else
+            os.path.join(outdir, f'{name}.{extension}'))
+
+
+def to_table(tmpdir: str, outdir: Optional[str],
+             sample: Optional[data.SampleClusters]) \
+        -> Optional[data.SampleClusterTable]:
+    """
+    Convert tab-separated clusters into the columnar format
+    :param tmpdir:
+    :param outdir:
+    :param sample:
+    :return:
+    """
+    if sample is None:
+        return None
+    output = _destination(tmpdir, outdir, sample.name, util.TABLE)
+    with sample:
+        data.write_cluster_table(output, sample.iter_records())
+        # conversion preserves clusters and hence their statistics
+        data.write_stats(output, *sample.stats())
+        return data.SampleClusterTable(sample.name, output,
+                                       delete=outdir is None)
+
+
+def to_tsv(tmpdir: str, outdir: Optional[str],
+           sample: Optional[data.SampleClusterTable]) \
+        -> Optional[data.SampleClusters]:
+    """
+    Convert columnar clusters into the tab-separated format
+    :param tmpdir:
+    :param outdir:
+    :param sample:
+    :return:
+    """
+    if sample is None:
+        return None
+    output = _destination(tmpdir, outdir, sample.name, util.CLUSTERS)
+    with sample:
+        with util.RecordWriter(False, output,
+                               util.CLUSTERS_TEMPLATE) as buffer:
+            buffer.writemany(('\t'.join([reference, *reads]),)
+                             for reference, reads in sample.iter_records())
+        # conversion preserves clusters and hence their statistics
+        data.write_stats(output, *sample.stats())
+    return data.SampleClusters(sample.name, output, delete=outdir is None)
+
+
+def to_tables(tmpdir: str, outdir: Optional[str],
+              samples: data.MultipleClusters) -> data.MultipleClusterTables:
+    return data.MultipleClusterTables([
+        to_table(tmpdir, outdir, sample) for sample in samples.samples
+    ])
+
+
+def to_tsvs(tmpdir: str, outdir: Optional[str],
+            samples: data.MultipleClusterTables) -> data.MultipleClusters:
+    return data.MultipleClusters([
+        to_tsv(tmpdir, outdir, sample) for sample in samples.samples
+    ])
+
+
+if __name__ == '__main__':
+    raise RuntimeError
@@ -1,15 +1,18 @@
 import abc
+import json
 import os
+from array import array
+from collections import Counter
 from contextlib import AbstractContextManager, suppress
 from itertools import filterfalse
 from typing import Optional, Callable, Sequence, Iterable, TypeVar, List, \
-    NamedTuple, Tuple
+    NamedTuple, Tuple, Iterator, Dict, Union
 
+import numpy as np
 from Bio.SeqIO.FastaIO import SimpleFastaParser
-from Bio.SeqIO.QualityIO import FastqGeneralIterator
 from fn import F
 
-from pipeline import util
+from pipeline import util, fastq
 
 A = TypeVar('A')
 
@@ -23,6 +26,136 @@ _nonfile: Callable[[Iterable[str]], List[str]] = (
     F(_true) >> (filterfalse, os.path.isfile) >> list
 )
 
+# statistics sidecars are stored next to data files
+STATS = 'stats'
+PHRED = 33
+
+SampleStats = NamedTuple('SampleStats', [
+    ('records', int),
+    # the total length of sequences; clusters: the total number of reads
+    ('bases', int),
+    # sequence length (clusters: cluster size) -> the number of records
+    ('lengths', Dict[int, int]),
+    # mean base quality; None for data without qualities
+    ('quality', Optional[float])
+])
+
+
+class StatsCollector:
+    """
+    Accumulate SampleStats while records are being written
+    >>> collector = StatsCollector()
+    >>> collector.update([('a', 'ACGT', 'IIII'), ('b', 'AC', '++')])
+    >>> collector.stats()
+    SampleStats(records=2, bases=6, lengths={2: 1, 4: 1}, quality=30.0)
+    >>> other = StatsCollector()
+    >>> other.update([('c', 'ACGT')])
+    >>> collector.merge(other).stats().lengths
+    {2: 1, 4: 2}
+    """
+
+    def __init__(self, phred: int=PHRED):
+        self._phred = phred
+        self._records = 0
+        self._bases = 0
+        self._lengths = Counter()
+        self._quality = 0
+        self._qualified = 0
+
+    def add(self, length: int, quality: Optional[str]=None):
+        """
+        Add a record
+        :param length: sequence length or cluster size
+        :param quality: a quality string
+        :return:
+        """
+        self._records += 1
+        self._bases += length
+        self._lengths[length] += 1
+        if quality is not None:
+            self._quality += sum(quality.encode()) - self._phred * len(quality)
+            self._qualified += len(quality)
+
+    def update(self, records: Iterable[Sequence[str]]):
+        """
+        Add (name, sequence) or (name, sequence, quality) records
+        :param records:
+        :return:
+        """
+        for _, sequence, *quality in records:
+            self.add(len(sequence), *quality)
+
+    def tap(self, records: Iterable[Sequence[str]]) -> Iterator[Sequence[str]]:
+        """
+        Pass records through adding them along the way
+        :param records:
+        :return:
+        """
+        for record in records:
+            self.update((record,))
+            yield record
+
+    def merge(self, other: 'StatsCollector') -> 'StatsCollector':
+        self._records += other._records
+        self._bases += other._bases
+        self._lengths.update(other._lengths)
+        self._quality += other._quality
+        self._qualified += other._qualified
+        return self
+
+    def stats(self) -> SampleStats:
+        return SampleStats(
+            self._records, self._bases, dict(sorted(self._lengths.items())),
+            self._quality / self._qualified if self._qualified else None
+        )
+
+
+def _sidecar(path: str) -> str:
+    return f'{path}.{STATS}'
+
+
+def _stamp(path: str) -> Tuple[int, int]:
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def write_stats(path: str, stats: SampleStats):
+    """
+    Store statistics of a data file into a sidecar file. The sidecar is bound
+    to the file's size and modification time, hence it must be written after
+    the data file is closed.
+    :param path: data file
+    :param stats:
+    :return:
+    """
+    size, mtime = _stamp(path)
+    sidecar = dict(stats._asdict(), lengths=list(stats.lengths.items()),
+                   size=size, mtime=mtime)
+    with open(_sidecar(path), 'w') as handle:
+        json.dump(sidecar, handle)
+
+
+def read_stats(path: str) -> Optional[SampleStats]:
+    """
+    Read a statistics sidecar
+    :param path: data file
+    :return: None if there is no sidecar or the data file has changed since
+    the sidecar was written
+    """
+    try:
+        with open(_sidecar(path)) as handle:
+            sidecar = json.load(handle)
+    except (FileNotFoundError, ValueError):
+        return None
+    if (sidecar.get('size'), sidecar.get('mtime')) != _stamp(path):
+        return None
+    try:
+        return SampleStats(sidecar['records'], sidecar['bases'],
+                           dict(map(tuple, sidecar['lengths'])),
+                           sidecar['quality'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
 
 class VolatileResource(AbstractContextManager, metaclass=abc.ABCMeta):
 
@@ -90,11 +223,44 @@ class SampleFiles(VolatileResource):
     def released(self) -> bool:
         return self._released
 
+    def count(self) -> int:
+        """
+        Count records. A valid statistics sidecar (see `write_stats`) of the
+        first file is used if there is one, otherwise files are scanned
+        without parsing.
+        :return:
+        """
+        if self.released:
+            raise RuntimeError(f'accessing a released resource {self}')
+        cached = read_stats(self.files[0])
+        return self._count() if cached is None else cached.records
+
+    def _count(self) -> int:
+        return sum(1 for _ in self.iter_records())
+
+    def stats(self) -> List[SampleStats]:
+        """
+        Statistics of each file. Sidecars written by the stage that produced
+        the files are used when valid, otherwise files are parsed.
+        :return:
+        """
+        if self.released:
+            raise RuntimeError(f'accessing a released resource {self}')
+        cached = list(map(read_stats, self.files))
+        return self._stats() if None in cached else cached
+
+    def _stats(self) -> List[SampleStats]:
+        collector = StatsCollector()
+        collector.update(self.iter_records())
+        return [collector.stats()]
+
     def release(self):
         if not self.released and self._delete:
             for fname in self.files:
                 with suppress(FileNotFoundError):
                     os.remove(fname)
+                with suppress(FileNotFoundError):
+                    os.remove(_sidecar(fname))
                 # TODO maybe we should throw a warning?
         self._released = True
 
@@ -113,12 +279,35 @@ class SamplePairedFastq(SampleFiles):
     def reverse(self) -> Optional[str]:
         return self.files[1] if self.files else None
 
-    def parse(self) \
-            -> List[Tuple[Tuple[str, str, str], Tuple[str, str, str]]]:
+    def iter_records(self) \
+            -> Iterator[Tuple[Tuple[str, str, str], Tuple[str, str, str]]]:
+        """
+        Lazily iterate over read pairs; the underlying handles are closed
+        once the iterator is exhausted (or garbage-collected)
+        :return:
+        """
         if self.released:
             raise RuntimeError(f'accessing a released resource {self}')
-        with util.gzread(self.forward) as fwd, util.gzread(self.reverse) as rev:
-            return list(zip(*map(FastqGeneralIterator, [fwd, rev])))
+        return self._iter_records()
+
+    def _iter_records(self) \
+            -> Iterator[Tuple[Tuple[str, str, str], Tuple[str, str, str]]]:
+        yield from zip(*map(fastq.parse, [self.forward, self.reverse]))
+
+    def _count(self) -> int:
+        # assumes 4-line records
+        return util.count_lines(self.forward) // 4
+
+    def _stats(self) -> List[SampleStats]:
+        forward, reverse = StatsCollector(), StatsCollector()
+        for fwd, rev in self.iter_records():
+            forward.update((fwd,))
+            reverse.update((rev,))
+        return [forward.stats(), reverse.stats()]
+
+    def parse(self) \
+            -> List[Tuple[Tuple[str, str, str], Tuple[str, str, str]]]:
+        return list(self.iter_records())
 
 
 class SampleFasta(SampleFiles):
@@ -130,20 +319,38 @@ class SampleFasta(SampleFiles):
     def sequences(self) -> str:
         return self.files[0] if self.files else None
 
-    def parse(self) -> List[Tuple[str, str]]:
+    def iter_records(self) -> Iterator[Tuple[str, str]]:
+        """
+        Lazily iterate over records; the underlying handle is closed once the
+        iterator is exhausted (or garbage-collected)
+        :return:
+        """
         if self.released:
             raise RuntimeError(f'accessing a released resource {self}')
+        return self._iter_records()
+
+    def _iter_records(self) -> Iterator[Tuple[str, str]]:
         with util.gzread(self.sequences) as buffer:
-            return list(SimpleFastaParser(buffer))
+            yield from SimpleFastaParser(buffer)
+
+    def _count(self) -> int:
+        return util.count_lines(self.sequences, b'>')
+
+    def parse(self) -> List[Tuple[str, str]]:
+        return list(self.iter_records())
 
 
 class SampleFastq(SampleFasta):
 
+    def _iter_records(self) -> Iterator[Tuple[str, str, str]]:
+        yield from fastq.parse(self.sequences)
+
+    def _count(self) -> int:
+        # assumes 4-line records
+        return util.count_lines(self.sequences) // 4
+
     def parse(self) -> List[Tuple[str, str, str]]:
-        if self.released:
-            raise RuntimeError(f'accessing a released resource {self}')
-        with util.gzread(self.sequences) as buffer:
-            return list(FastqGeneralIterator(buffer))
+        return list(self.iter_records())
 
 
 class SampleClusters(SampleFiles):
@@ -155,16 +362,181 @@ class SampleClusters(SampleFiles):
     def clusters(self) -> Optional[str]:
         return self.files[0] if self.files else None
 
-    def parse(self) -> List[Tuple[str, List[str]]]:
+    def iter_records(self) -> Iterator[Tuple[str, List[str]]]:
+        """
+        Lazily iterate over clusters; the underlying handle is closed once the
+        iterator is exhausted (or garbage-collected)
+        :return:
+        """
+        if self.released:
+            raise RuntimeError(f'accessing a released resource {self}')
+        return self._iter_records()
+
+    def counts(self) -> List[Tuple[str, int]]:
+        """
+        Reference names and the number of reads in their clusters; member
+        names are counted in raw bytes without being parsed
+        :return:
+        """
         if self.released:
             raise RuntimeError(f'accessing a released resource {self}')
+        counts = []
         with util.gzread(self.clusters) as buffer:
-            return (
+            for line in map(bytes.strip, buffer.buffer):
+                if line:
+                    reference, _, members = line.partition(b'\t')
+                    counts.append(
+                        (reference.decode(), members.count(b'\t') + bool(members))
+                    )
+        return counts
+
+    def _iter_records(self) -> Iterator[Tuple[str, List[str]]]:
+        with util.gzread(self.clusters) as buffer:
+            yield from (
                 F(map, str.strip) >> (filter, bool) >>
                 (map, lambda x: x.split('\t')) >>
-                (map, lambda x: (x[0], x[1:])) >> list
+                (map, lambda x: (x[0], x[1:]))
             )(buffer)
 
+    def _count(self) -> int:
+        # a cluster per line
+        return util.count_lines(self.clusters)
+
+    def _stats(self) -> List[SampleStats]:
+        collector = StatsCollector()
+        for _, size in self.counts():
+            collector.add(size)
+        return [collector.stats()]
+
+    def parse(self) -> List[Tuple[str, List[str]]]:
+        return list(self.iter_records())
+
+
+class SampleClusterTable(SampleFiles):
+    """
+    Clusters stored in a columnar NumPy .npz file. Reference names and member
+    read names are kept in separate columns: `references` (all reference
+    names concatenated, uint8) with `reference_offsets` (cluster c's
+    reference spans [reference_offsets[c], reference_offsets[c+1])), `reads`
+    (all member names concatenated, uint8) with `read_offsets` (read i spans
+    [read_offsets[i], read_offsets[i+1])) and `cluster_offsets` (cluster c
+    consists of reads [cluster_offsets[c], cluster_offsets[c+1])). Arrays
+    are loaded on demand, hence count-only accessors never read member names.
+    """
+
+    def __init__(self, name: str, table: str, delete=True):
+        super().__init__(name, table, delete=delete)
+
+    @property
+    def table(self) -> Optional[str]:
+        return self.files[0] if self.files else None
+
+    def _load(self, *arrays: str) -> List[np.ndarray]:
+        if self.released:
+            raise RuntimeError(f'accessing a released resource {self}')
+        with np.load(self.table) as table:
+            return [table[array] for array in arrays]
+
+    def sizes(self) -> np.ndarray:
+        """
+        The number of reads in each cluster
+        :return:
+        """
+        cluster_offsets, = self._load('cluster_offsets')
+        return np.diff(cluster_offsets)
+
+    def references(self) -> List[str]:
+        references, reference_offsets = self._load(
+            'references', 'reference_offsets'
+        )
+        return _split(references.tobytes(), reference_offsets.tolist())
+
+    def counts(self) -> List[Tuple[str, int]]:
+        """
+        Reference names and the number of reads in their clusters
+        :return:
+        """
+        return list(zip(self.references(), self.sizes().tolist()))
+
+    def iter_records(self) -> Iterator[Tuple[str, List[str]]]:
+        """
+        Iterate over clusters just like SampleClusters.iter_records
+        :return:
+        """
+        if self.released:
+            raise RuntimeError(f'accessing a released resource {self}')
+        return self._iter_records()
+
+    def _iter_records(self) -> Iterator[Tuple[str, List[str]]]:
+        reads, read_offsets, cluster_offsets = self._load(
+            'reads', 'read_offsets', 'cluster_offsets'
+        )
+        reads = _split(reads.tobytes(), read_offsets.tolist())
+        cluster_offsets = cluster_offsets.tolist()
+        for reference, start, end in zip(self.references(),
+                                         cluster_offsets[:-1],
+                                         cluster_offsets[1:]):
+            yield reference, reads[start:end]
+
+    def _count(self) -> int:
+        return len(self.sizes())
+
+    def _stats(self) -> List[SampleStats]:
+        collector = StatsCollector()
+        for _, size in self.counts():
+            collector.add(size)
+        return [collector.stats()]
+
+    def parse(self) -> List[Tuple[str, List[str]]]:
+        return list(self.iter_records())
+
+
+def _split(names: bytes, offsets: List[int]) -> List[str]:
+    """
+    Split concatenated names at offsets
+    :param names:
+    :param offsets: name i spans [offsets[i], offsets[i+1])
+    :return:
+    """
+    return [names[start:end].decode()
+            for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def _encode(name: Union[str, bytes]) -> bytes:
+    return name if isinstance(name, bytes) else name.encode()
+
+
+def write_cluster_table(path: str,
+                        clusters: Iterable[Tuple[Union[str, bytes],
+                                                 List[Union[str, bytes]]]]):
+    """
+    Write clusters in the SampleClusterTable format
+    :param path: an .npz destination
+    :param clusters: (reference, reads) pairs; names can be bytes, which are
+    stored as is
+    :return:
+    """
+    references, reads = bytearray(), bytearray()
+    reference_offsets = array('q', [0])
+    read_offsets = array('q', [0])
+    cluster_offsets = array('q', [0])
+    for reference, members in clusters:
+        references += _encode(reference)
+        reference_offsets.append(len(references))
+        for name in members:
+            reads += _encode(name)
+            read_offsets.append(len(reads))
+        cluster_offsets.append(len(read_offsets) - 1)
+    columns = dict(
+        references=np.frombuffer(bytes(references), dtype=np.uint8),
+        reference_offsets=np.frombuffer(reference_offsets, dtype=np.int64),
+        reads=np.frombuffer(bytes(reads), dtype=np.uint8),
+        read_offsets=np.frombuffer(read_offsets, dtype=np.int64),
+        cluster_offsets=np.frombuffer(cluster_offsets, dtype=np.int64)
+    )
+    with open(path, 'wb') as buffer:
+        np.savez(buffer, **columns)
+
 
 # TODO we might want to implement full-blown classes with init-time validation
 # to make sure MultipleSample* can't be initialised with released resources
@@ -184,6 +556,10 @@ MultipleClusters = NamedTuple('MultipleClusters', [
     ('samples', List[Optional[SampleClusters]])
 ])
 
+MultipleClusterTables = NamedTuple('MultipleClusterTables', [
+    ('samples', List[Optional[SampleClusterTable]])
+])
+
 
 if __name__ == '__main__':
     raise RuntimeError
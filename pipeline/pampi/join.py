@@ -1,18 +1,24 @@
 import operator as op
 import os
 import re
-from contextlib import ExitStack
-from functools import reduce
-from itertools import count, islice, chain, tee
-from typing import Callable, Iterator, Tuple, Iterable, List
+import tempfile
+from array import array
+from contextlib import ExitStack, closing, suppress
+from itertools import count
+from typing import Callable, Iterator, Tuple, Iterable, List, Sized, Dict, \
+    Union, Sequence
 
 from fn import F
-from fn.iters import group_by
 from multipledispatch import dispatch
 
 from pipeline.pampi import data
 from pipeline import util
-from pipeline.util import root_exists, writer, ending
+from pipeline.util import root_exists, ending
+
+CLUSTER_TEMPLATE = '{}\t{}\n'
+SHARD = 'shard'
+# the number of renamed reads written by a single cluster shard job
+SHARDSIZE = 2**20
 
 
 class BadSample(ValueError):
@@ -65,6 +71,34 @@ def join_fastqc(name_templates: Iterable[str],
         yield from ((name, seq, qual) for name, (_, seq, qual) in zip(names, reads))
 
 
+def join_paired_fastqc(name_templates: Iterable[str],
+                       pairs: Iterable[Iterable[Tuple[Tuple[str, str, str],
+                                                      Tuple[str, str, str]]]]) \
+        -> Iterator[Tuple[Tuple[str, str, str], Tuple[str, str, str]]]:
+    """
+    A paired-end equivalent of `join_fastqc`: mates are renamed in lockstep
+    :param name_templates:
+    :param pairs:
+    :return:
+    >>> pairs = [
+    ...     [(('a', 'f1', 'q1'), ('a', 'r1', 'q1'))],
+    ...     [(('b', 'f2', 'q2'), ('b', 'r2', 'q2')),
+    ...      (('c', 'f3', 'q3'), ('c', 'r3', 'q3'))]
+    ... ]
+    >>> for pair in join_paired_fastqc(['s1_{}', 's2_{}'], pairs):
+    ...     print(pair)
+    (('s1_1/1', 'f1', 'q1'), ('s1_1/2', 'r1', 'q1'))
+    (('s2_1/1', 'f2', 'q2'), ('s2_1/2', 'r2', 'q2'))
+    (('s2_2/1', 'f3', 'q3'), ('s2_2/2', 'r3', 'q3'))
+    """
+    name_generators = [_make_counter(1, template) for template in name_templates]
+    for names, pairs_ in zip(name_generators, pairs):
+        yield from (
+            ((f'{name}/1', fseq, fqual), (f'{name}/2', rseq, rqual))
+            for name, ((_, fseq, fqual), (_, rseq, rqual)) in zip(names, pairs_)
+        )
+
+
 def join_fasta(name_templates: Iterable[str],
                fastas: Iterable[Iterable[Tuple[str, str]]]) \
         -> Iterable[Tuple[str, str]]:
@@ -93,11 +127,18 @@ def join_fasta(name_templates: Iterable[str],
 
 
 def join_clusters(name_templates: Iterable[str],
-                  clusters: Iterable[List[Tuple[str, List]]]) \
-        -> List[Tuple[str, List[str]]]:
+                  clusters: Iterable[Iterable[Tuple[str, Sized]]]) \
+        -> Iterator[Tuple[str, List[str]]]:
     """
+    Merge clusters of several samples renaming their reads. Renamed reads
+    are represented by (sample, first read number, size) spans appended to
+    per-cluster buffers, hence memory usage depends on the number of
+    cluster-sample pairs rather than the number of reads; names are only
+    generated for one cluster at a time while yielding the results. Clusters
+    are ordered by first appearance.
     :param name_templates:
-    :param clusters:
+    :param clusters: (cluster, reads) pairs of each sample; only the sizes of
+    read containers are used
     :return:
     >>> clusters = [
     ...     [
@@ -115,25 +156,236 @@ def join_clusters(name_templates: Iterable[str],
     ...     ('cluster2', ['sample1_3', 'sample1_4']),
     ...     ('cluster3', ['sample2_2', 'sample2_3', 'sample2_4'])
     ... ]
-    >>> join_clusters(name_templates, clusters) == clusters_joined
+    >>> list(join_clusters(name_templates, clusters)) == clusters_joined
     True
     """
-    name_generators = [_make_counter(1, template) for template in name_templates]
-    renamed = (
-        ((cls, list(islice(names, 0, len(seqs)))) for cls, seqs in clusters_)
-        for names, clusters_ in zip(name_generators, clusters)
-    )
-    grouped = group_by(op.itemgetter(0), chain.from_iterable(renamed))
-    # flatten
+    templates, spans = cluster_spans(name_templates, clusters)
+    for cls, spans_ in spans.items():
+        yield cls, expand_spans(templates, spans_)
+
+
+def cluster_spans(name_templates: Iterable[str],
+                  clusters: Iterable[Iterable[Tuple[str, Sized]]]) \
+        -> Tuple[List[str], Dict[str, array]]:
+    """
+    Collect (sample, first read number, size) spans of each cluster (see
+    `join_clusters`)
+    :param name_templates:
+    :param clusters:
+    :return: name templates and flat span arrays of clusters
+    """
+    templates = []
+    spans = {}
+    for sample, (template, clusters_) in enumerate(zip(name_templates, clusters)):
+        templates.append(template)
+        start = 1
+        for cls, seqs in clusters_:
+            spans.setdefault(cls, array('q')).extend((sample, start, len(seqs)))
+            start += len(seqs)
+    return templates, spans
+
+
+def expand_spans(templates: List[str], spans: array) -> List[str]:
+    """
+    Generate read names
+    :param templates: name templates of samples
+    :param spans: a flat array of (sample, first read number, size) spans
+    :return:
+    >>> expand_spans(['a_{}', 'b_{}'], array('q', [0, 2, 2, 1, 1, 1]))
+    ['a_2', 'a_3', 'b_1']
+    """
     return [
-        (key, reduce(op.iadd, map(op.itemgetter(1), group)))
-        for key, group in grouped.items()
+        templates[sample].format(number)
+        for sample, start, size in zip(*[iter(spans)]*3)
+        for number in range(start, start + size)
     ]
 
 
+def _write_pairs(forward_buffer: util.RecordWriter,
+                 reverse_buffer: util.RecordWriter,
+                 pairs: Iterable[Tuple[Tuple[str, str, str],
+                                       Tuple[str, str, str]]]) \
+        -> Tuple[data.StatsCollector, data.StatsCollector]:
+    forward_stats, reverse_stats = data.StatsCollector(), data.StatsCollector()
+    for chunk in util.chunked(util.BATCHSIZE, pairs):
+        forward_buffer.writemany(forward_stats.tap(map(op.itemgetter(0), chunk)))
+        reverse_buffer.writemany(reverse_stats.tap(map(op.itemgetter(1), chunk)))
+    return forward_stats, reverse_stats
+
+
+def _write_sequences(buffer: util.RecordWriter, records: Iterable[Sequence[str]]) \
+        -> data.StatsCollector:
+    stats = data.StatsCollector()
+    buffer.writemany(stats.tap(records))
+    return stats
+
+
+def _write_clusters(buffer: util.RecordWriter,
+                    clusters: Iterable[Tuple[str, List[str]]]) \
+        -> data.StatsCollector:
+    stats = data.StatsCollector()
+    # clusters can be large: write them one by one to keep the buffer bounded
+    for name, reads in clusters:
+        buffer.write((name, '\t'.join(reads)))
+        stats.add(len(reads))
+    return stats
+
+
+def _shard_name(tmpdir: str, compress: bool) -> str:
+    return util.randname(tmpdir, f'.{SHARD}' + ending(compress))
+
+
+def _sequence_shard(tmpdir: str, compress: bool, template: str,
+                    join_: Callable, job: Tuple[str, data.SampleFiles]) \
+        -> Tuple[str, data.StatsCollector]:
+    """
+    Rename a single sample's records into a shard (a worker job)
+    :param tmpdir:
+    :param compress:
+    :param template: record template
+    :param join_: `join_fastqc` or `join_fasta`
+    :param job: a name template and a sample; the sample is not released
+    :return: shard path and shard statistics
+    """
+    name_template, sample = job
+    shard = _shard_name(tmpdir, compress)
+    with util.RecordWriter(compress, shard, template) as buffer:
+        stats = _write_sequences(
+            buffer, join_([name_template], [sample.iter_records()])
+        )
+    return shard, stats
+
+
+def _paired_shard(tmpdir: str, compress: bool,
+                  job: Tuple[str, data.SamplePairedFastq]) \
+        -> Tuple[Tuple[str, data.StatsCollector], Tuple[str, data.StatsCollector]]:
+    name_template, sample = job
+    forward, reverse = _shard_name(tmpdir, compress), _shard_name(tmpdir, compress)
+    with util.RecordWriter(compress, forward, util.FASTQ_TEMPLATE) as fwd, \
+            util.RecordWriter(compress, reverse, util.FASTQ_TEMPLATE) as rev:
+        forward_stats, reverse_stats = _write_pairs(
+            fwd, rev, join_paired_fastqc([name_template], [sample.iter_records()])
+        )
+    return (forward, forward_stats), (reverse, reverse_stats)
+
+
+def _cluster_shard(tmpdir: str, compress: bool, templates: List[str],
+                   clusters: List[Tuple[str, array]]) \
+        -> Tuple[str, data.StatsCollector]:
+    shard = _shard_name(tmpdir, compress)
+    with util.RecordWriter(compress, shard, CLUSTER_TEMPLATE) as buffer:
+        stats = _write_clusters(buffer, ((cls, expand_spans(templates, spans))
+                                         for cls, spans in clusters))
+    return shard, stats
+
+
+def _chunk_spans(spans: Dict[str, array]) -> Iterator[List[Tuple[str, array]]]:
+    """
+    Group clusters into shards of about SHARDSIZE reads
+    :param spans:
+    :return:
+    """
+    chunk, size = [], 0
+    for cls, spans_ in spans.items():
+        chunk.append((cls, spans_))
+        size += sum(spans_[2::3])
+        if size >= SHARDSIZE:
+            yield chunk
+            chunk, size = [], 0
+    if chunk:
+        yield chunk
+
+
+class _Concatenator:
+    """
+    Append shards to an output merging shard statistics; the statistics
+    sidecar is written once the output is closed. A partial output is removed
+    on failure.
+    """
+
+    def __init__(self, compress: bool, output: str):
+        self._output = output
+        self._writer = util.ShardWriter(compress, output)
+        self._stats = data.StatsCollector()
+
+    def append(self, shard: Tuple[str, data.StatsCollector]):
+        path, stats = shard
+        self._writer.append(path)
+        self._stats.merge(stats)
+
+    def __enter__(self) -> '_Concatenator':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._writer.close()
+        if exc_type is None:
+            data.write_stats(self._output, self._stats.stats())
+            return
+        with suppress(FileNotFoundError):
+            os.remove(self._output)
+
+
+def _concatenate(compress: bool, output: str,
+                 shards: Iterator[Tuple[str, data.StatsCollector]]):
+    """
+    :param compress:
+    :param output:
+    :param shards: a `util.pmap` stream; it is closed (and thus its workers
+    are waited for) before the output is removed on failure
+    :return:
+    """
+    with _Concatenator(compress, output) as concatenator, closing(shards):
+        for shard in shards:
+            concatenator.append(shard)
+
+
+def _join_sequences(tmpdir: str, rename: Callable[[str], str], compress: bool,
+                    output: str, template: str, join_: Callable, jobs: int,
+                    samples: List[data.SampleFiles]):
+    name_templates = [f'{rename(sample.name)}_{{}}' for sample in samples]
+    if jobs > 1:
+        # samples are renamed and compressed into shards in parallel; shards
+        # left unconsumed after a failure are removed with their directory
+        with tempfile.TemporaryDirectory(dir=tmpdir) as sharddir:
+            shards = util.pmap(
+                jobs, F(_sequence_shard, sharddir, compress, template, join_),
+                zip(name_templates, samples)
+            )
+            return _concatenate(compress, output, shards)
+    reads = (sample.iter_records() for sample in samples)
+    with util.RecordWriter(compress, output, template) as buffer:
+        stats = _write_sequences(buffer, join_(name_templates, reads))
+    data.write_stats(output, stats.stats())
+
+
+def _join_clusters(tmpdir: str, rename: Callable[[str], str], compress: bool,
+                   output: str, jobs: int,
+                   samples: List[Union[data.SampleClusters,
+                                       data.SampleClusterTable]]):
+    name_templates = [f'{rename(sample.name)}_{{}}' for sample in samples]
+    # reads are renamed, hence only cluster sizes are read
+    clusters = (
+        ((reference, range(size)) for reference, size in sample.counts())
+        for sample in samples
+    )
+    if jobs > 1:
+        # clusters merge reads across samples, hence shards hold groups of
+        # merged clusters rather than samples
+        templates, spans = cluster_spans(name_templates, clusters)
+        with tempfile.TemporaryDirectory(dir=tmpdir) as sharddir:
+            shards = util.pmap(
+                jobs, F(_cluster_shard, sharddir, compress, templates),
+                _chunk_spans(spans)
+            )
+            return _concatenate(compress, output, shards)
+    with util.RecordWriter(compress, output, CLUSTER_TEMPLATE) as buffer:
+        stats = _write_clusters(buffer, join_clusters(name_templates, clusters))
+    data.write_stats(output, stats.stats())
+
+
 @dispatch(str, Callable, bool, (str, type(None)), data.MultipleFastq)
 def join(tmpdir: str, rename: Callable[[str], str], compress: bool,
-         output: str, samples: data.MultipleFastq) \
+         output: str, samples: data.MultipleFastq, jobs: int=1) \
         -> data.SampleFastq:
 
     output_ = (
@@ -148,11 +400,8 @@ def join(tmpdir: str, rename: Callable[[str], str], compress: bool,
         samples_: List[data.SampleFastq] = list(
             map(context.enter_context, samples.samples)
         )
-        name_templates = [f'@{rename(sample.name)}_{{}}' for sample in samples_]
-        reads = (sample.parse() for sample in samples_)
-        buffer = context.enter_context(writer(compress, output_))
-        for name, seq, qual in join_fastqc(name_templates, reads):
-            print(name, seq, '+', qual, sep='\n', file=buffer)
+        _join_sequences(tmpdir, rename, compress, output_, util.FASTQ_TEMPLATE,
+                        join_fastqc, jobs, samples_)
         return data.SampleFastq(
             'joined', output_, output is None
         )
@@ -160,7 +409,8 @@ def join(tmpdir: str, rename: Callable[[str], str], compress: bool,
 
 @dispatch(str, Callable, bool, (str, type(None)), data.MultiplePairedFastq)
 def join(tmpdir: str, rename: Callable[[str], str], compress: bool,
-         output_pattern: str, samples: data.MultiplePairedFastq) \
+         output_pattern: str, samples: data.MultiplePairedFastq,
+         jobs: int=1) \
         -> data.SamplePairedFastq:
 
     out_pattern = (
@@ -178,22 +428,33 @@ def join(tmpdir: str, rename: Callable[[str], str], compress: bool,
         samples_: List[data.SamplePairedFastq] = list(
             map(context.enter_context, samples.samples)
         )
-        fwd_name_templates = [
-            f'@{rename(sample.name)}_{{}}/1' for sample in samples_
-        ]
-        rev_name_templates = [
-            f'@{rename(sample.name)}_{{}}/2' for sample in samples_
-        ]
-        fwd_stream, rev_stream = tee((sample.parse() for sample in samples_), 2)
-        fwd_reads = join_fastqc(fwd_name_templates,
-                                F(map, F(map, op.itemgetter(0)))(fwd_stream))
-        rev_reads = join_fastqc(rev_name_templates,
-                                F(map, F(map, op.itemgetter(1)))(rev_stream))
-        forward_buffer = context.enter_context(writer(compress, fwd_output))
-        reverse_buffer = context.enter_context(writer(compress, rev_output))
-        for (fname, fseq, fqual), (rname, rseq, rqual) in zip(fwd_reads, rev_reads):
-            print(fname, fseq, '+', fqual, sep='\n', file=forward_buffer)
-            print(rname, rseq, '+', rqual, sep='\n', file=reverse_buffer)
+        name_templates = [f'{rename(sample.name)}_{{}}' for sample in samples_]
+        if jobs > 1:
+            sharddir = context.enter_context(
+                tempfile.TemporaryDirectory(dir=tmpdir)
+            )
+            shards = util.pmap(jobs, F(_paired_shard, sharddir, compress),
+                               zip(name_templates, samples_))
+            with _Concatenator(compress, fwd_output) as forward_writer, \
+                    _Concatenator(compress, rev_output) as reverse_writer, \
+                    closing(shards):
+                for forward, reverse in shards:
+                    forward_writer.append(forward)
+                    reverse_writer.append(reverse)
+        else:
+            # both mates are read in lockstep and written chunk by chunk
+            pairs = join_paired_fastqc(
+                name_templates, (sample.iter_records() for sample in samples_)
+            )
+            with util.RecordWriter(compress, fwd_output,
+                                   util.FASTQ_TEMPLATE) as forward_buffer, \
+                    util.RecordWriter(compress, rev_output,
+                                      util.FASTQ_TEMPLATE) as reverse_buffer:
+                forward_stats, reverse_stats = _write_pairs(
+                    forward_buffer, reverse_buffer, pairs
+                )
+            data.write_stats(fwd_output, forward_stats.stats())
+            data.write_stats(rev_output, reverse_stats.stats())
         return data.SamplePairedFastq(
             'joined', fwd_output, rev_output,
             output_pattern is None
@@ -202,7 +463,7 @@ def join(tmpdir: str, rename: Callable[[str], str], compress: bool,
 
 @dispatch(str, Callable, bool, (str, type(None)), data.MultipleFasta)
 def join(tmpdir: str, rename: Callable[[str], str], compress: bool,
-         output: str, samples: data.MultipleFasta) \
+         output: str, samples: data.MultipleFasta, jobs: int=1) \
         -> data.SampleFasta:
 
     output_ = (
@@ -217,11 +478,8 @@ def join(tmpdir: str, rename: Callable[[str], str], compress: bool,
         samples_: List[data.SampleFasta] = list(
             map(context.enter_context, samples.samples)
         )
-        name_templates = [f'>{rename(sample.name)}_{{}}' for sample in samples_]
-        reads = (sample.parse() for sample in samples_)
-        buffer = context.enter_context(writer(compress, output_))
-        for name, seq in join_fasta(name_templates, reads):
-            print(name, seq, sep='\n', file=buffer)
+        _join_sequences(tmpdir, rename, compress, output_, util.FASTA_TEMPLATE,
+                        join_fasta, jobs, samples_)
         return data.SampleFasta(
             'joined', output_, output is None
         )
@@ -229,7 +487,7 @@ def join(tmpdir: str, rename: Callable[[str], str], compress: bool,
 
 @dispatch(str, Callable, bool, (str, type(None)), data.MultipleClusters)
 def join(tmpdir: str, rename: Callable[[str], str], compress: bool,
-         output: str, samples: data.MultipleClusters) \
+         output: str, samples: data.MultipleClusters, jobs: int=1) \
         -> data.SampleClusters:
 
     output_ = (
@@ -244,11 +502,30 @@ def join(tmpdir: str, rename: Callable[[str], str], compress: bool,
         samples_: List[data.SampleClusters] = list(
             map(context.enter_context, samples.samples)
         )
-        name_templates = [f'{rename(sample.name)}_{{}}' for sample in samples_]
-        clusters = (sample.parse() for sample in samples_)
-        buffer = context.enter_context(writer(compress, output_))
-        for name, reads in join_clusters(name_templates, clusters):
-            print(name, '\t'.join(reads), sep='\t', file=buffer)
+        _join_clusters(tmpdir, rename, compress, output_, jobs, samples_)
+        return data.SampleClusters(
+            'joined', output_, output is None
+        )
+
+
+@dispatch(str, Callable, bool, (str, type(None)), data.MultipleClusterTables)
+def join(tmpdir: str, rename: Callable[[str], str], compress: bool,
+         output: str, samples: data.MultipleClusterTables, jobs: int=1) \
+        -> data.SampleClusters:
+
+    output_ = (
+        output if output is not None else
+        util.randname(tmpdir, f'.{util.CLUSTERS}' + ending(compress))
+    )
+
+    if not root_exists(output_):
+        raise ValueError(f'missing directory for {os.path.dirname(output_)}')
+
+    with ExitStack() as context:
+        samples_: List[data.SampleClusterTable] = list(
+            map(context.enter_context, samples.samples)
+        )
+        _join_clusters(tmpdir, rename, compress, output_, jobs, samples_)
         return data.SampleClusters(
             'joined', output_, output is None
         )
@@ -0,0 +1,127 @@
+import datetime
+from array import array
+from typing import Tuple, List, NamedTuple, Union
+
+import numpy as np
+from scipy import sparse
+
+from pipeline import util
+from pipeline.pampi import data
+
+TSV = 'tsv'
+BIOM = 'biom'
+GENERATED_BY = 'pampi'
+_BIOM_FORMAT = 'http://biom-format.org/documentation/format_versions/biom-2.1.html'
+
+Abundance = NamedTuple('Abundance', [
+    ('observations', List[str]),
+    ('samples', List[str]),
+    # an (observations, samples) matrix of read counts
+    ('counts', sparse.csr_matrix)
+])
+
+
+def cluster_sizes(sample: Union[data.SampleClusters, data.SampleClusterTable]) \
+        -> List[Tuple[str, int]]:
+    """
+    Cluster names and the number of reads in them; member names are not
+    parsed
+    :param sample: the sample is released
+    :return:
+    """
+    with sample:
+        return sample.counts()
+
+
+def abundance(samples: Union[data.MultipleClusters, data.MultipleClusterTables]) \
+        -> Abundance:
+    """
+    Build a sparse cluster (OTU) abundance table. Only clusters with reads in
+    at least one sample are observed; observations are ordered by first
+    appearance.
+    :param samples: missing (None) samples are skipped
+    :return:
+    """
+    observations = {}
+    rows = array('q')
+    columns = array('q')
+    counts = array('q')
+    names = []
+    for column, sample in enumerate(s for s in samples.samples if s is not None):
+        names.append(sample.name)
+        for reference, size in cluster_sizes(sample):
+            if size:
+                rows.append(observations.setdefault(reference, len(observations)))
+                columns.append(column)
+                counts.append(size)
+    # duplicate (observation, sample) entries are summed up
+    matrix = sparse.coo_matrix(
+        (np.frombuffer(counts, dtype=np.int64),
+         (np.frombuffer(rows, dtype=np.int64),
+          np.frombuffer(columns, dtype=np.int64))),
+        shape=(len(observations), len(names))
+    ).tocsr()
+    return Abundance(list(observations), names, matrix)
+
+
+def write_tsv(path: str, table: Abundance):
+    """
+    Write a dense tab-separated table (BIOM's classic TSV layout)
+    :param path:
+    :param table:
+    :return:
+    """
+    with util.RecordWriter(util.compressing(path), path, '{}\n') as buffer:
+        buffer.write(('\t'.join(['#OTU ID', *table.samples]),))
+        for observation, row in zip(table.observations, table.counts):
+            values = row.toarray().ravel().tolist()
+            buffer.write(('\t'.join([observation, *map(str, values)]),))
+
+
+def write_biom(path: str, table: Abundance):
+    """
+    Write a BIOM 2.1 (HDF5) table
+    :param path:
+    :param table:
+    :return:
+    """
+    try:
+        import h5py
+    except ImportError:
+        raise RuntimeError('writing BIOM tables requires h5py')
+    matrix = table.counts
+    strings = h5py.string_dtype()
+    with h5py.File(path, 'w') as biom:
+        biom.attrs['id'] = GENERATED_BY
+        biom.attrs['type'] = 'OTU table'
+        biom.attrs['format-url'] = _BIOM_FORMAT
+        biom.attrs['format-version'] = (2, 1)
+        biom.attrs['generated-by'] = GENERATED_BY
+        biom.attrs['creation-date'] = datetime.datetime.now().isoformat()
+        biom.attrs['shape'] = matrix.shape
+        biom.attrs['nnz'] = matrix.nnz
+        # observations are stored row-wise (CSR), samples column-wise (CSC)
+        for axis, ids, compressed in [('observation', table.observations, matrix),
+                                      ('sample', table.samples, matrix.T.tocsr())]:
+            group = biom.create_group(axis)
+            group.create_dataset('ids', data=ids, dtype=strings)
+            group.create_group('metadata')
+            group.create_group('group-metadata')
+            group.create_dataset('matrix/data',
+                                 data=compressed.data.astype(np.float64))
+            group.create_dataset('matrix/indices',
+                                 data=compressed.indices.astype(np.int32))
+            group.create_dataset('matrix/indptr',
+                                 data=compressed.indptr.astype(np.int32))
+
+
+def write(format_: str, path: str, table: Abundance):
+    if format_ == TSV:
+        return write_tsv(path, table)
+    if format_ == BIOM:
+        return write_biom(path, table)
+    raise ValueError(f'unsupported table format: {format_}')
+
+
+if __name__ == '__main__':
+    raise RuntimeError
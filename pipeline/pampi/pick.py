@@ -1,10 +1,14 @@
+import glob
 import operator as op
 import os
 import re
 import shutil
 import subprocess as sp
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import suppress, contextmanager, ExitStack
 from itertools import groupby, chain
-from typing import Iterable, Optional, List, Union, Tuple
+from typing import Iterable, Optional, List, Union, Tuple, Iterator, Sequence, \
+    BinaryIO
 
 from fn import F
 
@@ -13,6 +17,11 @@ from pipeline import util
 
 CDHIT = 'cd-hit-est-2d'
 SEQID = re.compile('>(.+?)\.\.\.').findall
+# the smallest RAM limit (MB) a cd-hit job can be given
+MINMEMORY = 100
+# pooled reads are tagged with their sample's index: cd-hit truncates read
+# names at the first whitespace character, so tags have to be prefixes
+TAG = '{}_{}'
 
 
 # TODO add an import-time warnings about cd-hit's and/or gzip's absence
@@ -47,6 +56,85 @@ def parse_cdhit_clusters(dropsingle: bool, handle: Iterable[str]) \
     )(handle)
 
 
+def _seqid(line: bytes) -> Optional[bytes]:
+    r"""
+    A bytes equivalent of SEQID
+    :param line:
+    :return:
+    >>> _seqid(b'1\t250nt, >read1... at +/99.60%\n')
+    b'read1'
+    >>> _seqid(b'0\t1500nt, >ref... *')
+    b'ref'
+    """
+    start = line.find(b'>') + 1
+    end = line.find(b'...', start + 1) if start else -1
+    return line[start:end] if end >= 0 else None
+
+
+def _iter_raw_clusters(handle: BinaryIO) -> Iterator[List[bytes]]:
+    """
+    Iterate over sequence identifiers of raw cd-hit clusters; only one
+    cluster is held in memory at a time
+    :param handle: a binary .clstr handle
+    :return:
+    """
+    cluster = []
+    for line in handle:
+        if line.startswith(b'>'):
+            if cluster:
+                yield cluster
+            cluster = []
+        elif line.strip():
+            seqid = _seqid(line)
+            if seqid is None:
+                raise ValueError(f'malformed cd-hit cluster line: {line!r}')
+            cluster.append(seqid)
+    if cluster:
+        yield cluster
+
+
+def write_cdhit_clusters(dropsingle: bool, handle: BinaryIO, out: BinaryIO) \
+        -> data.StatsCollector:
+    """
+    A streaming bytes equivalent of writing `parse_cdhit_clusters` output as
+    tab-separated lines: no strings are decoded and no cluster is
+    materialised beyond a list of its identifiers
+    :param dropsingle: see `parse_cdhit_clusters`
+    :param handle: a binary .clstr handle
+    :param out: a binary output handle
+    :return: statistics of written clusters
+    """
+    stats = data.StatsCollector()
+    for cluster in _iter_raw_clusters(handle):
+        if len(cluster) > 1 or not dropsingle:
+            out.write(b'\t'.join(cluster))
+            out.write(b'\n')
+            stats.add(len(cluster) - 1)
+    return stats
+
+
+def write_cdhit_table(dropsingle: bool, handle: BinaryIO, path: str) \
+        -> data.StatsCollector:
+    """
+    Write raw cd-hit clusters in the SampleClusterTable format: identifiers
+    are copied as bytes, the first one in a cluster being its reference
+    :param dropsingle: see `parse_cdhit_clusters`
+    :param handle: a binary .clstr handle
+    :param path: an .npz destination
+    :return: statistics of written clusters
+    """
+    stats = data.StatsCollector()
+
+    def clusters() -> Iterator[Tuple[bytes, List[bytes]]]:
+        for reference, *reads in _iter_raw_clusters(handle):
+            if reads or not dropsingle:
+                stats.add(len(reads))
+                yield reference, reads
+
+    data.write_cluster_table(path, clusters())
+    return stats
+
+
 # @util.fallible(RuntimeError, sp.CalledProcessError)
 def cdhit(reference: str, accurate: bool, similarity: float, threads: int,
           memory: int, input: Union[Tuple[str], Tuple[str, str]], output: str) \
@@ -87,11 +175,43 @@ def cdhit(reference: str, accurate: bool, similarity: float, threads: int,
     return output, clusters
 
 
+@contextmanager
+def cdhit_clusters(tmpdir: str, input: Union[Tuple[str], Tuple[str, str]],
+                   **cdhit_options) -> Iterator[str]:
+    """
+    Run cdhit with a temporary output destination
+    :param tmpdir:
+    :param input: see `cdhit`
+    :param cdhit_options: see `cdhit`
+    :return: a context manager returning the path to the raw cd-hit
+    clustering file; all temporary cd-hit files are deleted upon exit (even
+    if cd-hit fails)
+    """
+    cdhit_tempout = util.randname(tmpdir, '')
+    try:
+        _, clusterfile = cdhit(input=input, output=cdhit_tempout,
+                               **cdhit_options)
+        yield clusterfile
+    finally:
+        # delete the output, its .clstr file and whatever else cd-hit might
+        # have left behind
+        for path in glob.glob(f'{glob.escape(cdhit_tempout)}*'):
+            with suppress(FileNotFoundError):
+                os.remove(path)
+
+
+def _output(tmpdir: str, outdir: Optional[str], sample: data.SampleFiles,
+            extension: str=util.CLUSTERS) -> str:
+    return (util.randname(tmpdir, f'.{extension}') if outdir is None else
+            os.path.join(outdir, f'{sample.name}.{extension}'))
+
+
 # TODO add a nondesctructive debug mode?
 # TODO we might want to report alignment identities
 # @util.fallible(RuntimeError, FileNotFoundError)
 def cdpick(tmpdir: str, sample: data.SampleFiles, outdir: Optional[str],
-           drop_empty: bool, **cdhit_options) -> Optional[data.SampleClusters]:
+           drop_empty: bool, table: bool=False, **cdhit_options) \
+        -> Optional[Union[data.SampleClusters, data.SampleClusterTable]]:
     """
     A high-level wrapper around cdhit
     TODO improve docs
@@ -99,6 +219,7 @@ def cdpick(tmpdir: str, sample: data.SampleFiles, outdir: Optional[str],
     :param sample:
     :param outdir:
     :param drop_empty:
+    :param table: write a SampleClusterTable instead of tab-separated clusters
     :param cdhit_options:
     :return:
     """
@@ -106,37 +227,239 @@ def cdpick(tmpdir: str, sample: data.SampleFiles, outdir: Optional[str],
         raise ValueError(f'temporary directory {tmpdir} does not exist')
     if len(sample.files) > 2:
         raise ValueError('no more than two read files can be used for picking')
-    output = (util.randname(tmpdir, f'.{util.CLUSTERS}') if outdir is None else
-              os.path.join(outdir, f'{sample.name}.{util.CLUSTERS}'))
-    cdhit_tempout = util.randname(tmpdir, '')
+    output = _output(tmpdir, outdir, sample,
+                     util.TABLE if table else util.CLUSTERS)
     # make sure the files are not compressed
     with sample, util.ungzipped(*sample.files, tmpdir=tmpdir) as reads:
-        seqs, clusterfile = cdhit(input=reads, output=cdhit_tempout,
-                                  **cdhit_options)
-        # parse raw cd-hit clusters and write it into output_
-        with open(clusterfile) as cluster_handle, open(output, 'w') as out:
-            for cluster in parse_cdhit_clusters(drop_empty, cluster_handle):
-                print('\t'.join(cluster), file=out)
-        # delete temporary cd-hit files
-        # TODO these temporary files are not cleaned upon exception
-        os.remove(seqs)
-        os.remove(clusterfile)
+        try:
+            # stream raw cd-hit clusters into output
+            with cdhit_clusters(tmpdir, reads, **cdhit_options) as clusterfile, \
+                    open(clusterfile, 'rb') as cluster_handle:
+                if table:
+                    stats = write_cdhit_table(drop_empty, cluster_handle,
+                                              output)
+                else:
+                    with open(output, 'wb', buffering=util.BUFSIZE) as out:
+                        stats = write_cdhit_clusters(drop_empty,
+                                                     cluster_handle, out)
+            data.write_stats(output, stats.stats())
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.remove(output)
+            raise
         # a specified output destination means that output files can be observed
         # by the callee and their destruction should not be subject to any
         # race conditions
+        if table:
+            return data.SampleClusterTable(sample.name, output,
+                                           delete=outdir is None)
         return data.SampleClusters(sample.name, clusters=output,
                                    delete=outdir is None)
 
 
+def budget(jobs: int, threads: int, memory: int, nsamples: int) \
+        -> Tuple[int, int, int]:
+    """
+    Split a global CPU and RAM budget among concurrent cd-hit jobs. The
+    number of jobs is reduced so that every job gets at least one thread and
+    MINMEMORY megabytes.
+    :param jobs: the maximum number of concurrent jobs
+    :param threads: the total number of threads
+    :param memory: the total RAM limit (MB)
+    :param nsamples: the number of samples to pick
+    :return: the number of concurrent jobs, threads and memory per job
+    >>> budget(4, 8, 1000, 10)
+    (4, 2, 250)
+    >>> budget(4, 8, 1000, 2)
+    (2, 4, 500)
+    >>> budget(8, 4, 250, 10)
+    (2, 2, 125)
+    """
+    jobs = max(1, min(jobs, threads, memory // MINMEMORY, nsamples))
+    return jobs, max(1, threads // jobs), memory // jobs
+
+
+def _release(futures: Iterable[Future]):
+    """
+    Cancel pending jobs, wait for the running ones and release their output
+    :param futures:
+    :return:
+    """
+    futures = list(futures)
+    for future in futures:
+        future.cancel()
+    for future in futures:
+        with suppress(Exception):
+            clusters = future.result()
+            if clusters is not None:
+                clusters.release()
+
+
 # @util.fallible(RuntimeError, FileNotFoundError)
 def cdpick_multiple(tmpdir: str, samples: data.MultipleFasta,
-                    outdir: Optional[str], drop_empty: bool, **cdhit_options) \
-        -> Optional[data.MultipleClusters]:
+                    outdir: Optional[str], drop_empty: bool, threads: int,
+                    memory: int, jobs: int=1, table: bool=False,
+                    **cdhit_options) \
+        -> Optional[Union[data.MultipleClusters, data.MultipleClusterTables]]:
+    """
+    Run cdpick on several samples concurrently
+    :param tmpdir:
+    :param samples:
+    :param outdir:
+    :param drop_empty:
+    :param threads: the total number of threads shared by all cd-hit jobs
+    :param memory: the total RAM limit (MB) shared by all cd-hit jobs
+    :param jobs: the maximum number of concurrent cd-hit jobs; see `budget`
+    :param table: see `cdpick`
+    :param cdhit_options:
+    :return: clusters in sample order; if any job fails, outputs of all other
+    jobs are released
+    """
+    jobs, threads, memory = budget(jobs, threads, memory, len(samples.samples))
+    pick = F(cdpick, tmpdir, outdir=outdir, drop_empty=drop_empty,
+             table=table, threads=threads, memory=memory, **cdhit_options)
+    multiple = data.MultipleClusterTables if table else data.MultipleClusters
+    with ThreadPoolExecutor(jobs) as pool:
+        futures = [pool.submit(pick, sample=sample)
+                   for sample in samples.samples]
+        try:
+            return multiple([future.result() for future in futures])
+        except BaseException:
+            _release(futures)
+            raise
 
-    return data.MultipleClusters([
-        cdpick(tmpdir, sample, outdir, drop_empty, **cdhit_options)
-        for sample in samples.samples
-    ])
+
+def tag_records(index: int, records: Iterable[Tuple]) -> Iterator[Tuple]:
+    """
+    Prefix record names with a sample index
+    :param index:
+    :param records: (name, *rest) tuples
+    :return:
+    >>> list(tag_records(3, [('read1 x', 'ACGT'), ('read2', 'AC')]))
+    [('3_read1 x', 'ACGT'), ('3_read2', 'AC')]
+    """
+    return ((TAG.format(index, name), *rest) for name, *rest in records)
+
+
+def split_clusters(nsamples: int, clusters: Iterable[List[str]]) \
+        -> Iterator[List[List[str]]]:
+    """
+    Split clusters of pooled reads tagged by `tag_records` into one cluster
+    per sample; the reference (the first sequence in a cluster) is kept in
+    each of them
+    :param nsamples:
+    :param clusters:
+    :return:
+    >>> clusters = [['ref1', '0_a', '1_b', '0_c_1'], ['ref2']]
+    >>> list(split_clusters(2, clusters)) == [
+    ...     [['ref1', 'a', 'c_1'], ['ref1', 'b']],
+    ...     [['ref2'], ['ref2']]
+    ... ]
+    True
+    """
+    for reference, *seqids in clusters:
+        split = [[reference] for _ in range(nsamples)]
+        for seqid in seqids:
+            index, name = seqid.split('_', 1)
+            split[int(index)].append(name)
+        yield split
+
+
+@contextmanager
+def pooled(tmpdir: str, samples: Sequence[data.SampleFiles]) \
+        -> Iterator[Tuple[str, ...]]:
+    """
+    Tag and concatenate sample reads into uncompressed temporary files
+    :param tmpdir:
+    :param samples: samples of the same type
+    :return: a context manager returning a pooled FASTA, a pooled FASTQ or a
+    pair of pooled FASTQ files; the files are deleted upon exit
+    """
+    paths = []
+    try:
+        if all(isinstance(sample, data.SamplePairedFastq) for sample in samples):
+            paths.extend(util.randname(tmpdir, f'_{mate}.{util.FASTQ}')
+                         for mate in ('R1', 'R2'))
+            with util.RecordWriter(False, paths[0], util.FASTQ_TEMPLATE) as fbuffer, \
+                    util.RecordWriter(False, paths[1], util.FASTQ_TEMPLATE) as rbuffer:
+                for index, sample in enumerate(samples):
+                    for (fname, *fwd), (rname, *rev) in sample.iter_records():
+                        fbuffer.write((TAG.format(index, fname), *fwd))
+                        rbuffer.write((TAG.format(index, rname), *rev))
+        else:
+            if all(isinstance(sample, data.SampleFastq) for sample in samples):
+                extension, template = util.FASTQ, util.FASTQ_TEMPLATE
+            elif all(isinstance(sample, data.SampleFasta) for sample in samples):
+                extension, template = util.FASTA, util.FASTA_TEMPLATE
+            else:
+                raise ValueError('samples must be of the same type to be pooled')
+            paths.append(util.randname(tmpdir, f'.{extension}'))
+            with util.RecordWriter(False, paths[0], template) as buffer:
+                for index, sample in enumerate(samples):
+                    buffer.writemany(tag_records(index, sample.iter_records()))
+        yield tuple(paths)
+    finally:
+        for path in paths:
+            with suppress(FileNotFoundError):
+                os.remove(path)
+
+
+# @util.fallible(RuntimeError, FileNotFoundError)
+def cdpick_pooled(tmpdir: str, samples: data.MultipleFasta,
+                  outdir: Optional[str], drop_empty: bool, **cdhit_options) \
+        -> Optional[data.MultipleClusters]:
+    """
+    Pick all samples in a single cd-hit run: reads are tagged with their
+    sample's index and pooled, hence the reference is loaded and indexed only
+    once. The pooled clusters are split back into one SampleClusters per
+    sample. The output is the same as that of `cdpick_multiple`: cd-hit-est-2d
+    assigns every read to a reference independently of other reads.
+    :param tmpdir:
+    :param samples:
+    :param outdir:
+    :param drop_empty:
+    :param cdhit_options: see `cdhit`; the pooled run gets all threads and
+    memory
+    :return:
+    """
+    if not os.path.exists(tmpdir):
+        raise ValueError(f'temporary directory {tmpdir} does not exist')
+    samples_ = samples.samples
+    if not samples_:
+        return data.MultipleClusters([])
+    outputs = [_output(tmpdir, outdir, sample) for sample in samples_]
+    with ExitStack() as context:
+        for sample in samples_:
+            context.enter_context(sample)
+        try:
+            with pooled(tmpdir, samples_) as reads, \
+                    cdhit_clusters(tmpdir, reads, **cdhit_options) as clusterfile, \
+                    open(clusterfile) as cluster_handle, ExitStack() as handles:
+                outs = [handles.enter_context(util.RecordWriter(
+                            False, output, util.CLUSTERS_TEMPLATE
+                        )) for output in outputs]
+                stats = [data.StatsCollector() for _ in outputs]
+                clusters = split_clusters(
+                    len(samples_), parse_cdhit_clusters(False, cluster_handle)
+                )
+                for split in clusters:
+                    for cluster, out, stats_ in zip(split, outs, stats):
+                        # singletons are references with no sequences
+                        if len(cluster) > 1 or not drop_empty:
+                            out.write(('\t'.join(cluster),))
+                            stats_.add(len(cluster) - 1)
+            for output, stats_ in zip(outputs, stats):
+                data.write_stats(output, stats_.stats())
+        except BaseException:
+            for output in outputs:
+                with suppress(FileNotFoundError):
+                    os.remove(output)
+            raise
+        return data.MultipleClusters([
+            data.SampleClusters(sample.name, clusters=output,
+                                delete=outdir is None)
+            for sample, output in zip(samples_, outputs)
+        ])
 
 
 if __name__ == '__main__':
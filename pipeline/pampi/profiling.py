@@ -0,0 +1,128 @@
+import csv
+import json
+import os
+import resource
+import time
+from typing import Callable, List, NamedTuple, Tuple, Any
+
+from pipeline import core
+from pipeline.pampi import data
+
+# report formats are chosen by the destination's extension
+JSON = '.json'
+
+Stage = NamedTuple('Stage', [
+    ('stage', str),
+    ('map', str),
+    ('wall_time', float),
+    ('cpu_time', float),
+    ('peak_rss', int),
+    ('peak_rss_children', int),
+    ('records_in', int),
+    ('records_out', int),
+    ('bytes_in', int),
+    ('bytes_out', int)
+])
+
+
+def _cputime() -> float:
+    """
+    CPU time consumed by the process and all its waited-for children (cd-hit,
+    worker processes, etc.)
+    """
+    user, system, children_user, children_system, _ = os.times()
+    return user + system + children_user + children_system
+
+
+def _peak_rss(who: int) -> int:
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss * 1024
+
+
+def measure(value: Any) -> Tuple[int, int]:
+    """
+    Count records and bytes held by a sample or a collection of samples.
+    Records are counted by scanning the files (unless there are count
+    sidecars), hence measurements take time and are not included in the
+    timing of a stage.
+    :param value: a SampleFiles instance, a Multiple* collection or None
+    :return: the number of records and the total size of underlying files
+    """
+    if value is None:
+        return 0, 0
+    if isinstance(value, data.SampleFiles):
+        if value.released:
+            return 0, 0
+        return (value.count(),
+                sum(map(os.path.getsize, value.files)))
+    samples = getattr(value, 'samples', None)
+    if samples is None:
+        return 0, 0
+    measurements = list(map(measure, samples))
+    return (sum(records for records, _ in measurements),
+            sum(nbytes for _, nbytes in measurements))
+
+
+class Profiler:
+    """
+    Opt-in per-stage instrumentation. Router maps are wrapped before they are
+    compiled, hence every stage of a composed `>>` chain reports separately.
+    """
+
+    def __init__(self):
+        self._stages: List[Stage] = []
+
+    @property
+    def stages(self) -> List[Stage]:
+        return list(self._stages)
+
+    def instrument(self, router: core.Router) -> core.Router:
+        """
+        Wrap all maps of a router
+        :param router:
+        :return:
+        """
+        return core.Router(router.name, [
+            core.Map(m.domain, m.codomain, self._wrap(router.name, m), m.cost)
+            for m in router.maps
+        ])
+
+    def _wrap(self, name: str, m: core.Map) -> Callable:
+
+        def profiled(value):
+            records_in, bytes_in = measure(value)
+            wall_start, cpu_start = time.perf_counter(), _cputime()
+            output = m(value)
+            wall_time = time.perf_counter() - wall_start
+            cpu_time = _cputime() - cpu_start
+            records_out, bytes_out = measure(output)
+            self._stages.append(Stage(
+                name, repr(m), wall_time, cpu_time,
+                _peak_rss(resource.RUSAGE_SELF),
+                _peak_rss(resource.RUSAGE_CHILDREN),
+                records_in, records_out, bytes_in, bytes_out
+            ))
+            return output
+
+        return profiled
+
+    def report(self, path: str):
+        """
+        Write the report as JSON (for paths ending with .json) or TSV.
+        Peak RSS values are high-water marks since the process started, i.e.
+        a stage reports the peak of all stages up to and including itself.
+        :param path:
+        :return:
+        """
+        with open(path, 'w') as handle:
+            if path.endswith(JSON):
+                json.dump([stage._asdict() for stage in self._stages], handle,
+                          indent=2)
+                return
+            writer = csv.writer(handle, delimiter='\t', lineterminator='\n')
+            writer.writerow(Stage._fields)
+            writer.writerows(self._stages)
+
+
+if __name__ == '__main__':
+    raise RuntimeError
@@ -0,0 +1,699 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from typing import List, NamedTuple, Optional, Iterator, Tuple, Iterable
+
+import numba as nb
+import numpy as np
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from fn import F
+
+from pipeline import util, fastq
+from pipeline.pampi import data, trim
+
+# the number of reads assigned in a single kernel call
+CHUNKSIZE = 10000
+# cd-hit's default band width
+BAND = 20
+# cd-hit-est scoring with a linear gap penalty
+MATCH = 2
+MISMATCH = -2
+GAP = -6
+# cd-hit-est's recommended word sizes: (the lowest similarity, word size)
+WORDSIZES = [(0.95, 10), (0.9, 9), (0.88, 8), (0.85, 7), (0.8, 6), (0.75, 5)]
+MINWORDSIZE = 4
+# index cache defaults: the total size (bytes) and the age (seconds) of
+# unused entries
+CACHESIZE = 10 * 2**30
+CACHEAGE = 30 * 24 * 3600
+# bump whenever the on-disk index layout changes
+CACHEFORMAT = 1
+_ARRAYS = ['buffer', 'offsets', 'ranks', 'word_offsets', 'postings_ref',
+           'postings_pos']
+_NAMES = 'names.txt'
+_META = 'meta.json'
+# memoised reference digests
+_DIGESTS = '.digests'
+
+# nucleotide codes: A, C, G, T(U) -> 0, 1, 2, 3; anything else -> 4
+_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _bases in enumerate(['Aa', 'Cc', 'Gg', 'TtUu']):
+    _CODES[list(map(ord, _bases))] = _code
+_NEG = -(1 << 30)
+
+
+ReferenceIndex = NamedTuple('ReferenceIndex', [
+    ('names', List[str]),
+    ('wordsize', int),
+    # encoded reference sequences and their [start, end) offsets
+    ('buffer', np.ndarray),
+    ('offsets', np.ndarray),
+    # positions of references sorted by decreasing length (stable)
+    ('ranks', np.ndarray),
+    # references and positions of every word, grouped by word: occurrences of
+    # word w are stored in [word_offsets[w], word_offsets[w+1])
+    ('word_offsets', np.ndarray),
+    ('postings_ref', np.ndarray),
+    ('postings_pos', np.ndarray)
+])
+
+
+def wordsize(similarity: float) -> int:
+    """
+    :param similarity:
+    :return:
+    >>> wordsize(0.97), wordsize(0.9), wordsize(0.5)
+    (10, 9, 4)
+    """
+    return next((size for lowest, size in WORDSIZES if similarity >= lowest),
+                MINWORDSIZE)
+
+
+def seqid(name: str) -> str:
+    """
+    Sequence identifier as reported by cd-hit, i.e. everything up to the first
+    whitespace character
+    :param name:
+    :return:
+    >>> seqid('read1 extra'), seqid('')
+    ('read1', '')
+    """
+    return next(iter(name.split()), '')
+
+
+def encode(seqs: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pack sequences into a contiguous buffer of nucleotide codes
+    :param seqs:
+    :return: the buffer and [start, end) offsets of each sequence
+    """
+    buffer, offsets = trim.pack(seqs)
+    return _CODES[buffer], offsets
+
+
+@nb.jit(nopython=True, nogil=True)
+def words(codes: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Extract all k-letter words (2 bits per base) without ambiguous bases
+    :param codes: nucleotide codes
+    :param k:
+    :return: words and their positions
+    """
+    n = max(len(codes) - k + 1, 0)
+    kmers = np.empty(n, dtype=np.int64)
+    positions = np.empty(n, dtype=np.int64)
+    mask = (1 << (2 * k)) - 1
+    nwords = 0
+    kmer = 0
+    valid = 0
+    for i in range(len(codes)):
+        if codes[i] > 3:
+            valid = 0
+            kmer = 0
+            continue
+        kmer = ((kmer << 2) | codes[i]) & mask
+        valid += 1
+        if valid >= k:
+            kmers[nwords] = kmer
+            positions[nwords] = i - k + 1
+            nwords += 1
+    return kmers[:nwords], positions[:nwords]
+
+
+def build_index(reference: str, similarity: float) -> ReferenceIndex:
+    """
+    Build a word index over reference sequences
+    :param reference: a FASTA or FASTQ file (possibly compressed)
+    :param similarity: similarity threshold used to select the word size
+    :return:
+    """
+    with util.gzread(reference) as handle:
+        isfastq = handle.read(1) == '@'
+    if isfastq:
+        records = [(name, seq) for name, seq, _ in fastq.parse(reference)]
+    else:
+        with util.gzread(reference) as handle:
+            records = list(SimpleFastaParser(handle))
+    k = wordsize(similarity)
+    names = [seqid(name) for name, _ in records]
+    buffer, offsets = encode([seq for _, seq in records])
+    lengths = np.diff(offsets)
+    ranks = np.empty(len(records), dtype=np.int64)
+    ranks[np.argsort(-lengths, kind='stable')] = np.arange(len(records))
+    extracted = [words(buffer[start:end], k)
+                 for start, end in zip(offsets[:-1], offsets[1:])]
+    kmers = np.concatenate([kmers for kmers, _ in extracted] +
+                           [np.empty(0, dtype=np.int64)])
+    positions = np.concatenate([pos for _, pos in extracted] +
+                               [np.empty(0, dtype=np.int64)])
+    refs = np.repeat(np.arange(len(records)), [len(pos) for _, pos in extracted])
+    # a stable sort keeps occurrences of a word ordered by reference
+    order = np.argsort(kmers, kind='stable')
+    word_offsets = np.zeros(4**k + 1, dtype=np.int64)
+    np.cumsum(np.bincount(kmers, minlength=4**k), out=word_offsets[1:])
+    return ReferenceIndex(names, k, buffer, offsets, ranks, word_offsets,
+                          refs[order].astype(np.int32),
+                          positions[order].astype(np.int32))
+
+
+@nb.jit(nopython=True, nogil=True)
+def banded(read: np.ndarray, ref: np.ndarray, diagonal: int, band: int) -> int:
+    """
+    Align a read end-to-end to a region of a reference within a band around a
+    diagonal (reference position - read position). Gaps at both ends of the
+    reference are free.
+    :param read: nucleotide codes
+    :param ref: nucleotide codes
+    :param diagonal:
+    :param band:
+    :return: the number of identical bases in the best alignment
+    """
+    n = len(read)
+    m = len(ref)
+    width = 2 * band + 1
+    offset = diagonal - band
+    score_prev = np.full(width, _NEG, dtype=np.int64)
+    match_prev = np.zeros(width, dtype=np.int64)
+    score = np.full(width, _NEG, dtype=np.int64)
+    match = np.zeros(width, dtype=np.int64)
+    for d in range(width):
+        if 0 <= offset + d <= m:
+            score_prev[d] = 0
+    for i in range(1, n + 1):
+        for d in range(width):
+            j = i + offset + d
+            score[d] = _NEG
+            match[d] = 0
+            if j < 0 or j > m:
+                continue
+            if j >= 1 and score_prev[d] > _NEG:
+                same = read[i-1] == ref[j-1] and read[i-1] < 4
+                score[d] = score_prev[d] + (MATCH if same else MISMATCH)
+                match[d] = match_prev[d] + same
+            if d + 1 < width and score_prev[d+1] > _NEG:
+                candidate = score_prev[d+1] + GAP
+                if candidate > score[d] or (candidate == score[d] and
+                                            match_prev[d+1] > match[d]):
+                    score[d] = candidate
+                    match[d] = match_prev[d+1]
+            if d >= 1 and j >= 1 and score[d-1] > _NEG:
+                candidate = score[d-1] + GAP
+                if candidate > score[d] or (candidate == score[d] and
+                                            match[d-1] > match[d]):
+                    score[d] = candidate
+                    match[d] = match[d-1]
+        score_prev, score = score, score_prev
+        match_prev, match = match, match_prev
+    best = _NEG
+    identical = 0
+    for d in range(width):
+        if score_prev[d] > best or (score_prev[d] == best and
+                                    match_prev[d] > identical):
+            best = score_prev[d]
+            identical = match_prev[d]
+    return identical if best > _NEG else 0
+
+
+@nb.jit(nopython=True, nogil=True)
+def revcomp(codes: np.ndarray) -> np.ndarray:
+    complement = np.empty_like(codes)
+    n = len(codes)
+    for i in range(n):
+        complement[n-1-i] = 3 - codes[i] if codes[i] < 4 else 4
+    return complement
+
+
+@nb.jit(nopython=True, nogil=True)
+def passing(read: np.ndarray, buffer: np.ndarray, offsets: np.ndarray,
+            ranks: np.ndarray, word_offsets: np.ndarray,
+            postings_ref: np.ndarray, postings_pos: np.ndarray, k: int,
+            maxlen: int, similarity: float, band: int, first: bool,
+            counts: np.ndarray, runs: np.ndarray, modes: np.ndarray) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find references a read is similar to. Candidates must share enough words
+    with the read (cd-hit's short word filter) and be at least as long as the
+    read (cd-hit-est-2d's default). Candidates are verified by a banded
+    alignment around their most common word diagonal in the order of their
+    ranks.
+    :param read: nucleotide codes
+    :param buffer: see ReferenceIndex
+    :param offsets: see ReferenceIndex
+    :param ranks: see ReferenceIndex
+    :param word_offsets: see ReferenceIndex
+    :param postings_ref: see ReferenceIndex
+    :param postings_pos: see ReferenceIndex
+    :param k: word size
+    :param maxlen: the length of the longest reference
+    :param similarity:
+    :param band:
+    :param first: stop at the first reference meeting the threshold
+    :param counts: a zeroed workspace array with an element per reference
+    :param runs: a zeroed workspace array with an element per reference
+    :param modes: a workspace array with an element per reference
+    :return: references meeting the threshold (ordered by rank) and the number
+    of identical bases in their alignments; workspaces are zeroed upon return
+    """
+    length = len(read)
+    kmers, positions = words(read, k)
+    touched = np.empty(len(offsets), dtype=np.int64)
+    ntouched = 0
+    for i in range(len(kmers)):
+        previous = -1
+        for p in range(word_offsets[kmers[i]], word_offsets[kmers[i]+1]):
+            ref = postings_ref[p]
+            # a word is counted once per reference
+            if ref == previous:
+                continue
+            previous = ref
+            if counts[ref] == 0:
+                touched[ntouched] = ref
+                ntouched += 1
+            counts[ref] += 1
+    # each mismatch can destroy up to k words
+    threshold = max(
+        1, length - k + 1 - int(np.ceil((1 - similarity) * length)) * k
+    )
+    candidates = np.empty(ntouched, dtype=np.int64)
+    ncandidates = 0
+    for t in range(ntouched):
+        ref = touched[t]
+        if (counts[ref] >= threshold and
+                offsets[ref+1] - offsets[ref] >= length):
+            candidates[ncandidates] = ref
+            ncandidates += 1
+            # mark candidates
+            counts[ref] = -1
+        else:
+            counts[ref] = 0
+    candidates = candidates[:ncandidates]
+    # find the most common diagonal of each candidate: encode (reference,
+    # diagonal) pairs as integers and count runs of equal keys
+    span = length + maxlen + 1
+    nkeys = 0
+    for i in range(len(kmers) if ncandidates else 0):
+        for p in range(word_offsets[kmers[i]], word_offsets[kmers[i]+1]):
+            nkeys += counts[postings_ref[p]] == -1
+    keys = np.empty(nkeys, dtype=np.int64)
+    nkeys = 0
+    for i in range(len(kmers) if ncandidates else 0):
+        for p in range(word_offsets[kmers[i]], word_offsets[kmers[i]+1]):
+            ref = postings_ref[p]
+            if counts[ref] == -1:
+                keys[nkeys] = ref * span + postings_pos[p] - positions[i] + length
+                nkeys += 1
+    keys.sort()
+    run = 0
+    for i in range(nkeys):
+        run = run + 1 if i and keys[i] == keys[i-1] else 1
+        ref = keys[i] // span
+        if run > runs[ref]:
+            runs[ref] = run
+            modes[ref] = keys[i] % span - length
+    for ref in candidates:
+        counts[ref] = 0
+        runs[ref] = 0
+    # verify candidates in the order of their ranks
+    candidates = candidates[np.argsort(ranks[candidates])]
+    refs = np.empty(ncandidates, dtype=np.int64)
+    identical = np.empty(ncandidates, dtype=np.int64)
+    npassing = 0
+    for ref in candidates:
+        matches = banded(read, buffer[offsets[ref]:offsets[ref+1]], modes[ref],
+                         band)
+        if length and matches / length >= similarity:
+            refs[npassing] = ref
+            identical[npassing] = matches
+            npassing += 1
+            if first:
+                break
+    return refs[:npassing], identical[:npassing]
+
+
+@nb.jit(nopython=True, nogil=True)
+def assign(fbuffer: np.ndarray, foffsets: np.ndarray, rbuffer: np.ndarray,
+           roffsets: np.ndarray, paired: bool, buffer: np.ndarray,
+           offsets: np.ndarray, ranks: np.ndarray, word_offsets: np.ndarray,
+           postings_ref: np.ndarray, postings_pos: np.ndarray, k: int,
+           similarity: float, accurate: bool, band: int) -> np.ndarray:
+    """
+    Assign reads (or read pairs) to references. Both strands are tried. In
+    the fast mode a read is assigned to the first reference (by rank) meeting
+    the threshold, in the accurate mode it is assigned to the most similar
+    one. Both mates of a pair must meet the threshold with the same
+    reference; their similarity is the combined identity.
+    :param fbuffer: nucleotide codes of reads (forward mates)
+    :param foffsets:
+    :param rbuffer: nucleotide codes of reverse mates (ignored unless paired)
+    :param roffsets:
+    :param paired:
+    :param buffer: see ReferenceIndex
+    :param offsets:
+    :param ranks:
+    :param word_offsets:
+    :param postings_ref:
+    :param postings_pos:
+    :param k:
+    :param similarity:
+    :param accurate:
+    :param band:
+    :return: reference indices (-1 for reads meeting no reference)
+    """
+    nrefs = len(offsets) - 1
+    maxlen = np.max(np.diff(offsets)) if nrefs else 0
+    counts = np.zeros(nrefs, dtype=np.int64)
+    runs = np.zeros(nrefs, dtype=np.int64)
+    modes = np.zeros(nrefs, dtype=np.int64)
+    # the best number of identical bases of forward mates
+    mates = np.full(nrefs, -1, dtype=np.int64)
+    # pairs need an exhaustive search to intersect mate candidates
+    first = not (accurate or paired)
+    assignments = np.full(len(foffsets) - 1, -1, dtype=np.int64)
+    for i in range(len(foffsets) - 1):
+        read = fbuffer[foffsets[i]:foffsets[i+1]]
+        best = -1
+        best_matches = -1
+        # references meeting the threshold with a forward mate
+        hits = np.empty(0, dtype=np.int64)
+        for seq in (read, revcomp(read)):
+            refs, identical = passing(
+                seq, buffer, offsets, ranks, word_offsets, postings_ref,
+                postings_pos, k, maxlen, similarity, band, first, counts,
+                runs, modes
+            )
+            if paired:
+                hits = np.concatenate((hits, refs))
+            for ref, matches in zip(refs, identical):
+                if paired:
+                    mates[ref] = max(mates[ref], matches)
+                elif best < 0 or (
+                        matches > best_matches if accurate else
+                        ranks[ref] < ranks[best]):
+                    best = ref
+                    best_matches = matches
+        if not paired:
+            assignments[i] = best
+            continue
+        mate = rbuffer[roffsets[i]:roffsets[i+1]]
+        for seq in (mate, revcomp(mate)):
+            refs, identical = passing(
+                seq, buffer, offsets, ranks, word_offsets, postings_ref,
+                postings_pos, k, maxlen, similarity, band, False, counts,
+                runs, modes
+            )
+            for ref, matches in zip(refs, identical):
+                if mates[ref] < 0:
+                    continue
+                matches += mates[ref]
+                if best < 0 or (
+                        matches > best_matches or (
+                            matches == best_matches and
+                            ranks[ref] < ranks[best])
+                        if accurate else ranks[ref] < ranks[best]):
+                    best = ref
+                    best_matches = matches
+        assignments[i] = best
+        # reset the workspace
+        for ref in hits:
+            mates[ref] = -1
+    return assignments
+
+
+def _assign_chunk(index: ReferenceIndex, similarity: float, accurate: bool,
+                  chunk: List[Tuple[str, str, Optional[str]]]) -> np.ndarray:
+    fbuffer, foffsets = encode([seq for _, seq, _ in chunk])
+    paired = bool(chunk) and chunk[0][2] is not None
+    rbuffer, roffsets = (
+        encode([mate for _, _, mate in chunk]) if paired else
+        (np.empty(0, dtype=np.uint8), np.zeros(1, dtype=np.int64))
+    )
+    return assign(fbuffer, foffsets, rbuffer, roffsets, paired, index.buffer,
+                  index.offsets, index.ranks, index.word_offsets,
+                  index.postings_ref, index.postings_pos, index.wordsize,
+                  similarity, accurate, BAND)
+
+
+def _reads(sample: data.SampleFiles) -> Iterator[Tuple[str, str, Optional[str]]]:
+    """
+    Iterate over (name, sequence, mate sequence or None)
+    """
+    if isinstance(sample, data.SamplePairedFastq):
+        return ((fwd[0], fwd[1], rev[1]) for fwd, rev in sample.iter_records())
+    return ((name, seq, None) for name, seq, *_ in sample.iter_records())
+
+
+def clusters(index: ReferenceIndex, similarity: float, accurate: bool,
+             threads: int, reads: Iterable[Tuple[str, str, Optional[str]]]) \
+        -> List[List[str]]:
+    """
+    Assign reads to references
+    :param index:
+    :param similarity:
+    :param accurate:
+    :param threads: the number of threads running the jitted kernel
+    :param reads: (name, sequence, mate sequence or None)
+    :return: a cluster per reference (in reference order): the reference
+    name followed by names of reads assigned to it (in read order)
+    """
+    clusters_ = [[name] for name in index.names]
+    chunks = util.chunked(CHUNKSIZE, reads)
+    with ThreadPoolExecutor(threads) as pool:
+        # chunks are materialised one step ahead of the kernel
+        pending = []
+        for chunk in chunks:
+            pending.append(
+                (chunk, pool.submit(_assign_chunk, index, similarity, accurate,
+                                    chunk))
+            )
+            if len(pending) > threads:
+                chunk_, future = pending.pop(0)
+                _collect(clusters_, chunk_, future.result())
+        for chunk_, future in pending:
+            _collect(clusters_, chunk_, future.result())
+    return clusters_
+
+
+def _collect(clusters_: List[List[str]], chunk: List[Tuple],
+             assignments: np.ndarray):
+    for (name, *_), ref in zip(chunk, assignments.tolist()):
+        if ref >= 0:
+            clusters_[ref].append(seqid(name))
+
+
+def digest(reference: str) -> str:
+    """
+    :param reference:
+    :return: a content hash of the reference
+    """
+    digest_ = hashlib.blake2b(digest_size=20)
+    with open(reference, 'rb') as buffer:
+        for block in iter(lambda: buffer.read(util.BUFSIZE), b''):
+            digest_.update(block)
+    return digest_.hexdigest()
+
+
+def _dirsize(path: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(path)
+               if entry.is_file())
+
+
+class IndexCache:
+    """
+    A directory of reference indices stored as raw NumPy arrays. Entries are
+    keyed by the reference's content hash and the word size and loaded as
+    read-only memory maps. Content hashes are memoised by the reference's
+    real path, size and modification time, hence only new or modified
+    references are read in full. Entries unused for longer than `maxage`
+    seconds are evicted, as well as least recently used entries once the
+    total size exceeds `maxsize` bytes.
+    """
+
+    def __init__(self, root: str, maxsize: int=CACHESIZE, maxage: int=CACHEAGE):
+        os.makedirs(os.path.join(root, _DIGESTS), exist_ok=True)
+        self._root = root
+        self._maxsize = maxsize
+        self._maxage = maxage
+
+    @property
+    def root(self) -> str:
+        return self._root
+
+    def key(self, reference: str, k: int) -> str:
+        """
+        :param reference:
+        :param k: word size
+        :return: a key identifying an index
+        """
+        return f'{self.digest(reference)}-k{k}-v{CACHEFORMAT}'
+
+    def digest(self, reference: str) -> str:
+        """
+        A memoised `digest`
+        :param reference:
+        :return:
+        """
+        stat = os.stat(reference)
+        signature = (f'{os.path.realpath(reference)}\0{stat.st_size}\0'
+                     f'{stat.st_mtime_ns}')
+        memo = os.path.join(
+            self._root, _DIGESTS,
+            hashlib.blake2b(signature.encode(), digest_size=20).hexdigest()
+        )
+        with suppress(FileNotFoundError):
+            with open(memo) as buffer:
+                digest_ = buffer.read()
+            # the modification time of a memo marks its last use
+            os.utime(memo)
+            return digest_
+        digest_ = digest(reference)
+        # concurrent runs might be memoising the same digest
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(memo),
+                                         prefix='.', delete=False) as buffer:
+            buffer.write(digest_)
+        os.replace(buffer.name, memo)
+        return digest_
+
+    def load(self, reference: str, similarity: float) -> ReferenceIndex:
+        """
+        Load an index from the cache, building and storing it on a miss
+        :param reference:
+        :param similarity:
+        :return:
+        """
+        key = self.key(reference, wordsize(similarity))
+        path = os.path.join(self._root, key)
+        if not os.path.exists(path):
+            self._store(path, build_index(reference, similarity))
+        # the modification time of an entry marks its last use
+        os.utime(path)
+        index = self._load(path)
+        self.evict(keep=key)
+        return index
+
+    @staticmethod
+    def _load(path: str) -> ReferenceIndex:
+        with open(os.path.join(path, _META)) as meta, \
+                open(os.path.join(path, _NAMES)) as names:
+            k = json.load(meta)['wordsize']
+            names_ = names.read().split('\n')[:-1]
+        arrays = {
+            name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+            for name in _ARRAYS
+        }
+        return ReferenceIndex(names=names_, wordsize=k, **arrays)
+
+    def _store(self, path: str, index: ReferenceIndex):
+        # build the entry next to its destination and move it atomically:
+        # concurrent runs might be storing the same entry
+        staging = tempfile.mkdtemp(dir=self._root, prefix='.')
+        try:
+            for name in _ARRAYS:
+                np.save(os.path.join(staging, f'{name}.npy'),
+                        getattr(index, name))
+            with open(os.path.join(staging, _NAMES), 'w') as names:
+                names.writelines(f'{name}\n' for name in index.names)
+            with open(os.path.join(staging, _META), 'w') as meta:
+                json.dump({'wordsize': index.wordsize}, meta)
+            with suppress(OSError):
+                os.rename(staging, path)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def evict(self, keep: Optional[str]=None):
+        """
+        Remove stale entries and memoised digests, then least recently used
+        entries until the cache fits into its size limit
+        :param keep: an entry to keep regardless of the limits
+        :return:
+        """
+        entries = sorted(
+            (entry for entry in os.scandir(self._root)
+             if entry.is_dir() and not entry.name.startswith('.')),
+            key=lambda entry: entry.stat().st_mtime, reverse=True
+        )
+        now = time.time()
+        total = 0
+        for entry in entries:
+            size = _dirsize(entry.path)
+            stale = now - entry.stat().st_mtime > self._maxage
+            if entry.name != keep and (stale or total + size > self._maxsize):
+                shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            total += size
+        for entry in os.scandir(os.path.join(self._root, _DIGESTS)):
+            if now - entry.stat().st_mtime > self._maxage:
+                with suppress(FileNotFoundError):
+                    os.remove(entry.path)
+
+
+def load_index(reference: str, similarity: float,
+               cache: Optional[IndexCache]=None) -> ReferenceIndex:
+    return (build_index(reference, similarity) if cache is None else
+            cache.load(reference, similarity))
+
+
+def refpick(tmpdir: str, sample: data.SampleFiles, outdir: Optional[str],
+            drop_empty: bool, reference: str, accurate: bool,
+            similarity: float, threads: int, index: Optional[ReferenceIndex]=None,
+            cache: Optional[IndexCache]=None, **_) \
+        -> Optional[data.SampleClusters]:
+    """
+    An in-process alternative to `pick.cdpick`: reads are assigned to
+    references using a word index over the reference and banded alignments.
+    The output format is the same.
+    :param tmpdir:
+    :param sample:
+    :param outdir:
+    :param drop_empty: drop references with no reads
+    :param reference:
+    :param accurate: assign reads to the most similar reference instead of the
+    first one (by decreasing length) meeting the threshold
+    :param similarity:
+    :param threads:
+    :param index: a prebuilt index over the reference
+    :param cache: an index cache to use unless `index` is provided
+    :param _: other cd-hit options (e.g. memory) are ignored
+    :return:
+    """
+    if not os.path.exists(tmpdir):
+        raise ValueError(f'temporary directory {tmpdir} does not exist')
+    if index is None:
+        index = load_index(reference, similarity, cache)
+    output = (util.randname(tmpdir, f'.{util.CLUSTERS}') if outdir is None else
+              os.path.join(outdir, f'{sample.name}.{util.CLUSTERS}'))
+    with sample:
+        clusters_ = clusters(index, similarity, accurate, threads,
+                             _reads(sample))
+        stats = data.StatsCollector()
+        with util.RecordWriter(False, output,
+                               util.CLUSTERS_TEMPLATE) as buffer:
+            for cluster in clusters_:
+                if len(cluster) > 1 or not drop_empty:
+                    buffer.write(('\t'.join(cluster),))
+                    stats.add(len(cluster) - 1)
+        data.write_stats(output, stats.stats())
+        return data.SampleClusters(sample.name, clusters=output,
+                                   delete=outdir is None)
+
+
+def refpick_multiple(tmpdir: str, samples: data.MultipleFasta,
+                     outdir: Optional[str], drop_empty: bool, reference: str,
+                     similarity: float, **options) \
+        -> Optional[data.MultipleClusters]:
+    """
+    Run `refpick` on several samples sharing a single reference index
+    """
+    index = load_index(reference, similarity, options.pop('cache', None))
+    pick = F(refpick, tmpdir, outdir=outdir, drop_empty=drop_empty,
+             reference=reference, similarity=similarity, index=index, **options)
+    return data.MultipleClusters([pick(sample=sample)
+                                  for sample in samples.samples])
+
+
+if __name__ == '__main__':
+    raise RuntimeError
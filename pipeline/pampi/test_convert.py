@@ -0,0 +1,58 @@
+import os
+import tempfile
+
+import numpy as np
+
+from pipeline.pampi import convert, data
+
+CLUSTERS = [
+    'ref1\tr1\tr2\tr3\n',
+    # an empty cluster
+    'ref2\n',
+    'ref3\tr4\n'
+]
+
+
+def _roundtrip(tmpdir: str, contents: str) -> data.SampleClusterTable:
+    path = os.path.join(tmpdir, 'sample.clstr')
+    with open(path, 'w') as handle:
+        handle.write(contents)
+    outdir = tempfile.mkdtemp(dir=tmpdir)
+    sample = data.SampleClusters('sample', path, delete=False)
+    table = convert.to_table(tmpdir, outdir, sample)
+    # conversion releases its input, hence a fresh handle is needed to convert
+    # the table back
+    tsv = convert.to_tsv(tmpdir, outdir, data.SampleClusterTable(
+        'sample', table.table, delete=False
+    ))
+    with open(tsv.clusters) as handle:
+        assert handle.read() == contents
+    return data.SampleClusterTable('sample', table.table, delete=False)
+
+
+def test_table_roundtrip():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        table = _roundtrip(tmpdir, ''.join(CLUSTERS))
+        assert table.counts() == [('ref1', 3), ('ref2', 0), ('ref3', 1)]
+        assert table.sizes().tolist() == [3, 0, 1]
+        assert table.count() == 3
+        assert table.parse() == [('ref1', ['r1', 'r2', 'r3']), ('ref2', []),
+                                 ('ref3', ['r4'])]
+        assert table.stats()[0].lengths == {0: 1, 1: 1, 3: 1}
+        # references are stored apart from reads
+        with np.load(table.table) as columns:
+            assert columns['references'].tobytes() == b'ref1ref2ref3'
+            assert columns['reads'].tobytes() == b'r1r2r3r4'
+
+
+def test_empty_table():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        table = _roundtrip(tmpdir, '')
+        assert table.counts() == []
+        assert table.sizes().tolist() == []
+        assert table.count() == 0
+        assert table.parse() == []
+
+
+if __name__ == '__main__':
+    raise RuntimeError
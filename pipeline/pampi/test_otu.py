@@ -0,0 +1,59 @@
+import os
+import tempfile
+
+import pytest
+
+from pipeline.pampi import data, otu
+
+SAMPLES = {
+    'a': 'ref1\tr1\tr2\nref2\nref3\tr3\n',
+    # ref4 is unique to b and ref2 has no reads anywhere
+    'b': 'ref3\tr4\tr5\nref4\tr6\nref1\n'
+}
+TSV = '#OTU ID\ta\tb\nref1\t2\t0\nref3\t1\t2\nref4\t0\t1\n'
+
+
+def _abundance(tmpdir: str) -> otu.Abundance:
+    samples = []
+    for name, contents in SAMPLES.items():
+        path = os.path.join(tmpdir, f'{name}.clstr')
+        with open(path, 'w') as handle:
+            handle.write(contents)
+        samples.extend([data.SampleClusters(name, path, delete=False), None])
+    return otu.abundance(data.MultipleClusters(samples))
+
+
+def test_abundance_tsv():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        table = _abundance(tmpdir)
+        assert table.observations == ['ref1', 'ref3', 'ref4']
+        assert table.samples == ['a', 'b']
+        assert table.counts.toarray().tolist() == [[2, 0], [1, 2], [0, 1]]
+        path = os.path.join(tmpdir, f'table.{otu.TSV}')
+        otu.write(otu.TSV, path, table)
+        with open(path) as handle:
+            assert handle.read() == TSV
+
+
+def test_abundance_biom():
+    h5py = pytest.importorskip('h5py')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, f'table.{otu.BIOM}')
+        otu.write(otu.BIOM, path, _abundance(tmpdir))
+        with h5py.File(path, 'r') as biom:
+            assert tuple(biom.attrs['shape']) == (3, 2)
+            assert biom.attrs['nnz'] == 4
+            assert [*map(bytes.decode, biom['observation/ids'][:])] == \
+                ['ref1', 'ref3', 'ref4']
+            assert [*map(bytes.decode, biom['sample/ids'][:])] == ['a', 'b']
+            # observations are rows (CSR), samples are columns (CSC)
+            assert biom['observation/matrix/data'][:].tolist() == [2, 1, 2, 1]
+            assert biom['observation/matrix/indices'][:].tolist() == [0, 0, 1, 1]
+            assert biom['observation/matrix/indptr'][:].tolist() == [0, 1, 3, 4]
+            assert biom['sample/matrix/data'][:].tolist() == [2, 1, 2, 1]
+            assert biom['sample/matrix/indices'][:].tolist() == [0, 1, 1, 2]
+            assert biom['sample/matrix/indptr'][:].tolist() == [0, 2, 4]
+
+
+if __name__ == '__main__':
+    raise RuntimeError
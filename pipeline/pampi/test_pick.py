@@ -0,0 +1,37 @@
+import io
+import os
+import tempfile
+
+from pipeline.pampi import data, pick
+
+CLSTR = b'''>Cluster 0
+0\t1500nt, >ref1... *
+1\t250nt, >read1... at +/99.60%
+2\t250nt, >read2... at -/98.00%
+>Cluster 1
+0\t1500nt, >ref2... *
+>Cluster 2
+0\t1500nt, >ref3... *
+1\t250nt, >read3... at +/100.00%
+'''
+
+
+def test_cdhit_table():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for dropsingle in (False, True):
+            out = io.BytesIO()
+            expected = pick.write_cdhit_clusters(dropsingle, io.BytesIO(CLSTR),
+                                                 out)
+            path = os.path.join(tmpdir, f'{dropsingle}.npz')
+            stats = pick.write_cdhit_table(dropsingle, io.BytesIO(CLSTR), path)
+            assert stats.stats() == expected.stats()
+            table = data.SampleClusterTable('sample', path, delete=False)
+            # the table holds the same clusters as the tab-separated output
+            assert ['\t'.join([reference, *reads]) + '\n'
+                    for reference, reads in table.iter_records()] == \
+                out.getvalue().decode().splitlines(keepends=True)
+        assert table.counts() == [('ref1', 2), ('ref3', 1)]
+
+
+if __name__ == '__main__':
+    raise RuntimeError
@@ -0,0 +1,170 @@
+import os
+import random
+import tempfile
+import time
+
+from pipeline.pampi import data
+from pipeline.pampi.refpick import IndexCache, load_index, refpick, \
+    wordsize, CACHEFORMAT
+
+SIMILARITY = 0.97
+COMPLEMENT = str.maketrans('ACGT', 'TGCA')
+
+
+def _random_seq(size: int) -> str:
+    return ''.join(random.choice('ACGT') for _ in range(size))
+
+
+def _mutate(seq: str, positions) -> str:
+    seq = list(seq)
+    for i in positions:
+        seq[i] = next(base for base in 'ACGT' if base != seq[i])
+    return ''.join(seq)
+
+
+def _revcomp(seq: str) -> str:
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def _write_fasta(path: str, records):
+    with open(path, 'w') as out:
+        out.writelines(f'>{name}\n{seq}\n' for name, seq in records)
+    return path
+
+
+def _write_fastq(path: str, records):
+    with open(path, 'w') as out:
+        out.writelines(f'@{name}\n{seq}\n+\n{"I" * len(seq)}\n'
+                       for name, seq in records)
+    return path
+
+
+def _references(tmpdir: str):
+    random.seed(42)
+    refs = [(f'ref{i} description', _random_seq(300)) for i in range(3)]
+    return refs, _write_fasta(os.path.join(tmpdir, 'refs.fasta'), refs)
+
+
+def _pick(tmpdir: str, sample: data.SampleFiles, reference: str, **options):
+    outdir = tempfile.mkdtemp(dir=tmpdir)
+    clusters = refpick(tmpdir, sample, outdir, False, reference,
+                       options.pop('accurate', False), SIMILARITY, 2, **options)
+    return dict(clusters.parse())
+
+
+def test_refpick():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        refs, reference = _references(tmpdir)
+        (_, ref0), (_, ref1), (_, ref2) = refs
+        reads = [
+            ('exact', ref0[50:150]),
+            # 2 substitutions per 100 bases are within the threshold
+            ('mutated', _mutate(ref1[100:200], [10, 60])),
+            ('reversed', _revcomp(ref2[150:250])),
+            # 5 substitutions per 100 bases are not
+            ('diverged', _mutate(ref0[0:100], [5, 25, 45, 65, 85])),
+            ('unrelated', _random_seq(100))
+        ]
+        fasta = _write_fasta(os.path.join(tmpdir, 'reads.fasta'), reads)
+        for accurate in (False, True):
+            sample = data.SampleFasta('sample', fasta, delete=False)
+            assert _pick(tmpdir, sample, reference, accurate=accurate) == {
+                'ref0': ['exact'], 'ref1': ['mutated'], 'ref2': ['reversed']
+            }
+
+
+def test_refpick_paired():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        refs, reference = _references(tmpdir)
+        (_, ref0), (_, ref1), _ = refs
+        pairs = [
+            ('concordant', ref0[0:100], _revcomp(ref0[200:300])),
+            ('mutated', _mutate(ref1[0:100], [50]),
+             _revcomp(_mutate(ref1[180:280], [20]))),
+            # mates must meet the threshold with the same reference
+            ('discordant', ref0[0:100], _revcomp(ref1[200:300])),
+            ('unmapped mate', ref1[0:100], _random_seq(100))
+        ]
+        forward = _write_fastq(os.path.join(tmpdir, 'R1.fastq'),
+                               [(name, fwd) for name, fwd, _ in pairs])
+        reverse = _write_fastq(os.path.join(tmpdir, 'R2.fastq'),
+                               [(name, rev) for name, _, rev in pairs])
+        sample = data.SamplePairedFastq('sample', forward, reverse,
+                                        delete=False)
+        assert _pick(tmpdir, sample, reference) == {
+            'ref0': ['concordant'], 'ref1': ['mutated'], 'ref2': []
+        }
+
+
+def _entries(cache: IndexCache):
+    return sorted(entry for entry in os.listdir(cache.root)
+                  if not entry.startswith('.'))
+
+
+def test_index_cache():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        refs, reference = _references(tmpdir)
+        cache = IndexCache(os.path.join(tmpdir, 'cache'))
+        # a miss builds and stores an index equal to an uncached one
+        built = load_index(reference, SIMILARITY)
+        cached = load_index(reference, SIMILARITY, cache)
+        key = cache.key(reference, wordsize(SIMILARITY))
+        assert key.endswith(f'-v{CACHEFORMAT}')
+        assert _entries(cache) == [key]
+        assert cached.names == built.names == ['ref0', 'ref1', 'ref2']
+        assert (cached.postings_pos == built.postings_pos).all()
+        # a hit reuses the entry
+        stored = os.path.join(cache.root, key, 'names.txt')
+        mtime = os.stat(stored).st_mtime_ns
+        assert load_index(reference, SIMILARITY, cache).names == built.names
+        assert os.stat(stored).st_mtime_ns == mtime
+        # a modified reference is indexed anew
+        _write_fasta(reference, refs[:2])
+        assert load_index(reference, SIMILARITY, cache).names == ['ref0', 'ref1']
+        assert len(_entries(cache)) == 2
+        # the word size is a part of the key
+        load_index(reference, 0.8, cache)
+        assert len(_entries(cache)) == 3
+
+
+def test_index_cache_eviction():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        refs, reference = _references(tmpdir)
+        cache = IndexCache(os.path.join(tmpdir, 'cache'), maxage=3600)
+        cache.load(reference, SIMILARITY)
+        old = cache.key(reference, wordsize(SIMILARITY))
+        # entries unused for longer than maxage are evicted
+        stale = time.time() - 7200
+        os.utime(os.path.join(cache.root, old), (stale, stale))
+        cache.load(reference, 0.8)
+        new = cache.key(reference, wordsize(0.8))
+        assert _entries(cache) == [new]
+        # least recently used entries are evicted once the cache is full,
+        # the entry being loaded is kept regardless
+        small = IndexCache(cache.root, maxsize=1)
+        small.load(reference, SIMILARITY)
+        assert _entries(small) == [old]
+
+
+def test_digest_memo(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        refs, reference = _references(tmpdir)
+        cache = IndexCache(os.path.join(tmpdir, 'cache'))
+        key = cache.key(reference, wordsize(SIMILARITY))
+        # an unmodified reference is not hashed again, not even by another
+        # run sharing the cache
+        with monkeypatch.context() as patch:
+            patch.setattr('pipeline.pampi.refpick.digest', None)
+            assert cache.key(reference, wordsize(SIMILARITY)) == key
+            assert IndexCache(cache.root).key(
+                os.path.join(tmpdir, '.', 'refs.fasta'), wordsize(SIMILARITY)
+            ) == key
+        # a modified one is
+        _write_fasta(reference, refs[:2])
+        assert cache.key(reference, wordsize(SIMILARITY)) != key
+        _write_fasta(reference, refs)
+        assert cache.key(reference, wordsize(SIMILARITY)) == key
+
+
+if __name__ == '__main__':
+    raise RuntimeError
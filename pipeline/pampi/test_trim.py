@@ -0,0 +1,68 @@
+import gzip
+import os
+import random
+import shutil
+import tempfile
+
+from pipeline.pampi import data, trim
+
+OPTIONS = dict(phred=33, minqual=20, window=4, minlen=30, croplen=2)
+
+
+def _read(rng: random.Random, name: str) -> str:
+    length = rng.randint(4, 60)
+    seq = ''.join(rng.choices('ACGT', k=length))
+    # qualities degrade towards the 3' end
+    qual = ''.join(chr(33 + max(2, 40 - i * rng.randint(0, 2)))
+                   for i in range(length))
+    return f'@{name}\n{seq}\n+\n{qual}\n'
+
+
+def _write(path: str, contents: str, compress: bool):
+    with (gzip.open(path, 'wt') if compress else open(path, 'w')) as handle:
+        handle.write(contents)
+
+
+def _trim(tmpdir: str, forward: str, reverse: str, compress: bool,
+          jobs: int) -> list:
+    directory = tempfile.mkdtemp(dir=tmpdir)
+    paths = [os.path.join(directory, f'R{i}.fastq' + '.gz' * compress)
+             for i in (1, 2)]
+    for path, contents in zip(paths, [forward, reverse]):
+        _write(path, contents, compress)
+    outdir = tempfile.mkdtemp(dir=tmpdir)
+    sample = data.SamplePairedFastq('sample', *paths, delete=False)
+    trimmed, = trim.trimmer(tmpdir, compress=False, outdir=outdir,
+                            samples=data.MultiplePairedFastq([sample]),
+                            jobs=jobs, **OPTIONS).samples
+    outputs = []
+    for path in trimmed.files:
+        with open(path) as handle:
+            outputs.append(handle.read())
+        outputs.append(data.read_stats(path))
+    shutil.rmtree(outdir)
+    return outputs
+
+
+def test_mapped_trimming():
+    rng = random.Random(0)
+    names = [f'read{i} 1:N:0' for i in range(trim.CHUNKSIZE + 50)]
+    forward = ''.join(_read(rng, name) for name in names)
+    # names with trailing whitespace and a shorter mate file
+    reverse = ''.join(_read(rng, name + ' ') for name in names[:-10])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for jobs in (1, 2):
+            # compressed samples are parsed, uncompressed ones are mapped
+            parsed = _trim(tmpdir, forward, reverse, True, jobs)
+            assert parsed[0] and parsed[2]
+            assert _trim(tmpdir, forward, reverse, False, jobs) == parsed
+        # a multi-line record is not strict and goes through the parser
+        wrapped = '@r\nACGT\nACGT\n+\nIIII\nIIII\n'
+        assert (_trim(tmpdir, wrapped, wrapped, False, 1) ==
+                _trim(tmpdir, wrapped, wrapped, True, 1))
+        # empty samples still produce outputs
+        assert _trim(tmpdir, '', '', False, 1)[0::2] == ['', '']
+
+
+if __name__ == '__main__':
+    raise RuntimeError
@@ -1,12 +1,27 @@
+import operator as op
 import os
-from typing import Iterable, Tuple, Optional
+from itertools import groupby
+from typing import Iterable, Tuple, Optional, List, Iterator, Sequence, \
+    NamedTuple, Union
 
 import numba as nb
 import numpy as np
 from fn import F
 
 from pipeline.pampi import data
-from pipeline import util
+from pipeline import util, fastq
+
+# the number of read pairs in a unit of parallel work
+CHUNKSIZE = 10000
+
+# a chunk of read pairs of uncompressed samples represented by record
+# offsets (see fastq.MappedFastq.offsets) rather than by parsed records
+MappedChunk = NamedTuple('MappedChunk', [
+    ('forward', str),
+    ('reverse', str),
+    ('forward_offsets', np.ndarray),
+    ('reverse_offsets', np.ndarray)
+])
 
 
 @nb.jit(locals={'total': nb.int32, 'threshold': nb.int32, 'stop': nb.int32})
@@ -35,6 +50,101 @@ def qualstop(minqual: int, window: int, scores: np.ndarray):
     return stop
 
 
+@nb.jit(nopython=True,
+        locals={'total': nb.int32, 'threshold': nb.int32, 'stop': nb.int32})
+def spanstops(base: int, minqual: int, window: int, buffer: np.ndarray,
+              starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """
+    A batch version of qualstop: find trimming borders for a chunk of reads in
+    a single pass.
+    :param base: Phred base quality
+    :param minqual:
+    :param window:
+    :param buffer: a uint8 array holding raw (encoded) quality strings, e.g.
+    a memory-mapped FASTQ file
+    :param starts: quality string starts in `buffer`
+    :param ends: quality string (non-inclusive) ends in `buffer`
+    :return: an array of right non-inclusive borders (relative to read starts)
+    """
+    if minqual < 1 or window < 1:
+        raise ValueError('minqual and window must be positive')
+    threshold = minqual * window
+    stops = np.zeros(len(starts), dtype=np.int64)
+    for read in range(len(starts)):
+        start = starts[read]
+        end = ends[read]
+        if end - start < window:
+            raise ValueError('window > len(scores)')
+        total = 0
+        for i in range(start, start+window):
+            total += np.int32(buffer[i]) - base
+        if total < threshold:
+            continue
+        stop = window
+        for i in range(start+window, end):
+            total += np.int32(buffer[i]) - np.int32(buffer[i-window])
+            if total < threshold:
+                break
+            stop += 1
+        stops[read] = stop
+    return stops
+
+
+@nb.jit(nopython=True)
+def qualstops(base: int, minqual: int, window: int, buffer: np.ndarray,
+              offsets: np.ndarray) -> np.ndarray:
+    """
+    `spanstops` over quality strings packed back to back (see `pack`)
+    :param base: Phred base quality
+    :param minqual:
+    :param window:
+    :param buffer: raw (encoded) quality strings of all reads concatenated
+    into a single uint8 array
+    :param offsets: an array of len(reads) + 1 read boundaries in `buffer`
+    :return:
+    """
+    return spanstops(base, minqual, window, buffer, offsets[:-1], offsets[1:])
+
+
+def pack(quals: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pack quality strings into a contiguous uint8 buffer and an offsets array
+    :param quals:
+    :return:
+    """
+    buffer = np.frombuffer(''.join(quals).encode(), dtype=np.uint8)
+    offsets = np.zeros(len(quals)+1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, quals), dtype=np.int64, count=len(quals)),
+              out=offsets[1:])
+    return buffer, offsets
+
+
+def trim_batch(phred: int, minqual: int, window: int, minlen: int,
+               croplen: int, reads: Sequence[Tuple[str, str, str]]) \
+        -> List[Tuple[str, str, str]]:
+    """
+    A batch equivalent of `trim`: quality scores never leave their encoded
+    form, trimming borders are found in a single jitted pass and the output is
+    produced by slicing the original strings.
+    :param phred:
+    :param minqual:
+    :param window:
+    :param minlen:
+    :param croplen:
+    :param reads:
+    :return:
+    """
+    if not reads:
+        return []
+    names, seqs, quals = zip(*reads)
+    stops = qualstops(phred, minqual, window, *pack(quals)).tolist()
+    return [
+        (name, seq[croplen:stop], qual[croplen:stop])
+        for name, seq, qual, stop in zip(names, seqs, quals, stops)
+        if stop >= minlen
+    ]
+
+
 def decode(base: int, reads: Iterable[Tuple[str, str, str]]) \
         -> Iterable[Tuple[str, str, np.ndarray]]:
     """
@@ -91,18 +201,183 @@ def cumlength(pair: Tuple[Tuple[str, str, str], Tuple[str, str, str]]) -> int:
     return len(pair[0][1]) + len(pair[1][1])
 
 
+def trim_pairs(phred: int, minqual: int, window: int, minlen: int,
+               croplen: int,
+               pairs: List[Tuple[Tuple[str, str, str], Tuple[str, str, str]]]) \
+        -> List[Tuple[Tuple[str, str, str], Tuple[str, str, str]]]:
+    """
+    Trim a chunk of read pairs and drop pairs with insufficient cumulative
+    length
+    :param phred:
+    :param minqual:
+    :param window:
+    :param minlen: minimal cumulative length of a pair
+    :param croplen:
+    :param pairs:
+    :return:
+    """
+    # do not filter individual reads by length
+    trimmer_ = F(trim_batch, phred, minqual, window, 0, croplen)
+    return (
+        F(util.starapply, zip) >>
+        (map, trimmer_) >>
+        (util.starapply, zip) >>
+        (filter, lambda pair: cumlength(pair) >= (minlen - croplen*2)) >>
+        list
+    )(pairs)
+
+
+def _trim_mapped(phred: int, minqual: int, window: int, minlen: int,
+                 croplen: int, chunk: MappedChunk) \
+        -> List[Tuple[Tuple[str, str, str], Tuple[str, str, str]]]:
+    """
+    A `trim_pairs` equivalent for a MappedChunk: trimming borders are found
+    right in the memory-mapped files and only the records are decoded
+    :param phred:
+    :param minqual:
+    :param window:
+    :param minlen: minimal cumulative length of a pair
+    :param croplen:
+    :param chunk:
+    :return:
+    """
+    sides = []
+    for path, offsets in [(chunk.forward, chunk.forward_offsets),
+                          (chunk.reverse, chunk.reverse_offsets)]:
+        with fastq.MappedFastq(path) as mapped:
+            stops = spanstops(phred, minqual, window, mapped.buffer,
+                              offsets[:, fastq.QUAL_START],
+                              offsets[:, fastq.QUAL_END])
+            records = mapped.decode(offsets)
+        sides.append([(name, seq[croplen:stop], qual[croplen:stop])
+                      for (name, seq, qual), stop in zip(records, stops.tolist())])
+    return [pair for pair in zip(*sides)
+            if cumlength(pair) >= (minlen - croplen*2)]
+
+
+def _trim_chunk(options: Tuple[int, int, int, int, int],
+                task: Tuple[int, Union[MappedChunk,
+                                       List[Tuple[Tuple[str, str, str],
+                                                  Tuple[str, str, str]]]]]) \
+        -> Tuple[int, data.StatsCollector, data.StatsCollector, bytes, bytes]:
+    """
+    A picklable unit of work for the process pool: trim a chunk of pairs
+    from the index-th sample and encode both sides as FASTQ records
+    :param options: trim_pairs options
+    :param task: sample index and a chunk of read pairs (or a MappedChunk)
+    :return: sample index, statistics and encoded records of both sides
+    """
+    index, pairs = task
+    phred = options[0]
+    trimmed = (_trim_mapped(*options, pairs) if isinstance(pairs, MappedChunk)
+               else trim_pairs(*options, pairs))
+    fwd_stats, rev_stats = data.StatsCollector(phred), data.StatsCollector(phred)
+    fwd_stats.update(map(op.itemgetter(0), trimmed))
+    rev_stats.update(map(op.itemgetter(1), trimmed))
+    fwd_records = util.encode_records(util.FASTQ_TEMPLATE,
+                                      map(op.itemgetter(0), trimmed))
+    rev_records = util.encode_records(util.FASTQ_TEMPLATE,
+                                      map(op.itemgetter(1), trimmed))
+    return index, fwd_stats, rev_stats, fwd_records, rev_records
+
+
+def _rechunk(size: int, chunks: Iterable[np.ndarray]) -> Iterator[np.ndarray]:
+    """
+    Regroup rows of arrays into arrays of `size` rows (the last one might be
+    shorter)
+    :param size:
+    :param chunks:
+    :return:
+    """
+    pending, npending = [], 0
+    for chunk in chunks:
+        pending.append(chunk)
+        npending += len(chunk)
+        while npending >= size:
+            merged = np.concatenate(pending)
+            yield merged[:size]
+            pending, npending = [merged[size:]], npending - size
+    if npending:
+        yield np.concatenate(pending)
+
+
+def _mappable(sample: data.SamplePairedFastq) -> bool:
+    """
+    Can the sample be trimmed straight from memory-mapped files?
+    :param sample:
+    :return:
+    """
+    if sample.released or any(map(util.isgzipped, sample.files)):
+        return False
+    with fastq.MappedFastq(sample.forward) as forward, \
+            fastq.MappedFastq(sample.reverse) as reverse:
+        return forward.strict() and reverse.strict()
+
+
+def _chunk_mapped(chunksize: int, sample: data.SamplePairedFastq) \
+        -> Iterator[MappedChunk]:
+    chunked = False
+    with fastq.MappedFastq(sample.forward) as forward, \
+            fastq.MappedFastq(sample.reverse) as reverse:
+        # pairs are zipped, hence extra records of the longer file are ignored
+        for fwd, rev in zip(_rechunk(chunksize, forward.offsets()),
+                            _rechunk(chunksize, reverse.offsets())):
+            size = min(len(fwd), len(rev))
+            if size:
+                yield MappedChunk(sample.forward, sample.reverse,
+                                  fwd[:size], rev[:size])
+                chunked = True
+    # every sample yields at least one chunk (see _chunk_samples)
+    if not chunked:
+        empty = np.empty((0, 6), dtype=np.int64)
+        yield MappedChunk(sample.forward, sample.reverse, empty, empty)
+
+
+def _chunk_samples(chunksize: int, samples: Iterable[data.SamplePairedFastq]) \
+        -> Iterator[Tuple[int, Union[MappedChunk, List]]]:
+    for index, sample in enumerate(samples):
+        if _mappable(sample):
+            # workers receive offsets instead of parsed records
+            yield from ((index, chunk)
+                        for chunk in _chunk_mapped(chunksize, sample))
+            continue
+        chunks = util.chunked(chunksize, sample.iter_records())
+        # every sample yields at least one (possibly empty) chunk to make sure
+        # its output files are created
+        yield index, next(chunks, [])
+        yield from ((index, chunk) for chunk in chunks)
+
+
 def trimmer(tmpdir: str, phred: int, minqual: int, window: int, minlen: int,
             croplen: int, compress: bool, outdir: Optional[str],
-            samples: data.MultiplePairedFastq) -> data.MultiplePairedFastq:
-    # do not filter individual reads by length
-    # TODO devectorise all low-level generators to make trimmer_ atomic: ...
-    # TODO ... this might shave off redundant complexity below
-    trimmer_ = F(trim, phred, minqual, window, 0, croplen)
+            samples: data.MultiplePairedFastq, jobs: int=1) \
+        -> data.MultiplePairedFastq:
+    """
+    :param tmpdir:
+    :param phred:
+    :param minqual:
+    :param window:
+    :param minlen:
+    :param croplen:
+    :param compress:
+    :param outdir:
+    :param samples:
+    :param jobs: the number of worker processes; samples are split into
+    chunks of CHUNKSIZE pairs and the chunks are trimmed in parallel, while
+    the output is written in the original order. Uncompressed strict 4-line
+    FASTQ samples are not parsed at all: workers get record offsets and trim
+    reads right in the memory-mapped files.
+    :return:
+    """
+    options = (phred, minqual, window, minlen, croplen)
     trimmed_samples = []
     fwd_suffix = f'_R1.{util.FASTQ}' + util.ending(compress)
     rev_suffix = f'_R2.{util.FASTQ}' + util.ending(compress)
 
-    for sample in samples.samples:
+    trimmed_chunks = util.pmap(jobs, F(_trim_chunk, options),
+                               _chunk_samples(CHUNKSIZE, samples.samples))
+    for index, chunks in groupby(trimmed_chunks, op.itemgetter(0)):
+        sample = samples.samples[index]
         fwd_out = (
             util.randname(tmpdir, fwd_suffix) if outdir is None else
             os.path.join(outdir, sample.name+fwd_suffix)
@@ -111,17 +386,17 @@ def trimmer(tmpdir: str, phred: int, minqual: int, window: int, minlen: int,
             util.randname(tmpdir, rev_suffix) if outdir is None else
             os.path.join(outdir, sample.name + rev_suffix)
         )
-        # filter pairs with insufficient cumulative length
-        trimmed_pairs = (
-                F(util.starapply, zip) >>
-                (map, trimmer_) >>
-                (util.starapply, zip) >>
-                (filter, lambda pair: cumlength(pair) >= (minlen - croplen*2))
-        )(sample.parse())
-        with util.writer(compress, fwd_out) as fbuffer, util.writer(compress, rev_out) as rbuffer:
-            for (fname, fseq, fqual), (rname, rseq, rqual) in trimmed_pairs:
-                print('@'+fname, fseq, '+', fqual, sep='\n', file=fbuffer)
-                print('@'+rname, rseq, '+', rqual, sep='\n', file=rbuffer)
+        with util.RecordWriter(compress, fwd_out, util.FASTQ_TEMPLATE) as fbuffer, \
+                util.RecordWriter(compress, rev_out, util.FASTQ_TEMPLATE) as rbuffer:
+            fwd_stats, rev_stats = data.StatsCollector(), data.StatsCollector()
+            for _, fwd_chunk, rev_chunk, fwd_records, rev_records in chunks:
+                fbuffer.write_bytes(fwd_records)
+                rbuffer.write_bytes(rev_records)
+                fwd_stats.merge(fwd_chunk)
+                rev_stats.merge(rev_chunk)
+        # let downstream stages (e.g. FILTER) skip rescanning the output
+        data.write_stats(fwd_out, fwd_stats.stats())
+        data.write_stats(rev_out, rev_stats.stats())
         trimmed_samples.append(
             data.SamplePairedFastq(sample.name, fwd_out, rev_out, outdir is None)
         )
@@ -0,0 +1,65 @@
+import gzip
+import os
+import tempfile
+
+from hypothesis import given, settings
+from hypothesis.strategies import binary, integers
+
+from . import bgzf, util
+
+
+def _write(directory: str, data: bytes) -> str:
+    path = os.path.join(directory, 'data.gz')
+    with bgzf.bgzfopen(path, 'wb') as handle:
+        handle.write(data)
+    return path
+
+
+def _read(path: str, start: int=0, end=None) -> bytes:
+    with bgzf.bgzfopen(path, 'rb', start=start, end=end) as handle:
+        return handle.read()
+
+
+@settings(max_examples=50, deadline=None)
+@given(binary(max_size=2**10), integers(min_value=0, max_value=3*bgzf.BLOCKSIZE))
+def test_roundtrip(data, padding):
+    # padding spans several blocks
+    data += bytes(padding)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = _write(tmpdir, data)
+        assert bgzf.isbgzf(path)
+        with gzip.open(path, 'rb') as handle:
+            assert handle.read() == data
+        with util.gzread_bytes(path) as handle:
+            assert handle.read() == data
+        assert _read(path) == data
+
+
+def test_empty():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = _write(tmpdir, b'')
+        with open(path, 'rb') as handle:
+            assert handle.read() == bgzf.EOF
+        with gzip.open(path, 'rb') as handle:
+            assert handle.read() == b''
+        with util.gzread(path) as handle:
+            assert handle.read() == ''
+        assert _read(path) == b''
+        assert [size for _, size in bgzf.blocks(path)] == [len(bgzf.EOF)]
+
+
+def test_ranges():
+    data = os.urandom(bgzf.BLOCKSIZE * 5 + 100)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = _write(tmpdir, data)
+        offsets = [offset for offset, _ in bgzf.blocks(path)]
+        for n in (1, 3, 8):
+            spans = bgzf.ranges(path, n)
+            assert 0 < len(spans) <= n
+            assert spans[0][0] == 0 and spans[-1][1] == os.path.getsize(path)
+            assert all(start in offsets for start, _ in spans)
+            assert b''.join(_read(path, *span) for span in spans) == data
+
+
+if __name__ == '__main__':
+    raise RuntimeError
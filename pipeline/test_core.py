@@ -1,7 +1,9 @@
+import gc
 import itertools
 import random
 import string
 import copy
+import weakref
 from functools import reduce
 from fn import F
 from queue import Queue
@@ -14,7 +16,7 @@ from multipledispatch import dispatch
 from typing import TypeVar, Generator, List, Tuple, \
     Type, Generic, SupportsFloat, SupportsInt, Callable, \
     Any, Union, Sequence
-from .core import _starapply, Map, Router, pcompile, \
+from .core import _starapply, _pcompile, Map, Router, pcompile, plan, Cost, \
     AmbiguousError, NoRouteError, RedundancyError
 
 
@@ -380,5 +382,77 @@ def test_starapply(test_data: Tuple[Callable, List[Callable]]):
         function], args))() == _starapply(function, args)
 
 
+def test_pcompile_cache():
+
+    def build():
+        return [Router('first', [Map(int, str, str), Map(float, str, str)]),
+                Router('second', [Map(str, int, len)])]
+
+    _pcompile.cache_clear()
+    assert pcompile(build(), int, int)(12345) == 5
+    # rebuilt routers of the same shape reuse the route
+    assert pcompile(build(), int, int)(123) == 3
+    assert _pcompile.cache_info().hits == 1
+    assert pcompile(build(), float, int)(1.5) == 3
+    assert _pcompile.cache_info().misses == 2
+    # the cache does not keep maps alive
+    routers = build()
+    pcompile(routers, int, int)
+    reference = weakref.ref(routers[0].maps[0])
+    del routers
+    gc.collect()
+    assert reference() is None
+    try:
+        Router('redundant', [Map(int, str, str), Map(int, str, repr)])
+        assert False
+    except RedundancyError:
+        pass
+
+
+def test_plan_cost():
+    routers = [Router('first', [Map(int, str, str), Map(int, float, float)]),
+               Router('second', [Map(str, int, len), Map(float, int, round)])]
+    try:
+        plan(routers, int, int)
+        assert False
+    except AmbiguousError:
+        pass
+    # route through floats
+    cheap = plan(routers, int, int, lambda m: m.domain is str or m.codomain is str)
+    assert cheap(12345) == 12345
+    try:
+        plan(routers, str, int)
+        assert False
+    except NoRouteError:
+        pass
+    # a tie between costlier routes is resolved by a cheaper one found later
+    slow = Cost(throughput=0.5, materialises=False, tempdisk=False)
+    routers = [Router('first', [Map(int, str, str, slow),
+                                Map(int, float, float, slow),
+                                Map(int, bytes, lambda x: b'%d' % x)]),
+               Router('second', [Map(str, int, len), Map(float, int, round),
+                                 Map(bytes, int, len)])]
+    assert plan(routers, int, int)(12345) == 5
+    assert pcompile(routers, int, int).estimate == 2.0
+
+
+def test_map_cost():
+    slow = Cost(throughput=0.5, materialises=False, tempdisk=True)
+    routers = [Router('first', [Map(int, str, str, slow), Map(int, float, float)]),
+               Router('second', [Map(str, int, len), Map(float, int, round)])]
+    compiled = pcompile(routers, int, int)
+    assert compiled(12345) == 12345
+    assert compiled.estimate == 2.0
+    assert compiled.cost is None
+    composed = routers[0].maps[0] >> routers[1].maps[0]
+    assert composed.estimate == 4.0
+    assert composed.cost is None
+    try:
+        Map(int, str, str, Cost(0, False, False))
+        assert False
+    except ValueError:
+        pass
+
+
 if __name__ == "__main__":
     raise RuntimeError
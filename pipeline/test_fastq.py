@@ -0,0 +1,85 @@
+import os
+import tempfile
+
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
+from hypothesis import given, settings
+from hypothesis.strategies import lists, sampled_from, integers
+
+from .fastq import MappedFastq, parse
+
+
+# well-formed records as well as the corner cases the indexer must pass over
+# to Biopython
+RECORDS = [
+    '@r1\nACGT\n+\nIIII\n',
+    '@r2 desc \nAC\n+r2 desc\nII\n',
+    '@r3\n\n+\n\n',
+    '@r4\nAC\nGT\n+\nII\nII\n',
+    '@r5\nAAAA\n+\n@III\n',
+    '@r6\r\nAA\r\n+\r\nII\r\n',
+    '@r7\nAA\n+\nII',
+    '@r8\nACG\n+\nII\n',
+    '@r9\nA A\n+\nIII\n',
+    '\n',
+]
+
+
+def _parse(parser, contents: str):
+    with tempfile.NamedTemporaryFile('w', suffix='.fastq', delete=False) as handle:
+        handle.write(contents)
+    try:
+        return list(parser(handle.name)), None
+    except ValueError as err:
+        return None, type(err)
+    finally:
+        os.remove(handle.name)
+
+
+def _biopython(path: str):
+    with open(path) as handle:
+        return list(FastqGeneralIterator(handle))
+
+
+@settings(max_examples=500, deadline=None)
+@given(lists(sampled_from(RECORDS), max_size=8),
+       integers(min_value=1, max_value=64))
+def test_mapped_biopython_equivalence(records, chunksize):
+    contents = ''.join(records)
+    with tempfile.NamedTemporaryFile('w', suffix='.fastq', delete=False) as handle:
+        handle.write(contents)
+    try:
+        with MappedFastq(handle.name) as fastq:
+            strict = fastq.strict(chunksize)
+            mapped = strict and [record for offsets in fastq.offsets(chunksize)
+                                 for record in fastq.decode(offsets)]
+    finally:
+        os.remove(handle.name)
+    # strict files are decoded exactly like Biopython parses them
+    if strict:
+        assert (mapped, None) == _parse(_biopython, contents)
+    # well-formed records are always strict
+    if all(record in RECORDS[:3] for record in records):
+        assert strict
+
+
+def test_offsets():
+    contents = '@r1 x\nACGT\n+\nIIII\n@r2\nAC\n+r2\nI#\n'
+    with tempfile.NamedTemporaryFile('w', suffix='.fastq', delete=False) as handle:
+        handle.write(contents)
+    try:
+        with MappedFastq(handle.name) as fastq:
+            offsets = [row for chunk in fastq.offsets() for row in chunk.tolist()]
+            raw = fastq.buffer.tobytes().decode()
+        assert [
+            (raw[ns:ne], raw[ss:se], raw[qs:qe])
+            for ns, ne, ss, se, qs, qe in offsets
+        ] == list(parse(handle.name))
+        with MappedFastq(handle.name) as fastq:
+            assert fastq.strict()
+            assert fastq.decode(next(fastq.offsets())) == list(parse(handle.name))
+    finally:
+        os.remove(handle.name)
+
+
+if __name__ == '__main__':
+    raise RuntimeError
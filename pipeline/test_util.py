@@ -0,0 +1,39 @@
+import gzip
+import os
+import shutil
+import tempfile
+
+from . import util
+
+
+def test_ungzipped_zlib(monkeypatch):
+    # pigz is optional: force the built-in zlib fallback
+    monkeypatch.setattr(shutil, 'which', lambda *_: None)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        contents = [os.urandom(100), os.urandom(util.BUFSIZE + 100)]
+        paths = []
+        for i, data in enumerate(contents):
+            paths.append(os.path.join(tmpdir, f'{i}.gz'))
+            with gzip.open(paths[-1], 'wb') as handle:
+                handle.write(data)
+        with util.ungzipped(*paths, tmpdir=tmpdir) as decompressed:
+            for path, data in zip(decompressed, contents):
+                with open(path, 'rb') as handle:
+                    assert handle.read() == data
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_gzwrite():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'text.gz')
+        with util.gzwrite(path) as handle:
+            handle.write('line\n' * 1000)
+        assert util.count_lines(path) == 1000
+        with util.gzread(path) as handle:
+            assert handle.read() == 'line\n' * 1000
+
+
+if __name__ == '__main__':
+    raise RuntimeError
@@ -7,30 +7,51 @@ import uuid
 import gzip
 import io
 import os
-from itertools import repeat, filterfalse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat, filterfalse, islice, starmap
 from functools import wraps
-from typing import Callable, TypeVar, Optional, Sequence, TextIO
+from typing import Callable, TypeVar, Optional, Sequence, TextIO, Iterable, \
+    Iterator, List, BinaryIO
 
 from fn import F, _ as X
 
+from pipeline import bgzf
+
 
 DEVNULL = open(os.devnull, 'w')
 ENV = '/usr/bin/env'
-GZIP = 'gzip'
+PIGZ = 'pigz'
+BUFSIZE = 2**20
+# the number of records formatted at once by RecordWriter.writemany
+BATCHSIZE = 1024
 QUITE = dict(stdout=DEVNULL, stderr=sp.STDOUT)
 # extensions
 GZ = 'gz'
 FASTQ = 'fastq'
 FASTA = 'fasta'
 CLUSTERS = 'clstr'
+TABLE = 'npz'
+# record templates
+FASTQ_TEMPLATE = '@{}\n{}\n+\n{}\n'
+FASTA_TEMPLATE = '>{}\n{}\n'
+# tab-separated clusters
+CLUSTERS_TEMPLATE = '{}\n'
 
 
 A = TypeVar('A')
+B = TypeVar('B')
 NoneType = type(None)
 
 
 writer: Callable[[bool, str], TextIO] = lambda compress, path: (
-    gzip.open(path, 'wt') if compress else open(path, 'w')
+    bgzf.bgzfopen(path, 'wt') if compress else open(path, 'w')
+)
+bwriter: Callable[[bool, str], BinaryIO] = lambda compress, path: (
+    bgzf.bgzfopen(path, 'wb') if compress else open(path, 'wb')
+)
+compressing: Callable[[str], bool] = (
+    lambda path: path.lower().endswith(('.gz', '.bgz'))
 )
 ending: Callable[[bool], str] = (
     lambda compress: f'.{GZ}' if compress else ''
@@ -41,6 +62,51 @@ def starapply(f, args):
     return f(*args)
 
 
+def chunked(size: int, iterable: Iterable[A]) -> Iterator[List[A]]:
+    """
+    Lazily split an iterable into lists of at most `size` items
+    :param size: chunk size
+    :param iterable:
+    :return:
+    >>> list(chunked(2, range(5)))
+    [[0, 1], [2, 3], [4]]
+    """
+    if size < 1:
+        raise ValueError('chunk size must be positive')
+    iterator = iter(iterable)
+    return iter(lambda: list(islice(iterator, size)), [])
+
+
+def pmap(jobs: int, f: Callable[[A], B], iterable: Iterable[A],
+         prefetch: Optional[int]=None) -> Iterator[B]:
+    """
+    An ordered process-pool map. Unlike Executor.map, this function only keeps
+    a bounded number of tasks in flight, so it is safe to feed it lazy
+    streams of arbitrary length.
+    :param jobs: the number of worker processes; with a single job `f` is
+    applied in the calling process
+    :param f: a picklable callable
+    :param iterable:
+    :param prefetch: the maximum number of pending tasks; defaults to
+    `2 * jobs`
+    :return: results in input order
+    """
+    if jobs < 1:
+        raise ValueError('the number of jobs must be positive')
+    if jobs == 1:
+        yield from map(f, iterable)
+        return
+    prefetch = prefetch or 2 * jobs
+    with ProcessPoolExecutor(jobs) as pool:
+        pending = deque()
+        for item in iterable:
+            pending.append(pool.submit(f, item))
+            if len(pending) >= prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
 def root_exists(path: str) -> bool:
     """
     Does root directory of a path exist?
@@ -98,12 +164,215 @@ def isgzipped(path: str) -> bool:
 
 
 def gzread(path: str) -> TextIO:
-    return gzip.open(path, 'rt') if isgzipped(path) else open(path)
+    """
+    Open a plain, gzipped or BGZF-compressed file in text mode. BGZF files are
+    decompressed in parallel.
+    :param path:
+    :return:
+    """
+    if not isgzipped(path):
+        return open(path)
+    return bgzf.bgzfopen(path, 'rt') if bgzf.isbgzf(path) else gzip.open(path, 'rt')
+
+
+def gzread_bytes(path: str) -> BinaryIO:
+    """
+    A binary mode counterpart of `gzread`
+    :param path:
+    :return:
+    """
+    if not isgzipped(path):
+        return open(path, 'rb')
+    return bgzf.bgzfopen(path, 'rb') if bgzf.isbgzf(path) else gzip.open(path, 'rb')
+
+
+def count_lines(path: str, prefix: bytes=b'') -> int:
+    """
+    Count lines starting with `prefix` (all lines by default) in a plain or
+    compressed file. Raw bytes are scanned chunk by chunk, nothing is decoded.
+    :param path:
+    :param prefix:
+    :return:
+    >>> with tempfile.NamedTemporaryFile('w', suffix='.fasta') as handle:
+    ...     _ = handle.write('>a\\nACGT\\n>b\\nT>\\n>c')
+    ...     handle.flush()
+    ...     count_lines(handle.name), count_lines(handle.name, b'>')
+    (5, 3)
+    """
+    needle = b'\n' + prefix
+    # a virtual newline precedes the first line
+    tail = b'\n'
+    last = b''
+    total = 0
+    with gzread_bytes(path) as handle:
+        for chunk in iter(F(handle.read, BUFSIZE), b''):
+            total += (tail + chunk).count(needle)
+            # keep enough bytes to find needles spanning chunk boundaries
+            tail = (tail + chunk)[-(len(needle)-1):] if prefix else b''
+            last = chunk[-1:]
+    if not last:
+        return 0
+    # a trailing newline does not start a line
+    return total - (not prefix and last == b'\n')
 
 
 def gzwrite(path: str) -> TextIO:
-    compress = path.lower().endswith('.gz') or path.lower().endswith('.bgz')
-    return gzip.open(path, 'wt') if compress else open(path, 'w')
+    """
+    Open a file for writing in text mode; paths ending with .gz or .bgz are
+    compressed in parallel into BGZF, which is a valid gzip format.
+    :param path:
+    :return:
+    """
+    return writer(compressing(path), path)
+
+
+class RecordWriter(contextlib.AbstractContextManager):
+    """
+    A bulk record writer: records are formatted using a template (see
+    FASTQ_TEMPLATE and FASTA_TEMPLATE), collected into a large buffer and
+    encoded and flushed all at once. Pre-encoded data can be written as well.
+    """
+
+    def __init__(self, compress: bool, path: str, template: str,
+                 bufsize: int=BUFSIZE):
+        """
+        :param compress: compress the output (into BGZF)
+        :param path: output destination
+        :param template: record template; each record's fields are passed to
+        template.format
+        :param bufsize: buffer size (in characters) triggering a flush
+        """
+        self._handle = bwriter(compress, path)
+        self._format = template.format
+        self._bufsize = bufsize
+        self._buffer: List[str] = []
+        self._size = 0
+
+    def write(self, record: Sequence[str]):
+        formatted = self._format(*record)
+        self._buffer.append(formatted)
+        self._size += len(formatted)
+        if self._size >= self._bufsize:
+            self.flush()
+
+    def writemany(self, records: Iterable[Sequence[str]]):
+        for chunk in chunked(BATCHSIZE, records):
+            formatted = ''.join(starmap(self._format, chunk))
+            self._buffer.append(formatted)
+            self._size += len(formatted)
+            if self._size >= self._bufsize:
+                self.flush()
+
+    def write_bytes(self, data: bytes):
+        """
+        Write pre-encoded (e.g. formatted elsewhere) records
+        :param data:
+        :return:
+        """
+        self.flush()
+        self._handle.write(data)
+
+    def flush(self):
+        if self._buffer:
+            self._handle.write(''.join(self._buffer).encode())
+            self._buffer.clear()
+            self._size = 0
+
+    def close(self):
+        if not self._handle.closed:
+            try:
+                self.flush()
+            finally:
+                self._handle.close()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def encode_records(template: str, records: Iterable[Sequence[str]]) -> bytes:
+    """
+    Format and encode records in bulk for RecordWriter.write_bytes
+    :param template:
+    :param records:
+    :return:
+    >>> encode_records(FASTA_TEMPLATE, [('a', 'ACGT'), ('b', 'TT')])
+    b'>a\\nACGT\\n>b\\nTT\\n'
+    """
+    return ''.join(starmap(template.format, records)).encode()
+
+
+class ShardWriter(contextlib.AbstractContextManager):
+    """
+    Stitch files written independently (e.g. by worker processes) into a
+    single output. BGZF shards are gzip members, hence they can be
+    concatenated as is; only their EOF markers are dropped and a single
+    marker is written on close.
+    """
+
+    def __init__(self, compress: bool, path: str):
+        """
+        :param compress: shards are BGZF-compressed
+        :param path: output destination
+        """
+        self._compress = compress
+        self._handle = open(path, 'wb')
+
+    def append(self, shard: str):
+        """
+        Append a shard and remove it
+        :param shard:
+        :return:
+        """
+        size = os.path.getsize(shard)
+        with open(shard, 'rb') as source:
+            if self._compress and size >= len(bgzf.EOF):
+                source.seek(size - len(bgzf.EOF))
+                if source.read() == bgzf.EOF:
+                    size -= len(bgzf.EOF)
+                source.seek(0)
+            while size:
+                data = source.read(min(BUFSIZE, size))
+                if not data:
+                    break
+                self._handle.write(data)
+                size -= len(data)
+        os.remove(shard)
+
+    def close(self):
+        if not self._handle.closed:
+            try:
+                if self._compress:
+                    self._handle.write(bgzf.EOF)
+            finally:
+                self._handle.close()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _pigz_decompress(executable: str, path: str, destination: BinaryIO):
+    process = sp.run([executable, '-cdf', path], stdout=destination)
+    if process.returncode:
+        raise RuntimeError(f'{executable} failed to decompress {path}')
+
+
+def _zlib_decompress(path: str, destination: BinaryIO):
+    # zlib releases the GIL, hence several files can be decompressed in
+    # parallel on a thread pool
+    with gzip.open(path, 'rb') as source:
+        shutil.copyfileobj(source, destination, BUFSIZE)
+    # consumers read the destination by name
+    destination.flush()
+
+
+def decompressor() -> Callable[[str, BinaryIO], None]:
+    """
+    Select a decompression backend: pigz if it is on your PATH, otherwise the
+    built-in zlib
+    :return: a function decompressing a path into a binary handle
+    """
+    pigz_exec = shutil.which(PIGZ)
+    return F(_pigz_decompress, pigz_exec) if pigz_exec else _zlib_decompress
 
 
 @contextlib.contextmanager
@@ -112,38 +381,37 @@ def ungzipped(*paths, tmpdir=tempfile.gettempdir()) -> Sequence[str]:
     Takes a sequence of paths (p1, p2, ..., pn) and returns (d1, d2, ..., dn),
     where pi == di if not isgzipped(pi), otherwise di point to a temporary
     decompressed file which will be erased upon exit from the context manager.
+    Compressed files are decompressed concurrently using pigz if it is
+    available and the built-in zlib otherwise.
     :param paths:
     :param tmpdir: a location for temporary decompressed files
     :return: a sequence of file path strings
     """
-    # TODO consider defaulting to the built-in gzip in this case
-    gzip_exec = shutil.which(GZIP)
-    if not gzip_exec:
-        raise RuntimeError(
-            'No gzip executable found; is it on your PATH?'
-        )
     if not os.path.exists(tmpdir):
         raise ValueError(
             f'directory {tmpdir}, specified as tmpdir, does not exist'
         )
-    uncompressed = []
+    decompress = decompressor()
+    compressed = [path for path in paths if isgzipped(path)]
+    # !!! note: opening several connections to a named temporary file
+    #           is only possible on Unix-like systems. This function is thus
+    #           not Windows-friendly.
     with contextlib.ExitStack() as stack:
-        for path in paths:
-            # if gzipped, make a temporary decompressed file
-            # shelling gzip out, because Python's built-in gzip implementation
-            # is notoriously slow
-            # !!! note: opening several connections to a named temporary file
-            #           is only possible on Unix-like systems. This function is
-            #           thus not Windows-friendly.
-            if isgzipped(path):
-                buffer = tempfile.NamedTemporaryFile(dir=tmpdir)
-                stack.enter_context(buffer)
-                sp.run([gzip_exec, '-cdf', path], stdout=buffer)
-                buffer.flush()
-                uncompressed.append(buffer.name)
-            else:
-                uncompressed.append(path)
-        yield tuple(uncompressed)
+        pool = stack.enter_context(ThreadPoolExecutor(len(compressed) or 1))
+        destinations = {}
+        jobs = []
+        for path in compressed:
+            if path in destinations:
+                continue
+            buffer = stack.enter_context(
+                tempfile.NamedTemporaryFile(dir=tmpdir)
+            )
+            destinations[path] = buffer.name
+            jobs.append(pool.submit(decompress, path, buffer))
+        # make sure all temporary files are complete
+        for job in jobs:
+            job.result()
+        yield tuple(destinations.get(path, path) for path in paths)
 
 
 if __name__ == '__main__':
@@ -1,16 +1,20 @@
 #! /usr/bin/env python
 
+import operator as op
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack
 from itertools import starmap
-from typing import Pattern, Tuple, List, Optional, TypeVar, Iterator
+from typing import Pattern, Tuple, List, Optional, TypeVar, Iterator, \
+    Callable, Generic
 
 import click
 import regex as re
 from Bio.SeqIO.QualityIO import FastqGeneralIterator
 from fn import F
 
-from pipeline.util import gzread, gzwrite
+from pipeline.util import gzread, chunked, pmap, compressing, \
+    encode_records, RecordWriter, FASTQ_TEMPLATE
 
 ALPHABET = {
     'A': 'A',
@@ -30,6 +34,13 @@ ALPHABET = {
     'N': '[ACGT]'
 }
 
+BASES = 'ACGT'
+# a primer pattern starts with an optional gap symbol, that can be consumed by
+# a substitution (see mkprimer)
+GAP = ':'
+# the number of read pairs in a unit of parallel work
+CHUNKSIZE = 10000
+
 A = TypeVar('A')
 
 
@@ -66,10 +77,107 @@ def match(primers: List[Tuple[A, Pattern]], seq: Seq) -> Optional[Tuple[A, Seq]]
     return None
 
 
-def normalise_pairs(forward, reverse, reads1: Iterator, reads2: Iterator) -> Iterator[Tuple[Seq, Seq]]:
+# one-hot nibbles: each position of a sequence occupies four bits, one per base
+_NIBBLES = {base: 1 << i for i, base in enumerate(BASES)}
+_READ_TABLE = bytes(
+    ord(format(_NIBBLES.get(chr(i), 0), 'x')) for i in range(256)
+)
+_popcount = (
+    int.bit_count if hasattr(int, 'bit_count') else
+    lambda value: bin(value).count('1')
+)
+
+
+def _encode_read(seq: str) -> int:
+    """
+    Encode a sequence as a bit-vector of one-hot nibbles: the i-th nibble
+    has a single bit set for the base at the i-th position. Non-ACGT symbols
+    are encoded as blank nibbles, i.e. they mismatch everything.
+    :param seq:
+    :return:
+    """
+    return int(seq.encode().translate(_READ_TABLE)[::-1] or b'0', 16)
+
+
+def _encode_primer(primer: str) -> int:
+    """
+    Encode an IUPAC primer as a bit-vector of nibbles: the i-th nibble has a
+    bit set for every base accepted at the i-th position. Since read nibbles
+    are one-hot, popcount(read & primer) is the number of matching positions.
+    :param primer:
+    :return:
+    """
+    try:
+        accepted = [ALPHABET[code] for code in primer]
+    except KeyError as err:
+        raise ValueError(f'unknown base: {err}')
+    return sum(
+        sum(nibble for base, nibble in _NIBBLES.items() if base in options)
+        << 4*i
+        for i, options in enumerate(accepted)
+    )
+
+
+class PrimerMatcher(Generic[A]):
+    """
+    A bit-parallel Hamming matcher for a prioritised list of IUPAC primers. It
+    is a drop-in replacement for `match` over `mkprimer` patterns: a read
+    prefix is encoded once and scored against all primers with a handful of
+    integer operations, instead of running a fuzzy regex per primer.
+    """
+    def __init__(self, substitutions: int, primers: List[Tuple[A, str]]):
+        """
+        :param substitutions: the maximum number of substitutions
+        :param primers: (flag, IUPAC primer) pairs in order of priority
+        """
+        if substitutions < 0:
+            raise ValueError('the number of substitutions can\'t be negative')
+        self._substitutions = substitutions
+        self._primers = [
+            (flag, len(primer), _encode_primer(primer))
+            for flag, primer in primers
+        ]
+        # a match might be shifted by a substituted gap symbol
+        self._prefix = max((length for _, length, _ in self._primers),
+                           default=0) + 1
+
+    def __call__(self, seq: Seq) -> Optional[Tuple[A, Seq]]:
+        prefix = seq.seq[:self._prefix]
+        read = _encode_read(prefix)
+        gap_cost = int(not prefix.startswith(GAP))
+        for flag, length, primer in self._primers:
+            # mirror regex's BESTMATCH: the gap-shifted alignment is tried
+            # first and is only replaced by a strictly better one
+            shifted = (
+                gap_cost + length - _popcount((read >> 4) & primer)
+                if len(prefix) > length else None
+            )
+            unshifted = (
+                length - _popcount(read & primer)
+                if len(prefix) >= length else None
+            )
+            if shifted is not None and shifted <= self._substitutions and (
+                    unshifted is None or shifted <= unshifted):
+                return flag, seq[length+1:]
+            if unshifted is not None and unshifted <= self._substitutions:
+                return flag, seq[length:]
+        return None
+
+
+def normalise_pairs(fmatch: Callable[[Seq], Optional[Tuple[str, Seq]]],
+                    rmatch: Callable[[Seq], Optional[Tuple[str, Seq]]],
+                    reads1: Iterator, reads2: Iterator) \
+        -> Iterator[Optional[Tuple[Seq, Seq]]]:
+    """
+    :param fmatch: forward read matcher; it must prioritise the forward primer
+    :param rmatch: reverse read matcher; it must prioritise the reverse primer
+    :param reads1:
+    :param reads2:
+    :return:
+    """
     for r1, r2 in zip(reads1, reads2):
-        match1 = match([('F', forward), ('R', reverse)], r1)
-        match2 = match([('R', reverse), ('F', forward)], r2)
+        match1 = fmatch(r1)
+        match2 = rmatch(r2)
         # both matches must be positive and come from different primers
         if not (match1 and match2) or match1[0] == match2[0] or match1[0] == 'R':
             yield None
@@ -77,40 +185,109 @@ def normalise_pairs(forward, reverse, reads1: Iterator, reads2: Iterator) -> Ite
         yield match1[1], match2[1]
 
 
+def mkmatchers(engine: str, substitutions: int, forward: str, reverse: str) \
+        -> Tuple[Callable[[Seq], Optional[Tuple[str, Seq]]],
+                 Callable[[Seq], Optional[Tuple[str, Seq]]]]:
+    """
+    Make forward and reverse read matchers for normalise_pairs
+    :param engine: either 'hamming' (PrimerMatcher) or 'regex'
+    :param substitutions:
+    :param forward: IUPAC-encoded forward primer
+    :param reverse: IUPAC-encoded reverse primer
+    :return:
+    """
+    if engine == 'regex':
+        fpattern, rpattern = map(F(mkprimer, substitutions), [forward, reverse])
+        return (F(match, [('F', fpattern), ('R', rpattern)]),
+                F(match, [('R', rpattern), ('F', fpattern)]))
+    if engine == 'hamming':
+        return (PrimerMatcher(substitutions, [('F', forward), ('R', reverse)]),
+                PrimerMatcher(substitutions, [('R', reverse), ('F', forward)]))
+    raise ValueError(f'unknown matching engine: {engine}')
+
+
+def normalise_chunk(options: Tuple[str, int, str, str],
+                    chunk: List[Tuple[Tuple[str, str, str],
+                                      Tuple[str, str, str]]]) \
+        -> Tuple[int, int, bytes, bytes]:
+    """
+    A picklable unit of parallel work: normalise a chunk of raw read pairs and
+    encode the good ones as FASTQ records
+    :param options: mkmatchers arguments
+    :param chunk: raw (name, seq, qual) read pairs
+    :return: the number of pairs, the number of bad pairs and FASTQ records
+    for both outputs
+    """
+    fmatch, rmatch = mkmatchers(*options)
+    reads1 = starmap(Seq, map(op.itemgetter(0), chunk))
+    reads2 = starmap(Seq, map(op.itemgetter(1), chunk))
+    normalised = list(filter(bool, normalise_pairs(fmatch, rmatch, reads1, reads2)))
+    records1 = encode_records(FASTQ_TEMPLATE, ((r1.name, r1.seq, r1.qual)
+                                               for r1, _ in normalised))
+    records2 = encode_records(FASTQ_TEMPLATE, ((r2.name, r2.seq, r2.qual)
+                                               for _, r2 in normalised))
+    return len(chunk), len(chunk) - len(normalised), records1, records2
+
+
+def _write(output1: RecordWriter, output2: RecordWriter, records1: bytes,
+           records2: bytes):
+    output1.write_bytes(records1)
+    output2.write_bytes(records2)
+
+
 @click.command('primercut')
 @click.option('-f', '--forward', type=str, required=True,
               help='IUPAC-encoded forward primer')
 @click.option('-r', '--reverse', type=str, required=True,
               help='IUPAC-encoded reverse primer')
 @click.option('-m', '--mismatches', type=int, default=0)
+@click.option('-e', '--engine', type=click.Choice(['hamming', 'regex']),
+              default='hamming',
+              help='Primer matching engine: a bit-parallel Hamming matcher or '
+                   'fuzzy regular expressions')
+@click.option('-t', '--threads', type=int, default=1,
+              help='The number of worker processes matching chunks of pairs; '
+                   'parsing and writing run concurrently in the main process')
 @click.argument('inputs', nargs=2, required=True,
                 type=click.Path(exists=True, dir_okay=False, resolve_path=True))
 @click.argument('outputs', nargs=2, required=True,
                 type=click.Path(exists=False, dir_okay=False, resolve_path=True))
-def primercut(forward, reverse, mismatches, inputs: Tuple[str, str], outputs: Tuple[str, str]):
-    forward, reverse = map(F(mkprimer, mismatches), [forward, reverse])
+def primercut(forward, reverse, mismatches, engine, threads,
+              inputs: Tuple[str, str], outputs: Tuple[str, str]):
+    if threads < 1:
+        raise click.BadParameter('must be positive', param_hint='threads')
+    # make sure the primers are valid before spawning any workers
+    options = (engine, mismatches, forward, reverse)
+    mkmatchers(*options)
     in1, in2 = inputs
     out1, out2 = outputs
     bad_pairs = 0
     total_pairs = 0
-    template = '@{}\n{}\n+\n{}'
     with ExitStack() as context:
         reads1, reads2 = (
             F(map, gzread) >> (map, context.enter_context) >>
-            (map, FastqGeneralIterator) >> (map, F(starmap, Seq))
+            (map, FastqGeneralIterator)
         )([in1, in2])
         output1, output2 = (
-            F(map, gzwrite) >> (map, context.enter_context)
+            F(map, lambda path: RecordWriter(compressing(path), path,
+                                             FASTQ_TEMPLATE)) >>
+            (map, context.enter_context)
         )([out1, out2])
-        normalised_pairs = normalise_pairs(forward, reverse, reads1, reads2)
-        for entry in normalised_pairs:
-            total_pairs += 1
-            if not entry:
-                bad_pairs += 1
-                continue
-            r1, r2 = entry
-            print(template.format(r1.name, r1.seq, r1.qual), file=output1)
-            print(template.format(r2.name, r2.seq, r2.qual), file=output2)
+        chunks = chunked(CHUNKSIZE, zip(reads1, reads2))
+        normalised_chunks = pmap(threads, F(normalise_chunk, options), chunks)
+        # a single writer thread preserves the order of chunks, while letting
+        # parsing and matching of the next chunks proceed
+        writer = context.enter_context(ThreadPoolExecutor(1))
+        written = None
+        for size, bad, records1, records2 in normalised_chunks:
+            total_pairs += size
+            bad_pairs += bad
+            if written is not None:
+                written.result()
+            written = writer.submit(_write, output1, output2, records1,
+                                    records2)
+        if written is not None:
+            written.result()
     good_pairs = total_pairs - bad_pairs
     print(f'Successfully normalised {good_pairs} ({good_pairs/total_pairs:.1%})'
           f' pairs out of {total_pairs}', file=sys.stderr)
@@ -23,6 +23,7 @@ setup(
         'multipledispatch',
         'numba',
         'numpy',
+        'scipy',
         'hypothesis',
         'click',
         'pandas',
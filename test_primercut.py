@@ -0,0 +1,44 @@
+from hypothesis import given, settings
+from hypothesis.strategies import text, integers, lists, tuples
+
+from primercut import ALPHABET, Seq, PrimerMatcher, mkprimer, match
+
+
+_primers = text(alphabet=sorted(ALPHABET), min_size=1, max_size=8)
+# N and the gap symbol exercise the corner cases of the regex patterns
+_reads = text(alphabet='ACGTN:', max_size=12)
+
+
+def _unwrap(result):
+    if result is None:
+        return None
+    flag, seq = result
+    return flag, seq.name, seq.seq, seq.qual
+
+
+@settings(max_examples=2000)
+@given(integers(min_value=0, max_value=3),
+       lists(_primers, min_size=1, max_size=3),
+       _reads)
+def test_matcher_regex_equivalence(substitutions, primers, read):
+    seq = Seq('read', read, 'I' * len(read))
+    flagged = list(enumerate(primers))
+    patterns = [(flag, mkprimer(substitutions, primer))
+                for flag, primer in flagged]
+    matcher = PrimerMatcher(substitutions, flagged)
+    assert _unwrap(matcher(seq)) == _unwrap(match(patterns, seq))
+
+
+@given(tuples(_primers, _primers), integers(min_value=0, max_value=2))
+def test_matcher_exact_prefix(primers, substitutions):
+    forward, reverse = primers
+    # pick the first accepted base at each position to build a matching read
+    read = ''.join(ALPHABET[code].strip('[')[0] for code in forward) + 'ACGT'
+    matcher = PrimerMatcher(substitutions, [('F', forward), ('R', reverse)])
+    flag, trimmed = matcher(Seq('read', read, None))
+    assert flag == 'F'
+    assert trimmed.seq == 'ACGT'
+
+
+if __name__ == '__main__':
+    raise RuntimeError